@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# 本地压测：起一个源站（echo + HTTP）、可选的上游 SOCKS5 代理和被测代理，全部在 127.0.0.1 上，
+# 结果以 JSON 输出，便于比较不同引擎和版本
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ('socks5', 'http-connect', 'http-get')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing listening on 127.0.0.1:{port}")
+
+def read_rss(pid):
+    # 返回 (当前 RSS, 峰值 RSS)，单位 KB；非 Linux 平台返回 None
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(':', 1) for line in f)
+        return int(fields['VmRSS'].split()[0]), int(fields['VmHWM'].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 3)
+
+# ---------------- 源站 ----------------
+
+async def echo_handler(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def http_handler(reader, writer):
+    # GET /<n> 返回 n 字节，支持 keep-alive
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            path = head.split(b" ", 2)[1]
+            size = int(path.rsplit(b"/", 1)[-1] or 0)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/octet-stream\r\n"
+                         b"Content-Length: %d\r\n\r\n" % size + b"x" * size)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_origin(echo_port, http_port):
+    echo = await asyncio.start_server(echo_handler, '127.0.0.1', echo_port, backlog=4096)
+    http = await asyncio.start_server(http_handler, '127.0.0.1', http_port, backlog=4096)
+    async with echo, http:
+        await asyncio.gather(echo.serve_forever(), http.serve_forever())
+
+# ---------------- 客户端 ----------------
+
+class Recorder:
+    def __init__(self):
+        self.connects = []
+        self.requests = []
+        self.bytes = 0
+        self.errors = 0
+
+async def open_socks(port, target):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b"\x05\x01\x00")
+    await reader.readexactly(2)
+    writer.write(b"\x05\x01\x00\x01" + socket.inet_aton(target[0]) + target[1].to_bytes(2, 'big'))
+    reply = await reader.readexactly(4)
+    if reply[1] != 0:
+        raise ConnectionError(f"SOCKS5 reply {reply[1]}")
+    await reader.readexactly({1: 4, 4: 16}[reply[3]] + 2)
+    return reader, writer
+
+async def open_connect(port, target):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f"CONNECT {target[0]}:{target[1]} HTTP/1.1\r\nHost: {target[0]}:{target[1]}\r\n\r\n".encode())
+    head = await reader.readuntil(b"\r\n\r\n")
+    if b" 200 " not in head.split(b"\r\n", 1)[0]:
+        raise ConnectionError(head.split(b"\r\n", 1)[0].decode(errors='replace'))
+    return reader, writer
+
+async def echo_rounds(reader, writer, payload, rounds, rec):
+    for _ in range(rounds):
+        start = time.perf_counter()
+        writer.write(payload)
+        await reader.readexactly(len(payload))
+        rec.requests.append(time.perf_counter() - start)
+        rec.bytes += 2 * len(payload)
+
+async def http_rounds(port, origin, size, rounds, rec):
+    # 经代理转发的普通 HTTP 请求；第一个响应到达视为建立完成
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        request = f"GET http://{origin[0]}:{origin[1]}/{size} HTTP/1.1\r\nHost: {origin[0]}:{origin[1]}\r\n\r\n".encode()
+        for i in range(rounds):
+            sent = time.perf_counter()
+            writer.write(request)
+            head = await reader.readuntil(b"\r\n\r\n")
+            headers = head.lower()
+            if b" 200 " not in head.split(b"\r\n", 1)[0]:
+                raise ConnectionError(head.split(b"\r\n", 1)[0].decode(errors='replace'))
+            length = int(headers.split(b"content-length:", 1)[1].split(b"\r\n", 1)[0])
+            await reader.readexactly(length)
+            now = time.perf_counter()
+            if i == 0:
+                rec.connects.append(now - start)
+            rec.requests.append(now - sent)
+            rec.bytes += length
+            if b"connection: close" in headers:
+                break
+    finally:
+        writer.close()
+
+async def worker(scenario, port, args, targets, deadline, rec):
+    payload = b"x" * args.payload
+    while time.monotonic() < deadline:
+        try:
+            if scenario == 'http-get':
+                await http_rounds(port, targets['http'], args.payload, args.requests_per_conn, rec)
+                continue
+            start = time.perf_counter()
+            opener = open_socks if scenario == 'socks5' else open_connect
+            reader, writer = await opener(port, targets['echo'])
+            rec.connects.append(time.perf_counter() - start)
+            try:
+                await echo_rounds(reader, writer, payload, args.requests_per_conn, rec)
+            finally:
+                writer.close()
+        except (OSError, asyncio.IncompleteReadError, ValueError, IndexError, KeyError):
+            rec.errors += 1
+            await asyncio.sleep(0.01)
+
+async def drive(scenario, port, args, targets, proxy_process):
+    rec = Recorder()
+    start = time.monotonic()
+    deadline = start + args.duration
+    rss_samples = []
+
+    async def sample_rss():
+        while time.monotonic() < deadline:
+            rss = read_rss(proxy_process.pid)
+            if rss:
+                rss_samples.append(rss[0])
+            await asyncio.sleep(0.5)
+
+    await asyncio.gather(sample_rss(), *(worker(scenario, port, args, targets, deadline, rec)
+                                         for _ in range(args.concurrency)))
+    elapsed = time.monotonic() - start
+    rss = read_rss(proxy_process.pid)
+    return {
+        'scenario': scenario,
+        'duration': round(elapsed, 3),
+        'connections': len(rec.connects),
+        'requests': len(rec.requests),
+        'errors': rec.errors,
+        'connections_per_sec': round(len(rec.connects) / elapsed, 1),
+        'requests_per_sec': round(len(rec.requests) / elapsed, 1),
+        'throughput_mbps': round(rec.bytes * 8 / elapsed / 1e6, 2),
+        'connect_latency_ms': {'p50': percentile(rec.connects, 50), 'p99': percentile(rec.connects, 99)},
+        'request_latency_ms': {'p50': percentile(rec.requests, 50), 'p99': percentile(rec.requests, 99)},
+        'proxy_rss_kb': {'avg': int(sum(rss_samples) / len(rss_samples)) if rss_samples else None,
+                         'peak': rss[1] if rss else None},
+    }
+
+# ---------------- 进程管理 ----------------
+
+def spawn(args, workdir):
+    # 在临时目录中启动，避免读到当前目录下的 proxies.json
+    return subprocess.Popen([sys.executable] + args, cwd=workdir,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='sockstools-bench-')
+    processes = []
+    results = []
+    try:
+        echo_port, http_port = free_port(), free_port()
+        processes.append(spawn([os.path.abspath(__file__), '--origin', str(echo_port), str(http_port)], workdir))
+        wait_for_port(echo_port)
+        wait_for_port(http_port)
+        targets = {'echo': ('127.0.0.1', echo_port), 'http': ('127.0.0.1', http_port)}
+
+        upstream = []
+        if args.upstream:
+            upstream_port = free_port()
+            processes.append(spawn([os.path.join(HERE, 'proxy.py'), '--type', 'socks5', '--engine', 'asyncio',
+                                    '--port', str(upstream_port)], workdir))
+            wait_for_port(upstream_port)
+            upstream = ['--upstream', f'socks5://127.0.0.1:{upstream_port}']
+
+        for scenario in (SCENARIOS if args.scenario == 'all' else (args.scenario,)):
+            port = free_port()
+            proxy_type = 'socks5' if scenario == 'socks5' else 'http'
+            command = [os.path.join(HERE, 'proxy.py'), '--type', proxy_type, '--port', str(port),
+                       '--engine', args.engine, '--relay', args.relay] + upstream + args.proxy_arg
+            if args.relay_workers is not None:
+                command += ['--relay-workers', str(args.relay_workers)]
+            proxy_process = spawn(command, workdir)
+            try:
+                wait_for_port(port)
+                result = asyncio.run(drive(scenario, port, args, targets, proxy_process))
+            finally:
+                proxy_process.terminate()
+                proxy_process.wait()
+            result['config'] = {
+                'engine': args.engine if proxy_type == 'socks5' else 'thread', 'relay': args.relay,
+                'relay_workers': args.relay_workers, 'upstream': bool(args.upstream),
+                'concurrency': args.concurrency, 'payload': args.payload,
+                'requests_per_conn': args.requests_per_conn, 'proxy_args': args.proxy_arg,
+            }
+            results.append(result)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Localhost load test for the HTTP and SOCKS5 listeners")
+    parser.add_argument('--scenario', choices=SCENARIOS + ('all',), default='all', help='What to drive (default: all)')
+    parser.add_argument('--concurrency', type=int, default=50, help='Concurrent client connections (default: 50)')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per scenario (default: 10)')
+    parser.add_argument('--payload', type=int, default=16384, help='Bytes echoed per request, or HTTP response size (default: 16384)')
+    parser.add_argument('--requests-per-conn', type=int, default=1, help='Requests per connection; 1 measures connection churn (default: 1)')
+    parser.add_argument('--upstream', action='store_true', help='Chain through a local stand-in SOCKS5 upstream')
+    parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread', help='SOCKS5 engine under test (default: thread)')
+    parser.add_argument('--relay', choices=['auto', 'splice', 'copy'], default='auto', help='Relay mode under test (default: auto)')
+    parser.add_argument('--relay-workers', type=int, help='Relay reactor threads under test (default: proxy default)')
+    parser.add_argument('--proxy-arg', action='append', default=[], help='Extra argument passed to proxy.py (repeatable)')
+    parser.add_argument('--output', help='Also write the JSON results to this file')
+    parser.add_argument('--origin', nargs=2, type=int, metavar=('ECHO_PORT', 'HTTP_PORT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.origin:
+        asyncio.run(serve_origin(*args.origin))
+        return
+
+    output = json.dumps(run(args), indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,205 +1,3845 @@
 import socket
 import select
+import selectors
+import itertools
+import queue
+import os
+import errno
 import threading
 import argparse
+import atexit
+import signal
+import multiprocessing
+import multiprocessing.connection
+import re
+import sys
+import collections
+import contextlib
+import gc
+from concurrent.futures import ThreadPoolExecutor
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from socketserver import ThreadingMixIn
 import socks
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util import Retry
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 import json
 import random
 import time
+import zlib
+import codecs
+import bisect
+import heapq
+import hmac
+import base64
+import ipaddress
+import hashlib
+import mmap
+import email.utils
+import math
+import functools
 import urllib3
 import aiohttp
 import asyncio
-from typing import List, Dict
+from typing import List, Dict, Optional
+from urllib.parse import urlsplit, unquote, quote, parse_qs
+from types import MappingProxyType
 import aiofiles
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+RELAY_CHUNK = 65536
+RELAY_MODE = 'auto'  # auto / splice / copy
+RELAY_WORKERS = min(4, os.cpu_count() or 1)  # 0 表示每个隧道使用独立线程转发
+ROTATE_MODE = 'off'  # off / connection / host：是否为每个连接（或每个目标主机）从代理池选择上游
+CONNECT_TIMEOUT = 10  # 经过上游建立连接的单次超时（秒）
+FAILOVER_ATTEMPTS = 3  # 上游连接失败时最多尝试的上游数量
+FAILOVER_DEADLINE = 15  # 所有尝试的总时限（秒）
+RACE_COUNT = 1  # >1 时同时经过多个上游竞速建立连接（happy eyeballs）
+RACE_STAGGER = 0.25  # 竞速时相邻两次尝试的启动间隔（秒）
+BIND_TIMEOUT = 120  # SOCKS5 BIND 等待目标连入的时限（秒）
+SNIFF_TIMEOUT = 10  # 单端口模式等待客户端第一个字节的时限（秒）
+SOCKS_USERS = {}  # SOCKS5 用户名 -> 密码，非空时要求客户端认证
+warm_pool = None  # WarmPool 实例，--warm-pool 大于 0 时创建
+REUSE_PORT = False  # --workers 模式下各工作进程以 SO_REUSEPORT 绑定同一端口
+SPLICE_SUPPORTED = hasattr(os, 'splice')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRIC_HELP = {
+    'sockstools_connects_total': ('counter', 'Tunnels and forwarded requests established'),
+    'sockstools_connect_errors_total': ('counter', 'Client connections that failed before a tunnel was established'),
+    'sockstools_rejected_total': ('counter', 'Client connections refused by the per-client connection cap'),
+    'sockstools_active_tunnels': ('gauge', 'Tunnels and forwarded requests currently open'),
+    'sockstools_bytes_total': ('counter', 'Bytes relayed; upstream is client to target, downstream is target to client'),
+    'sockstools_handshake_seconds': ('histogram', 'Time from accepting a client to the tunnel being ready'),
+    'sockstools_upstream_connect_seconds': ('histogram', 'Time to connect to a target through an upstream, or directly'),
+    'sockstools_upstream_failures_total': ('counter', 'Failed connect attempts per upstream'),
+    'sockstools_dns_cache_hits_total': ('counter', 'DNS cache hits'),
+    'sockstools_dns_cache_misses_total': ('counter', 'DNS lookups sent to the system resolver'),
+    'sockstools_dns_cache_coalesced_total': ('counter', 'DNS lookups that joined an in-flight lookup'),
+    'sockstools_dns_cache_errors_total': ('counter', 'Failed DNS lookups'),
+    'sockstools_dns_cache_entries': ('gauge', 'Entries in the DNS cache'),
+    'sockstools_cache_requests_total': ('counter', 'HTTP cache lookups by result: hit, miss, revalidated, coalesced'),
+    'sockstools_cache_entries': ('gauge', 'Responses held in the HTTP cache per tier'),
+    'sockstools_cache_bytes': ('gauge', 'Response body bytes held in the HTTP cache per tier'),
+}
+
+class Metrics:
+    # 每个线程写自己的计数器分片，热路径上不加锁；抓取时再把各分片汇总
+    def __init__(self):
+        self.enabled = False
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []  # [(thread, shard)]
+        self.retired = {}  # 已退出线程的分片合并到这里
+        self.collectors = []  # 抓取时调用，返回 [(key, value)]
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                if len(self.shards) >= 256:
+                    self.fold()
+                self.shards.append((threading.current_thread(), shard))
+            return shard
+
+    def add(self, key, value=1):
+        # key 为 (指标名, ((标签, 值), ...))
+        if self.enabled:
+            shard = self.shard()
+            shard[key] = shard.get(key, 0) + value
+
+    def observe(self, key, seconds):
+        if self.enabled:
+            shard = self.shard()
+            buckets = shard.get(key)
+            if buckets is None:
+                buckets = shard[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            buckets[-2] += seconds
+            buckets[-1] += 1
+
+    @staticmethod
+    def merge(totals, shard):
+        for key, value in shard.copy().items():
+            if isinstance(value, list):
+                merged = totals.setdefault(key, [0] * len(value))
+                for i, v in enumerate(value):
+                    merged[i] += v
+            else:
+                totals[key] = totals.get(key, 0) + value
+
+    def fold(self):
+        # 调用方持有 self.lock
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self.merge(self.retired, shard)
+        self.shards = alive
+
+    def totals(self):
+        totals = {}
+        with self.lock:
+            self.fold()
+            self.merge(totals, self.retired)
+            for _, shard in self.shards:
+                self.merge(totals, shard)
+        for collector in self.collectors:
+            self.merge(totals, dict(collector()))
+        return totals
+
+    def active_tunnels(self):
+        return sum(value for (name, _), value in self.totals().items() if name == 'sockstools_active_tunnels')
+
+    def render(self):
+        totals = self.totals()
+        families = {}
+        for (name, labels), value in totals.items():
+            families.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(families):
+            kind, help_text = METRIC_HELP.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(families[name]):
+                if kind != 'histogram':
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {value[-2]:.6f}")
+                lines.append(f"{name}_count{format_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+metrics = Metrics()
+
+@functools.lru_cache(maxsize=4096)
+def upstream_label(upstream_name):
+    # 指标标签中去掉上游的用户名和密码
+    if not upstream_name:
+        return 'direct'
+    return upstream_for(upstream_name).label
+
+def tunnel_labels(listener, upstream_name):
+    return (('listener', listener), ('upstream', upstream_label(upstream_name)))
+
+def byte_keys(labels):
+    # (客户端 -> 目标, 目标 -> 客户端) 两个方向的字节计数键
+    return (('sockstools_bytes_total', labels + (('direction', 'upstream'),)),
+            ('sockstools_bytes_total', labels + (('direction', 'downstream'),)))
+
+def tunnel_opened(labels, start=None):
+    metrics.add(('sockstools_connects_total', labels))
+    metrics.add(('sockstools_active_tunnels', labels))
+    if start is not None:
+        metrics.observe(('sockstools_handshake_seconds', labels), time.monotonic() - start)
+
+def tunnel_closed(labels, upstream_name=None):
+    metrics.add(('sockstools_active_tunnels', labels), -1)
+    release_upstream(upstream_name)
+
+def connect_failed(listener):
+    metrics.add(('sockstools_connect_errors_total', (('listener', listener),)))
+
+def connection_rejected(listener):
+    metrics.add(('sockstools_rejected_total', (('listener', listener),)))
+
+class TokenBucket:
+    # 令牌桶：rate 字节/秒，容量为 0.25 秒的量（至少一个分块）。允许透支，透支的部分换算成调用方需要暂停读取的秒数；
+    # rate 为 0 表示不限速
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'lock')
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.burst = max(rate // 4, RELAY_CHUNK)
+            self.tokens = self.burst
+            self.stamp = time.monotonic()
+
+    def take(self, n, now):
+        if not self.rate:
+            return 0.0
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate) - n
+            self.stamp = now
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def full(self, now):
+        # 已经回满的桶和新建的没有区别，可以丢弃
+        return not self.rate or self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+def throttle(buckets, n):
+    # 一个分块经过（全局、客户端、上游）三个桶，返回需要暂停的秒数
+    now = time.monotonic()
+    return max(buckets[0].take(n, now), buckets[1].take(n, now), buckets[2].take(n, now))
+
+class RateLimits:
+    # 全局、每个客户端 IP、每个上游的带宽限制，以及每个客户端的并发连接上限（0 表示不限，每个进程单独计算）。
+    # 隧道建立时取得三个桶的引用，转发时每个分块只调用一次 throttle()；
+    # configure() 可在运行时调用（如 /limits 端点），已有隧道立即按新速率执行
+    def __init__(self):
+        self.global_rate = self.client_rate = self.upstream_rate = 0
+        self.client_connections = 0
+        self.global_bucket = TokenBucket()
+        self.buckets = {}  # ('client', ip) / ('upstream', name) -> [TokenBucket, 使用中的隧道数]
+        self.swept = 0.0
+        self.connections = collections.Counter()
+        self.lock = threading.Lock()
+        self.on_change = None  # 多进程模式下由父进程设置，把新的限制下发给工作进程
+
+    def configure(self, global_rate=None, client_rate=None, upstream_rate=None, client_connections=None):
+        with self.lock:
+            if global_rate is not None:
+                self.global_rate = global_rate
+                self.global_bucket.set_rate(global_rate)
+            if client_rate is not None:
+                self.client_rate = client_rate
+            if upstream_rate is not None:
+                self.upstream_rate = upstream_rate
+            if client_connections is not None:
+                self.client_connections = client_connections
+            for (kind, _), (bucket, _) in self.buckets.items():
+                rate = self.client_rate if kind == 'client' else self.upstream_rate
+                if bucket.rate != rate:
+                    bucket.set_rate(rate)
+        if self.on_change:
+            self.on_change(self.settings())
+
+    def settings(self):
+        return {'global_rate': self.global_rate, 'client_rate': self.client_rate,
+                'upstream_rate': self.upstream_rate, 'client_connections': self.client_connections}
+
+    def admit(self, client_ip) -> bool:
+        # 超过并发上限时返回 False；返回 True 的连接结束时必须调用 leave()
+        with self.lock:
+            if self.client_connections and self.connections[client_ip] >= self.client_connections:
+                return False
+            self.connections[client_ip] += 1
+            return True
+
+    def leave(self, client_ip):
+        with self.lock:
+            self.connections[client_ip] -= 1
+            if self.connections[client_ip] <= 0:
+                del self.connections[client_ip]
+
+    def buckets_for(self, client_ip, upstream_name):
+        # 隧道结束时调用 release()。桶在没有隧道使用并且回满之后才删除，
+        # 否则一个接一个的短连接每次都拿到新桶，限速就失效了
+        with self.lock:
+            return (self.global_bucket, self.acquire(('client', client_ip), self.client_rate),
+                    self.acquire(('upstream', upstream_name or 'direct'), self.upstream_rate))
+
+    def acquire(self, key, rate):
+        entry = self.buckets.get(key)
+        if entry is None:
+            entry = self.buckets[key] = [TokenBucket(rate), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, client_ip, upstream_name):
+        with self.lock:
+            for key in (('client', client_ip), ('upstream', upstream_name or 'direct')):
+                entry = self.buckets.get(key)
+                if entry:
+                    entry[1] -= 1
+            now = time.monotonic()
+            if now - self.swept > 1:
+                self.swept = now
+                self.buckets = {key: entry for key, entry in self.buckets.items()
+                                if entry[1] > 0 or not entry[0].full(now)}
+
+rate_limits = RateLimits()
+LIMIT_FIELDS = ('global_rate', 'client_rate', 'upstream_rate', 'client_connections')
+
+def configure_limits(args):
+    rate_limits.configure(**{name: getattr(args, name, 0) or 0 for name in LIMIT_FIELDS})
+
+def byte_rate(value):
+    # 命令行中的速率，支持 k/m/g 后缀（1024 进制），单位字节/秒
+    value = value.strip().lower().rstrip('b')
+    scale = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}.get(value[-1:], 1)
+    return int(float(value[:-1] if scale > 1 else value) * scale)
+
+class CopyPump:
+    # 单方向转发 src -> dst，复用同一块缓冲区，避免每个分块都分配新的 bytes
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.buf = bytearray(RELAY_CHUNK)
+        self.view = memoryview(self.buf)
+
+    def pump(self):
+        n = self.src.recv_into(self.buf)
+        if n:
+            self.dst.sendall(self.view[:n])
+        return n
+
+    def close(self):
+        self.view.release()
+
+class SplicePump:
+    # 通过管道在内核中 splice 数据，不经过 Python 层
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.rfd, self.wfd = os.pipe()
+        self.writable = None  # 等待 dst 可写的 poll 对象，第一次需要时创建
+
+    def pump(self):
+        try:
+            n = os.splice(self.src.fileno(), self.wfd, RELAY_CHUNK, flags=os.SPLICE_F_MOVE)
+        except BlockingIOError:
+            return -1  # 设置了超时的套接字是非阻塞的，可能出现伪唤醒
+        pending = n
+        while pending:
+            try:
+                pending -= os.splice(self.rfd, self.dst.fileno(), pending, flags=os.SPLICE_F_MOVE)
+            except BlockingIOError:
+                if self.writable is None:
+                    # 用 poll 而不是 select，描述符编号超过 FD_SETSIZE 时也能等待
+                    self.writable = select.poll()
+                    self.writable.register(self.dst, select.POLLOUT)
+                self.writable.poll()
+        return n
+
+    def close(self):
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+def make_pump(src, dst, mode=None):
+    mode = mode or RELAY_MODE
+    if mode != 'copy' and SPLICE_SUPPORTED:
+        return SplicePump(src, dst)
+    if mode == 'splice':
+        log("splice is not available on this platform, falling back to copy relay", "WARNING")
+    return CopyPump(src, dst)
+
+def relay(a, b, timeout=None, mode=None, labels=None, buckets=None):
+    pumps = {a: make_pump(a, b, mode), b: make_pump(b, a, mode)}
+    keys = dict(zip((a, b), byte_keys(labels))) if labels else None
+    selector = selectors.DefaultSelector()  # 与 RelayReactor 相同，不受 select() 的 FD_SETSIZE 限制
+    selector.register(a, selectors.EVENT_READ)
+    selector.register(b, selectors.EVENT_READ)
+    try:
+        while True:
+            events = selector.select(timeout)
+            if not events:
+                break
+            for key, _ in events:
+                r = key.fileobj
+                if buckets:
+                    delay = throttle(buckets, 0)
+                    if delay:
+                        time.sleep(delay)  # 每个隧道独占线程，直接暂停即可
+                try:
+                    n = pumps[r].pump()
+                    if not n:
+                        return
+                    if keys and n > 0:
+                        metrics.add(keys[r], n)
+                    if buckets and n > 0:
+                        throttle(buckets, n)
+                except OSError as e:
+                    if isinstance(pumps[r], SplicePump) and e.errno in (errno.EINVAL, errno.ENOSYS):
+                        # 该套接字不支持 splice（尚未搬运任何数据），退回到缓冲区复制
+                        pumps[r].close()
+                        pumps[r] = CopyPump(r, pumps[r].dst)
+                        continue
+                    return
+    finally:
+        selector.close()
+        for pump in pumps.values():
+            pump.close()
+
+class RelayChannel:
+    # reactor 中的单方向通道 src -> dst；splice 模式下管道本身充当积压缓冲区
+    __slots__ = ('src', 'dst', 'pipe', 'queued', 'backlog', 'eof', 'done', 'key', 'buckets', 'resume')
+
+    def __init__(self, src, dst, splice, key=None, buckets=None):
+        self.src = src
+        self.dst = dst
+        self.key = key  # 字节计数的指标键
+        self.buckets = buckets
+        self.resume = 0  # 被限速时暂停读取到这个时间点
+        self.pipe = os.pipe() if splice else None
+        self.queued = 0
+        self.backlog = b''
+        self.eof = False
+        self.done = False
+
+    def blocked(self):
+        return bool(self.queued or self.backlog)
+
+    def read(self, view):
+        # 返回 False 表示读到 EOF
+        if self.buckets and self.throttle(0):
+            return True  # 桶里还有透支（可能来自同一客户端的其它隧道），先不读
+        if self.pipe:
+            try:
+                n = os.splice(self.src.fileno(), self.pipe[1], RELAY_CHUNK,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                return True
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                    raise
+                self.close()  # 不支持 splice，退回到缓冲区复制
+                return self.read(view)
+            self.queued += n
+            if n and self.key:
+                metrics.add(self.key, n)
+            if n and self.buckets:
+                self.throttle(n)
+            return n > 0
+        try:
+            n = self.src.recv_into(view)
+        except BlockingIOError:
+            return True
+        if n:
+            if self.key:
+                metrics.add(self.key, n)
+            if self.buckets:
+                self.throttle(n)
+            try:
+                sent = self.dst.send(view[:n])
+            except BlockingIOError:
+                sent = 0
+            if sent < n:
+                self.backlog = bytes(view[sent:n])
+        return n > 0
+
+    def throttle(self, n):
+        delay = throttle(self.buckets, n)
+        if delay:
+            self.resume = time.monotonic() + delay
+        return delay
+
+    def flush(self):
+        # 返回 True 表示积压已清空
+        try:
+            while self.queued:
+                self.queued -= os.splice(self.pipe[0], self.dst.fileno(), self.queued,
+                                         flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            while self.backlog:
+                self.backlog = self.backlog[self.dst.send(self.backlog):]
+        except BlockingIOError:
+            return False
+        return True
+
+    def close(self):
+        if self.pipe:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
+class RelayTunnel:
+    __slots__ = ('a', 'b', 'channels', 'events', 'on_close')
+
+    def __init__(self, a, b, splice, on_close=None, labels=None, buckets=None):
+        self.a = a
+        self.b = b
+        self.on_close = on_close
+        up, down = byte_keys(labels) if labels else (None, None)
+        self.channels = {a: RelayChannel(a, b, splice, up, buckets), b: RelayChannel(b, a, splice, down, buckets)}
+        self.events = {a: 0, b: 0}
+
+    def peer(self, sock):
+        return self.b if sock is self.a else self.a
+
+    def interest(self, sock):
+        outbound = self.channels[sock]
+        inbound = self.channels[self.peer(sock)]
+        events = 0
+        if not outbound.eof and not outbound.blocked() and not outbound.resume:
+            events |= selectors.EVENT_READ
+        if inbound.blocked():
+            events |= selectors.EVENT_WRITE
+        return events
+
+class RelayWorker(threading.Thread):
+    # 一个 epoll 选择器 + 一个线程服务大量隧道，不受 FD_SETSIZE 限制
+    def __init__(self, index):
+        super().__init__(name=f"relay-{index}", daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.incoming = queue.SimpleQueue()
+        self.tunnels = set()
+        self.timers = []  # (恢复读取的时间, 序号, tunnel, channel) 小根堆，用于限速
+        self.sequence = itertools.count()
+        self.running = True
+        self.buf = bytearray(RELAY_CHUNK)
+        self.view = memoryview(self.buf)
+        self.waker_r, self.waker_w = socket.socketpair()
+        self.waker_r.setblocking(False)
+        self.waker_w.setblocking(False)
+        self.selector.register(self.waker_r, selectors.EVENT_READ)
+
+    def add(self, a, b, on_close=None, labels=None, buckets=None):
+        self.incoming.put((a, b, on_close, labels, buckets))
+        self.wake()
+
+    def wake(self):
+        try:
+            self.waker_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def stop(self):
+        self.running = False
+        self.wake()
+
+    def run(self):
+        splice = RELAY_MODE != 'copy' and SPLICE_SUPPORTED
+        while self.running:
+            timeout = max(0, self.timers[0][0] - time.monotonic()) if self.timers else None
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    self.accept_tunnels(splice)
+                else:
+                    self.handle(key.data, key.fileobj, mask)
+            if self.timers:
+                self.resume_due()
+        for tunnel in list(self.tunnels):
+            self.close_tunnel(tunnel)
+        self.selector.close()
+        self.waker_r.close()
+        self.waker_w.close()
+
+    def accept_tunnels(self, splice):
+        try:
+            while self.waker_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                a, b, on_close, labels, buckets = self.incoming.get_nowait()
+            except queue.Empty:
+                break
+            a.setblocking(False)
+            b.setblocking(False)
+            tunnel = RelayTunnel(a, b, splice, on_close, labels, buckets)
+            self.tunnels.add(tunnel)
+            self.update(tunnel, a)
+            self.update(tunnel, b)
+
+    def update(self, tunnel, sock):
+        old, new = tunnel.events[sock], tunnel.interest(sock)
+        if old == new:
+            return
+        if not old:
+            self.selector.register(sock, new, tunnel)
+        elif not new:
+            self.selector.unregister(sock)
+        else:
+            self.selector.modify(sock, new, tunnel)
+        tunnel.events[sock] = new
+
+    def handle(self, tunnel, sock, mask):
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self.drain(tunnel.channels[tunnel.peer(sock)])
+            if mask & selectors.EVENT_READ:
+                channel = tunnel.channels[sock]
+                if not channel.read(self.view):
+                    channel.eof = True
+                elif channel.resume:
+                    heapq.heappush(self.timers, (channel.resume, next(self.sequence), tunnel, channel))
+                self.drain(channel)
+        except OSError:
+            self.close_tunnel(tunnel)
+            return
+        if all(channel.done for channel in tunnel.channels.values()):
+            self.close_tunnel(tunnel)
+            return
+        self.update(tunnel, tunnel.a)
+        self.update(tunnel, tunnel.b)
+
+    def resume_due(self):
+        now = time.monotonic()
+        timers = self.timers
+        while timers and timers[0][0] <= now:
+            _, _, tunnel, channel = heapq.heappop(timers)
+            channel.resume = 0
+            if tunnel in self.tunnels:
+                self.update(tunnel, channel.src)
+
+    def drain(self, channel):
+        if channel.flush() and channel.eof and not channel.done:
+            channel.done = True
+            channel.dst.shutdown(socket.SHUT_WR)  # 半关闭，另一方向继续转发
+
+    def close_tunnel(self, tunnel):
+        self.tunnels.discard(tunnel)
+        for sock in (tunnel.a, tunnel.b):
+            if tunnel.events[sock]:
+                self.selector.unregister(sock)
+                tunnel.events[sock] = 0
+            sock.close()
+        for channel in tunnel.channels.values():
+            channel.close()
+        if tunnel.on_close:
+            tunnel.on_close()
+
+class RelayReactor:
+    # 握手完成后接管两个套接字，由固定数量的 worker 线程轮流分担
+    def __init__(self, workers=RELAY_WORKERS):
+        self.workers = [RelayWorker(i) for i in range(max(1, workers))]
+        self.counter = itertools.count()
+        for worker in self.workers:
+            worker.start()
+
+    def add_tunnel(self, a, b, on_close=None, labels=None, buckets=None):
+        self.workers[next(self.counter) % len(self.workers)].add(a, b, on_close, labels, buckets)
+
+    def active_tunnels(self):
+        return sum(len(worker.tunnels) for worker in self.workers)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+relay_reactor = None
+relay_reactor_lock = threading.Lock()
+
+def get_relay_reactor():
+    global relay_reactor
+    if relay_reactor is None:
+        with relay_reactor_lock:
+            if relay_reactor is None:
+                relay_reactor = RelayReactor(RELAY_WORKERS)
+    return relay_reactor
+
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                      'proxy-connection', 'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'}
+STREAM_BODY_MIN = 65536  # 更短的请求体整个读入内存，故障转移时可以重发
+
+def end_to_end_headers(headers, exclude=()):
+    # 去掉逐跳头，包括 Connection 头里列出的；重复的头（如多个 Set-Cookie）分别保留
+    connection = {token.strip().lower() for value in headers.get_all('Connection', ()) for token in value.split(',')} \
+        if hasattr(headers, 'get_all') else {token.strip().lower() for token in headers.get('Connection', '').split(',')}
+    return [(name, value) for name, value in headers.items()
+            if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() not in connection and name.lower() not in exclude]
+
+class RequestBody:
+    # 客户端请求体的流式读取（Content-Length 或 chunked），requests 逐块读取后转发，内存占用与请求体大小无关。
+    # 有 len 属性时 requests 按 Content-Length 发送，否则用 chunked 发送
+    def __init__(self, rfile, length=None):
+        self.rfile = rfile
+        self.remaining = length  # chunked 时为当前块剩余的字节数
+        self.chunked = length is None
+        self.finished = not length and not self.chunked
+        self.sent = 0
+        if length is not None:
+            self.len = length
+
+    def __iter__(self):
+        while True:
+            data = self.read(RELAY_CHUNK)
+            if not data:
+                return
+            yield data
+
+    def read(self, size=-1):
+        if self.finished:
+            return b''
+        if size is None or size < 0:
+            size = RELAY_CHUNK
+        if self.chunked and not self.remaining:
+            self.remaining = self.next_chunk()
+            if not self.remaining:
+                self.finished = True
+                return b''
+        data = self.rfile.read1(min(size, self.remaining))
+        if not data:
+            raise ConnectionError("Client closed the connection in the middle of the request body")
+        self.remaining -= len(data)
+        self.sent += len(data)
+        if not self.remaining:
+            if self.chunked:
+                self.rfile.readline(8)  # 块末尾的 CRLF
+            else:
+                self.finished = True
+        return data
+
+    def next_chunk(self):
+        line = self.rfile.readline(1026)
+        try:
+            size = int(line.split(b';', 1)[0].strip(), 16)
+        except ValueError:
+            raise ValueError(f"Malformed chunk size line {line[:32]!r}") from None
+        if size == 0:
+            # 最后一块之后是可选的 trailer，以空行结束
+            while self.rfile.readline(65537) not in (b'\r\n', b'\n', b''):
+                pass
+        return size
+
+class ConnectAdapter(HTTPAdapter):
+    # 只替换这个适配器的连接池新建连接的方式（子类实现 connect），请求（以及 HTTPS 的 TLS）直接在返回的套接字上进行
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        connect = self.connect
+
+        def new_conn(conn):
+            # 和 urllib3 一样包装异常，这样连接失败仍按 Retry 的 connect 次数重试
+            try:
+                return connect(conn)
+            except socket.timeout as e:
+                raise ConnectTimeoutError(conn, f"Connection to {conn.host} timed out. (connect timeout={conn.timeout})") from e
+            except OSError as e:
+                raise NewConnectionError(conn, f"Failed to establish a new connection: {e}") from e
+
+        prefix = type(self).__name__.removesuffix('Adapter')
+        classes = {}
+        for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items():
+            connection_class = type(prefix + pool_class.ConnectionCls.__name__, (pool_class.ConnectionCls,),
+                                    {'_new_conn': new_conn})
+            classes[scheme] = type(prefix + pool_class.__name__, (pool_class,), {'ConnectionCls': connection_class})
+        self.poolmanager.pool_classes_by_scheme = classes
+
+class DirectAdapter(ConnectAdapter):
+    # HTTP 直连转发：域名经过 dns_resolver 解析，和隧道直连共用解析缓存
+    def connect(self, conn):
+        return connect_direct((conn._dns_host, conn.port), conn.timeout, conn.source_address, conn.socket_options)
+
+class ChainAdapter(ConnectAdapter):
+    # 经过多跳上游转发普通 HTTP 请求：连接池新建连接时先穿过整条链
+    def __init__(self, chain, **kwargs):
+        self.chain = chain
+        super().__init__(**kwargs)
+
+    def connect(self, conn):
+        return self.chain.connect((conn._dns_host, conn.port), conn.timeout)
+
+class UpstreamSessions:
+    # 每个上游（直连为 None）一个 requests.Session，所有处理线程共享其连接池
+    def __init__(self, pool_size=32, idle_timeout=120, retries=2):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.sessions: Dict[str, list] = {}
+        self.lock = threading.Lock()
+
+    def get(self, upstream):
+        key = str(upstream) if upstream else None
+        now = time.monotonic()
+        with self.lock:
+            self.evict_idle(now)
+            entry = self.sessions.get(key)
+            if entry is None:
+                entry = self.sessions[key] = [self.build(upstream), now]
+            entry[1] = now
+            return entry[0]
+
+    def build(self, upstream):
+        session = requests.Session()
+        retry = Retry(total=self.retries, connect=self.retries, read=0, backoff_factor=0.2,
+                      raise_on_status=False, respect_retry_after_header=False)
+        upstream = upstream_for(upstream)
+        if isinstance(upstream, ProxyChain):
+            adapter_class = functools.partial(ChainAdapter, upstream)
+        else:
+            adapter_class = DirectAdapter if upstream is None else HTTPAdapter
+        adapter = adapter_class(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if isinstance(upstream, UpstreamProxy):
+            session.proxies.update(upstream.requests_proxies)
+        return session
+
+    def evict_idle(self, now):
+        for key, (session, last_used) in list(self.sessions.items()):
+            if now - last_used > self.idle_timeout:
+                del self.sessions[key]
+                session.close()
+
+    def close(self):
+        with self.lock:
+            for session, _ in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+@functools.lru_cache(maxsize=65536)
+def parse_upstream(proxy_string):
+    if ProxyChain.separator in proxy_string:
+        return ProxyChain.parse(proxy_string)
+    return UpstreamProxy.parse(proxy_string)
+
+def upstream_for(upstream):
+    # 字符串 -> UpstreamProxy：代理池中的代理直接取索引里的实例，其它字符串（--upstream 等）解析一次后缓存
+    if not upstream or isinstance(upstream, (UpstreamProxy, ProxyChain)):
+        return upstream or None
+    return proxy_pool.index.get(upstream) or parse_upstream(upstream)
+
+def recv_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by upstream")
+        data += chunk
+    return data
+
+def socks_address(host):
+    # SOCKS5 的 ATYP + 地址字段
+    for address_type, family in ((1, socket.AF_INET), (4, socket.AF_INET6)):
+        try:
+            return bytes((address_type,)) + socket.inet_pton(family, host)
+        except OSError:
+            pass
+    host = host.encode('idna')
+    return b"\x03" + bytes((len(host),)) + host
+
+# 上游握手的报文构造和回复检查与 I/O 无关，阻塞套接字（线程引擎）和 asyncio 流（asyncio 引擎）共用
+def socks5_greeting(username=None):
+    return b"\x05\x02\x00\x02" if username else b"\x05\x01\x00"
+
+def socks5_auth_request(username, password=None):
+    user = username.encode()
+    password = (password or '').encode()
+    return bytes((1, len(user))) + user + bytes((len(password),)) + password
+
+def socks5_check_method(method, username=None):
+    # 返回是否需要用户名/密码认证
+    if method == 0x02 and username:
+        return True
+    if method != 0x00:
+        raise ConnectionError("SOCKS5 upstream rejected the offered authentication methods")
+    return False
+
+def socks5_check_auth(reply):
+    if reply[1] != 0:
+        raise ConnectionError("SOCKS5 upstream authentication failed")
+
+def socks5_command(address, cmd=1):
+    return bytes((5, cmd, 0)) + socks_address(address[0]) + address[1].to_bytes(2, 'big')
+
+SOCKS5_ADDRESS_LENGTHS = {1: 4, 4: 16}  # 域名地址（3）的长度在地址前的一个字节里
+
+def socks5_check_reply(head, address=None):
+    # 检查回复的前 4 个字节，返回地址类型
+    version, rep, _, address_type = head
+    if rep != 0:
+        target = f" {address[0]}:{address[1]}" if address else ''
+        raise ConnectionError(f"SOCKS5 upstream refused{target} (reply {rep})")
+    return address_type
+
+def socks5_reply_address(address_type, data):
+    # data 为地址（域名不含长度字节）加 2 字节端口
+    if address_type == 1:
+        host = socket.inet_ntoa(data[:4])
+    elif address_type == 4:
+        host = socket.inet_ntop(socket.AF_INET6, data[:16])
+    else:
+        host = data[:-2].decode(errors='replace')
+    return host, int.from_bytes(data[-2:], 'big')
+
+def socks4_command(address, username=None):
+    # SOCKS4a：目标为域名时交给上游解析
+    host, port = address
+    try:
+        ip, domain = socket.inet_aton(host), b''
+    except OSError:
+        ip, domain = b"\x00\x00\x00\x01", host.encode('idna') + b"\x00"
+    return b"\x04\x01" + port.to_bytes(2, 'big') + ip + (username or '').encode() + b"\x00" + domain
+
+def socks4_check_reply(reply, address):
+    if reply[1] != 0x5a:
+        raise ConnectionError(f"SOCKS4 upstream refused {address[0]}:{address[1]}")
+
+def http_connect_head(address, username=None, password=None):
+    host, port = address
+    target = f"[{host}]:{port}" if ':' in host else f"{host}:{port}"
+    request = f"CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n"
+    if username:
+        token = base64.b64encode(f"{username}:{password or ''}".encode()).decode()
+        request += f"Proxy-Authorization: Basic {token}\r\n"
+    return (request + "\r\n").encode(), target
+
+def http_connect_check(head, target):
+    status_line = head.split(b"\r\n", 1)[0].decode(errors='replace')
+    if status_line.split(' ', 2)[1:2] != ['200']:
+        raise ConnectionError(f"HTTP upstream refused {target}: {status_line}")
+
+def socks5_greet(sock, username=None, password=None):
+    sock.sendall(socks5_greeting(username))
+    version, method = recv_exact(sock, 2)
+    if socks5_check_method(method, username):
+        sock.sendall(socks5_auth_request(username, password))
+        socks5_check_auth(recv_exact(sock, 2))
+
+def socks5_request(sock, address, cmd=1):
+    sock.sendall(socks5_command(address, cmd))
+    return socks5_read_reply(sock, address)
+
+def socks5_read_reply(sock, address=None):
+    # 读取上游的回复，返回其中的 (host, port)；BIND 的第二个回复也由这里读取
+    address_type = socks5_check_reply(recv_exact(sock, 4), address)
+    length = SOCKS5_ADDRESS_LENGTHS.get(address_type) or recv_exact(sock, 1)[0]
+    return socks5_reply_address(address_type, recv_exact(sock, length + 2))
+
+def socks4_request(sock, address, username=None):
+    sock.sendall(socks4_command(address, username))
+    socks4_check_reply(recv_exact(sock, 8), address)
+
+def http_connect_request(sock, address, username=None, password=None):
+    # 经过 HTTP 上游的 CONNECT；只取走响应头，之后的数据属于隧道（目标可能先发数据，如 SMTP 的问候）
+    request, target = http_connect_head(address, username, password)
+    sock.sendall(request)
+    head = b''
+    while True:
+        data = sock.recv(4096, socket.MSG_PEEK)
+        if not data:
+            raise ConnectionError("Connection closed by upstream")
+        end = (head + data).find(b"\r\n\r\n")
+        if end >= 0:
+            head += recv_exact(sock, end + 4 - len(head))
+            break
+        head += recv_exact(sock, len(data))
+        if len(head) > 65536:
+            raise ConnectionError("Oversized CONNECT response from HTTP upstream")
+    http_connect_check(head, target)
+
+def tunnel_through(sock, hop, address):
+    # 在已经连到 hop 的套接字上请求连接 address
+    if hop.proxy_type == socks.SOCKS5:
+        socks5_greet(sock, hop.username, hop.password)
+        socks5_request(sock, address)
+    elif hop.proxy_type == socks.SOCKS4:
+        socks4_request(sock, address, hop.username)
+    elif hop.proxy_type == socks.HTTP:
+        http_connect_request(sock, address, hop.username, hop.password)
+    else:
+        raise ValueError(f"Unsupported upstream proxy: {hop.label}")
+
+async def read_exact(reader, n):
+    try:
+        return await reader.readexactly(n)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed by upstream") from None
+
+async def socks5_read_reply_async(reader, address=None):
+    address_type = socks5_check_reply(await read_exact(reader, 4), address)
+    length = SOCKS5_ADDRESS_LENGTHS.get(address_type) or (await read_exact(reader, 1))[0]
+    return socks5_reply_address(address_type, await read_exact(reader, length + 2))
+
+async def socks5_handshake_async(reader, writer, hop, address, cmd=1):
+    # 认证并发送命令，返回上游回复的地址
+    writer.write(socks5_greeting(hop.username))
+    version, method = await read_exact(reader, 2)
+    if socks5_check_method(method, hop.username):
+        writer.write(socks5_auth_request(hop.username, hop.password))
+        socks5_check_auth(await read_exact(reader, 2))
+    writer.write(socks5_command(address, cmd))
+    return await socks5_read_reply_async(reader, address)
+
+async def tunnel_through_async(reader, writer, hop, address):
+    # tunnel_through 的 asyncio 版本；HTTP 上游在响应头之后发来的数据留在 reader 的缓冲区里，属于隧道
+    if hop.proxy_type == socks.SOCKS5:
+        await socks5_handshake_async(reader, writer, hop, address)
+    elif hop.proxy_type == socks.SOCKS4:
+        writer.write(socks4_command(address, hop.username))
+        socks4_check_reply(await read_exact(reader, 8), address)
+    elif hop.proxy_type == socks.HTTP:
+        request, target = http_connect_head(address, hop.username, hop.password)
+        writer.write(request)
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed by upstream") from None
+        except asyncio.LimitOverrunError:
+            raise ConnectionError("Oversized CONNECT response from HTTP upstream") from None
+        http_connect_check(head, target)
+    else:
+        raise ValueError(f"Unsupported upstream proxy: {hop.label}")
+
+class WarmPool(threading.Thread):
+    # 为热点 SOCKS 上游预先建立好 TCP 连接（SOCKS5 还完成了认证），连接到来时只需发送最后的 CONNECT 请求
+    interval = 0.5
+
+    def __init__(self, min_size=2, max_size=32, idle_timeout=10, hot_upstreams=16):
+        super().__init__(name="warm-pool", daemon=True)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.hot_upstreams = hot_upstreams
+        self.sessions: Dict[str, collections.deque] = {}
+        self.demand: Dict[str, int] = {}
+        self.rates: Dict[str, float] = {}
+        self.opening: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="warm")
+        self.stop_event = threading.Event()
+
+    def connect(self, address, upstream_name, timeout=None):
+        # 用预热好的会话完成 CONNECT；没有可用会话或会话已失效时返回 None，由调用方正常建立连接
+        upstream = upstream_for(upstream_name)
+        if upstream.proxy_type not in (socks.SOCKS4, socks.SOCKS5):
+            return None
+        sock = self.take(upstream_name)
+        if sock is None:
+            return None
+        try:
+            sock.settimeout(timeout)
+            if upstream.proxy_type == socks.SOCKS5:
+                socks5_request(sock, address)
+            else:
+                socks4_request(sock, address, upstream.username)
+            sock.settimeout(None)
+            return sock
+        except Exception:
+            sock.close()
+            return None
+
+    async def connect_async(self, address, upstream_name, limit):
+        # connect 的 asyncio 版本：取出预热的会话后在事件循环里发送 CONNECT 请求
+        upstream = upstream_for(upstream_name)
+        if upstream.proxy_type not in (socks.SOCKS4, socks.SOCKS5):
+            return None
+        sock = self.take(upstream_name)
+        if sock is None:
+            return None
+        sock.setblocking(False)
+        reader, writer = await asyncio.open_connection(sock=sock, limit=limit)
+        try:
+            if upstream.proxy_type == socks.SOCKS5:
+                writer.write(socks5_command(address))
+                await asyncio.wait_for(socks5_read_reply_async(reader, address), CONNECT_TIMEOUT)
+            else:
+                writer.write(socks4_command(address, upstream.username))
+                socks4_check_reply(await asyncio.wait_for(read_exact(reader, 8), CONNECT_TIMEOUT), address)
+            return reader, writer
+        except asyncio.CancelledError:
+            writer.close()
+            raise
+        except Exception:
+            writer.close()
+            return None
+
+    def take(self, name):
+        with self.lock:
+            self.demand[name] = self.demand.get(name, 0) + 1
+            sessions = self.sessions.get(name)
+            while sessions:
+                sock, created = sessions.pop()
+                if self.alive(sock):
+                    return sock
+                sock.close()
+        return None
+
+    @staticmethod
+    def alive(sock):
+        try:
+            sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return True  # 没有数据也没有关闭，会话仍然可用
+        except OSError:
+            pass
+        return False
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.tick()
+            except Exception as e:
+                log(f"Warm pool error: {e}", "ERROR")
+
+    def tick(self):
+        now = time.monotonic()
+        with self.lock:
+            # 每个上游的连接速率（指数滑动平均），决定哪些上游是热点以及需要预热多少
+            for name in set(self.demand) | set(self.rates):
+                rate = self.demand.pop(name, 0) / self.interval
+                ewma = self.rates.get(name, rate)
+                ewma += 0.3 * (rate - ewma)
+                if ewma < 0.01:
+                    self.rates.pop(name, None)
+                else:
+                    self.rates[name] = ewma
+            hot = set(heapq.nlargest(self.hot_upstreams, self.rates, key=self.rates.get))
+            for name, sessions in list(self.sessions.items()):
+                keep = collections.deque()
+                for sock, created in sessions:
+                    if name in hot and now - created < self.idle_timeout:
+                        keep.append((sock, created))
+                    else:
+                        sock.close()
+                if keep:
+                    self.sessions[name] = keep
+                else:
+                    del self.sessions[name]
+            for name in hot:
+                if not proxy_pool.available(name, now):
+                    continue
+                missing = self.target(name) - len(self.sessions.get(name, ())) - self.opening.get(name, 0)
+                for _ in range(missing):
+                    self.opening[name] = self.opening.get(name, 0) + 1
+                    self.executor.submit(self.open, name)
+
+    def target(self, name):
+        # Little 定律：补充一个会话约需一次握手的时间，库存按 速率 x 补充时间 估算并留一倍余量
+        stats = proxy_pool.stats.get(name)
+        latency = stats.latency if stats and stats.latency else ProxyStats.unknown_latency
+        needed = math.ceil(self.rates[name] * (latency + self.interval) * 2)
+        return max(self.min_size, min(self.max_size, needed))
+
+    def open(self, name):
+        sock = None
+        try:
+            upstream = upstream_for(name)
+            if upstream.proxy_type not in (socks.SOCKS4, socks.SOCKS5):
+                return
+            sock = socket.create_connection((upstream.host, upstream.port), timeout=CONNECT_TIMEOUT)
+            if upstream.proxy_type == socks.SOCKS5:
+                socks5_greet(sock, upstream.username, upstream.password)
+            sock.settimeout(None)
+            with self.lock:
+                self.sessions.setdefault(name, collections.deque()).append((sock, time.monotonic()))
+            sock = None
+        except Exception:
+            pass
+        finally:
+            if sock is not None:
+                sock.close()
+            with self.lock:
+                self.opening[name] -= 1
+
+    def stop(self):
+        self.stop_event.set()
+        with self.lock:
+            for sessions in self.sessions.values():
+                for sock, _ in sessions:
+                    sock.close()
+            self.sessions.clear()
+
+class DnsResolver:
+    # 直连模式的域名解析：带 TTL 的缓存（LRU 限制条目数），同一域名的并发查询合并为一次 getaddrinfo
+    def __init__(self, max_size=1024, ttl=60, negative_ttl=5, workers=16):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = collections.OrderedDict()  # host -> (expires, [(family, ip), ...] 或异常)
+        self.expiry = []  # (expires, host) 小根堆，用于优先淘汰已过期的条目
+        self.inflight = {}  # host -> Future
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dns")
+        self.hits = self.misses = self.coalesced = self.errors = self.evictions = 0
+
+    def resolve(self, host):
+        # 返回 [(family, ip), ...]，解析失败时抛出 socket.gaierror
+        addresses, future = self.lookup(host)
+        return addresses if future is None else future.result()
+
+    async def resolve_async(self, host):
+        addresses, future = self.lookup(host)
+        return addresses if future is None else await asyncio.wrap_future(future)
+
+    def lookup(self, host):
+        host = host.strip('[]').lower()
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                socket.inet_pton(family, host)
+                return [(family, host)], None  # IP 字面量无需解析
+            except OSError:
+                pass
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(host) if self.max_size > 0 else None
+            if entry and entry[0] > now:
+                self.cache.move_to_end(host)
+                self.hits += 1
+                if isinstance(entry[1], Exception):
+                    raise socket.gaierror(*entry[1].args)
+                return entry[1], None
+            future = self.inflight.get(host)
+            if future:
+                self.coalesced += 1
+                return None, future
+            self.misses += 1
+            future = self.inflight[host] = self.executor.submit(self.query, host)
+        return None, future
+
+    def query(self, host):
+        try:
+            infos = socket.getaddrinfo(host, None, socket.AF_UNSPEC, socket.SOCK_STREAM)
+            addresses = list(dict.fromkeys((info[0], info[4][0]) for info in infos))
+            self.store(host, addresses, self.ttl)
+            return addresses
+        except socket.gaierror as e:
+            with self.lock:
+                self.errors += 1
+            self.store(host, e, self.negative_ttl)  # 失败结果也短暂缓存，避免反复查询不存在的域名
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(host, None)
+
+    def store(self, host, result, ttl):
+        if self.max_size <= 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            self.cache[host] = (now + ttl, result)
+            self.cache.move_to_end(host)
+            heapq.heappush(self.expiry, (now + ttl, host))
+            while self.expiry and self.expiry[0][0] <= now:
+                expires, name = heapq.heappop(self.expiry)
+                entry = self.cache.get(name)
+                if entry and entry[0] == expires:
+                    del self.cache[name]
+                    self.evictions += 1
+            while len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)  # 过期条目清完仍超限时按 LRU 淘汰
+                self.evictions += 1
+            if len(self.expiry) > 2 * self.max_size:
+                self.expiry = [(entry[0], name) for name, entry in self.cache.items()]
+                heapq.heapify(self.expiry)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.cache), 'hits': self.hits, 'misses': self.misses,
+                    'coalesced': self.coalesced, 'errors': self.errors, 'evictions': self.evictions}
+
+dns_resolver = DnsResolver()
+
+def connect_direct(address, timeout=None, source_address=None, socket_options=None):
+    # 与 socket.create_connection 相同，但域名经过 dns_resolver 解析；依次尝试每个地址
+    host, port = address
+    error = None
+    for family, ip in dns_resolver.resolve(host):
+        sock = None
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            for option in socket_options or ():
+                sock.setsockopt(*option)
+            if isinstance(timeout, (int, float)):  # urllib3 用哨兵对象表示默认超时
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect((ip, port))
+            return sock
+        except OSError as e:
+            error = e
+            if sock is not None:
+                sock.close()
+    raise error or OSError(f"No addresses found for {host}")
+
+class RouteBlockedError(ConnectionError):
+    pass
+
+class RouteRules:
+    # --routes 规则文件编译成的路由表，按文件中的顺序第一条匹配的规则生效，没有匹配时按原来的方式选择上游。
+    #   pool us socks5://1.2.3.4:1080 socks5://5.6.7.8:1080   定义命名代理池
+    #   domain:corp.example.com,cdn.example.net  direct       域名及其所有子域名
+    #   cidr:10.0.0.0/8,fd00::/8  direct                      只匹配以 IP 给出的目标，不为匹配规则解析域名
+    #   domain:example.org port:80,443,8000-9000  via socks5://a:1080>http://b:8080
+    #   port:25  block
+    #   *  pool:us
+    # 动作：direct、block、pool（默认的代理池或上游）、pool:NAME、via 上游（可以是 '>' 连接的多跳链）。
+    # 域名按标签倒序存入后缀 trie，CIDR 按前缀长度分表做最长前缀查找，一次匹配只需 O(标签数 + 前缀长度种类数)
+    def __init__(self):
+        self.rules = []  # 规则编号 -> (端口范围或 None, 动作)
+        self.domains = {}  # 标签 -> 子节点；键 None 下是在此结束的规则编号
+        self.networks = {socket.AF_INET: {}, socket.AF_INET6: {}}  # 前缀长度 -> {网络号: [规则编号]}
+        self.prefixes = {socket.AF_INET: [], socket.AF_INET6: []}  # 由长到短
+        self.anywhere = []  # 不限定主机的规则
+        self.pools = {}
+
+    def __len__(self):
+        return len(self.rules)
+
+    def add_line(self, line):
+        tokens = line.split()
+        if tokens[0] == 'pool':
+            if len(tokens) < 3:
+                raise ValueError("Expected 'pool NAME PROXY...'")
+            pool = ProxyPool(None, proxy_pool.strategy.name)
+            pool.replace(tokens[2:])
+            # 熔断和延迟统计与主代理池共用，连接结果都记在 proxy_pool 上
+            pool.stats, pool.stats_lock = proxy_pool.stats, proxy_pool.stats_lock
+            self.pools[tokens[1]] = pool
+            return
+        domains, networks, ports = [], [], None
+        for position, token in enumerate(tokens):
+            kind, _, value = token.partition(':')
+            if token == '*':
+                continue
+            elif kind == 'domain' and value:
+                domains += [domain.strip('.').lower() for domain in value.split(',')]
+            elif kind == 'cidr' and value:
+                networks += [ipaddress.ip_network(network, strict=False) for network in value.split(',')]
+            elif kind == 'port' and value:
+                ports = tuple(self.port_range(spec) for spec in value.split(','))
+            else:
+                break
+        else:
+            raise ValueError("Missing action")
+        if position == 0:
+            raise ValueError(f"Expected a match before '{token}'")
+        index = len(self.rules)
+        self.rules.append((ports, self.action(tokens[position:])))
+        for domain in domains:
+            node = self.domains
+            for label in reversed(domain.split('.')):
+                node = node.setdefault(label, {})
+            node.setdefault(None, []).append(index)
+        for network in networks:
+            family = socket.AF_INET if network.version == 4 else socket.AF_INET6
+            table = self.networks[family].setdefault(network.prefixlen, {})
+            table.setdefault(int(network.network_address) >> (network.max_prefixlen - network.prefixlen), []).append(index)
+            self.prefixes[family] = sorted(self.networks[family], reverse=True)
+        if not domains and not networks:
+            self.anywhere.append(index)
+
+    @staticmethod
+    def port_range(spec):
+        low, _, high = spec.partition('-')
+        return int(low), int(high or low)
+
+    def action(self, tokens):
+        name, _, pool = tokens[0].partition(':')
+        if name in ('direct', 'block') and len(tokens) == 1:
+            return name, None
+        if name == 'pool' and len(tokens) == 1:
+            if pool and pool not in self.pools:
+                raise ValueError(f"Unknown pool '{pool}'")
+            return 'pool', self.pools.get(pool)
+        if name == 'via' and len(tokens) == 2:
+            upstream = parse_proxy_string(tokens[1])
+            if upstream is None:
+                raise ValueError(f"Unsupported upstream '{tokens[1]}'")
+            return 'via', upstream.proxy
+        raise ValueError(f"Unknown action '{' '.join(tokens)}'")
+
+    def match(self, host, port=None):
+        # 返回第一条匹配规则的动作 (kind, target)，没有匹配时返回 None
+        candidates = list(self.anywhere)
+        host = host.strip('[]')
+        for family, bits in ((socket.AF_INET, 32), (socket.AF_INET6, 128)):
+            try:
+                value = int.from_bytes(socket.inet_pton(family, host), 'big')
+            except OSError:
+                continue
+            networks = self.networks[family]
+            for length in self.prefixes[family]:
+                candidates += networks[length].get(value >> (bits - length), ())
+            break
+        else:
+            node = self.domains
+            for label in reversed(host.rstrip('.').lower().split('.')):
+                node = node.get(label)
+                if node is None:
+                    break
+                candidates += node.get(None, ())
+        best = None
+        for index in candidates:
+            if best is not None and index >= best:
+                continue
+            ports = self.rules[index][0]
+            if ports is None or (port is not None and any(low <= port <= high for low, high in ports)):
+                best = index
+        return self.rules[best][1] if best is not None else None
+
+def load_routes(path):
+    rules = RouteRules()
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if line:
+                try:
+                    rules.add_line(line)
+                except ValueError as e:
+                    raise ValueError(f"{path}:{number}: {e}") from None
+    return rules
+
+route_rules = None  # RouteRules 实例，--routes 给出时加载
+DEFAULT_ROUTE = ('pool', None)
+
+def pick_upstream(host, upstream_proxy=None, upstream_name=None, exclude=(), port=None):
+    # 返回 (upstream_proxy, upstream_name)；路由规则优先，其次是轮换模式下从代理池中选择，池为空时回退到固定上游
+    action, target = (route_rules.match(host, port) if route_rules else None) or DEFAULT_ROUTE
+    if action == 'direct':
+        return None, None
+    if action == 'block':
+        raise RouteBlockedError(f"{host} is blocked by the routing rules")
+    if action == 'via':
+        return target, target
+    if target is not None:  # 命名代理池
+        proxy = target.select_for(host, exclude) if ROTATE_MODE == 'host' else target.select(exclude)
+        if not proxy:
+            raise ConnectionError(f"No available upstream in the routing pool for {host}")
+        return proxy, proxy
+    if ROTATE_MODE != 'off':
+        proxy = proxy_pool.select_for(host, exclude) if ROTATE_MODE == 'host' else proxy_pool.select(exclude)
+        if proxy:
+            return proxy, proxy
+    return upstream_proxy, upstream_name if upstream_proxy else None
+
+def failover_pool(host, port=None):
+    # 故障转移和竞速时可以换用的代理池；规则指定了直连或固定上游时没有
+    action, target = (route_rules.match(host, port) if route_rules else None) or DEFAULT_ROUTE
+    if action != 'pool':
+        return None
+    return target or proxy_pool
+
+def next_upstream(host, tried, port=None):
+    # 故障转移时选择下一个上游：不限于轮换模式，只要代理池里还有没试过的可用代理
+    pool = failover_pool(host, port)
+    if pool is None:
+        return None, None
+    proxy = pool.select_for(host, tried) if ROTATE_MODE == 'host' else pool.select(tried)
+    return proxy, proxy
+
+def connect_upstream(address, upstream_proxy=None, upstream_name=None, timeout=None):
+    # 建立到目标的连接；经过上游时把真实的连接耗时和失败记入代理池统计
+    if not upstream_proxy:
+        start = time.monotonic()
+        remote = connect_direct(address, timeout=timeout)
+        metrics.observe(('sockstools_upstream_connect_seconds', (('upstream', 'direct'),)), time.monotonic() - start)
+        return remote
+    if upstream_name and not proxy_pool.begin_attempt(upstream_name):
+        raise CircuitOpenError(f"Circuit open for upstream {upstream_name}")
+    start = time.monotonic()
+    try:
+        remote = warm_pool.connect(address, upstream_name, timeout) if warm_pool and upstream_name else None
+        if remote is None:
+            remote = upstream_for(upstream_proxy).connect(address, timeout)
+    except Exception:
+        metrics.add(('sockstools_upstream_failures_total', (('upstream', upstream_label(upstream_name)),)))
+        if upstream_name:
+            proxy_pool.record_failure(upstream_name)
+        raise
+    remote.settimeout(None)
+    elapsed = time.monotonic() - start
+    metrics.observe(('sockstools_upstream_connect_seconds', (('upstream', upstream_label(upstream_name)),)), elapsed)
+    if upstream_name:
+        proxy_pool.record_connect(upstream_name, elapsed)
+        proxy_pool.acquire(upstream_name)
+    return remote
+
+def race_connect(address, candidates, timeout):
+    # 按 RACE_STAGGER 错开启动各个上游的连接，取最先完成握手的一个；某个尝试失败时立即启动下一个
+    results = queue.SimpleQueue()
+
+    def attempt(upstream_proxy, upstream_name):
+        try:
+            results.put((connect_upstream(address, upstream_proxy, upstream_name, timeout), upstream_name, None))
+        except Exception as e:
+            results.put((None, upstream_name, e))
+
+    candidates = iter(candidates)
+    deadline = time.monotonic() + timeout
+    next_start = 0.0
+    pending = 0
+    error = None
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if now >= next_start:
+                candidate = next(candidates, None)
+                if candidate:
+                    threading.Thread(target=attempt, args=candidate, daemon=True).start()
+                    pending += 1
+                    next_start = now + RACE_STAGGER
+                else:
+                    next_start = deadline
+            if not pending:
+                break
+            try:
+                remote, upstream_name, e = results.get(timeout=max(0.0, min(next_start, deadline) - time.monotonic()))
+            except queue.Empty:
+                continue
+            pending -= 1
+            if remote is not None:
+                return remote, upstream_name
+            error = e
+            next_start = 0.0
+    finally:
+        if pending:
+            threading.Thread(target=discard_race_losers, args=(results, pending), daemon=True).start()
+    raise error or socket.timeout(f"Timed out connecting to {address[0]}:{address[1]}")
+
+def discard_race_losers(results, pending):
+    # 竞速输掉但随后连上的连接直接关闭
+    for _ in range(pending):
+        remote, upstream_name, _ = results.get()
+        if remote is not None:
+            remote.close()
+            release_upstream(upstream_name)
+
+def race_candidates(address, upstream_proxy, upstream_name, tried):
+    # 本轮尝试的上游：选中的上游，开启竞速时再加上代理池里最健康的几个
+    candidates = [(upstream_proxy, upstream_name)]
+    pool = failover_pool(*address) if RACE_COUNT > 1 and upstream_name else None
+    if pool is not None:
+        candidates += [(proxy, proxy) for proxy in pool.best(RACE_COUNT - 1, tried | {upstream_name})]
+    return candidates
+
+def connect_with_failover(address, upstream_proxy=None, upstream_name=None, timeout=None):
+    # 上游连接失败时在预算（次数和总时限）内换下一个上游重试；返回 (remote, upstream_name)
+    if not upstream_proxy:
+        return connect_upstream(address, timeout=timeout), None
+    deadline = time.monotonic() + FAILOVER_DEADLINE
+    timeout = CONNECT_TIMEOUT if timeout is None else min(timeout, CONNECT_TIMEOUT)
+    tried = set()
+    error = None
+    for attempt in range(FAILOVER_ATTEMPTS):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        candidates = race_candidates(address, upstream_proxy, upstream_name, tried)
+        try:
+            if len(candidates) > 1:
+                return race_connect(address, candidates, min(timeout, remaining))
+            return connect_upstream(address, upstream_proxy, upstream_name, min(timeout, remaining)), upstream_name
+        except Exception as e:
+            error = e
+            if not isinstance(e, CircuitOpenError):
+                log(f"Upstream {upstream_name or upstream_proxy} failed for {address[0]}:{address[1]}: {e}", "WARNING")
+        tried.update(name for _, name in candidates)
+        upstream_proxy, upstream_name = next_upstream(address[0], tried, address[1])
+        if not upstream_proxy:
+            break
+    raise error
+
+def release_upstream(upstream_name):
+    if upstream_name:
+        proxy_pool.release(upstream_name)
+
+# 以下是上面几个函数的 asyncio 版本，供 asyncio 引擎在事件循环里完成上游握手，不占用线程池；
+# 统计、熔断、竞速和故障转移的规则与线程版本相同，返回 asyncio 流而不是套接字
+async def open_direct(address, limit, timeout=None):
+    host, port = address
+    error = None
+    for family, ip in await dns_resolver.resolve_async(host):
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(ip, port, family=family, limit=limit), timeout or CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            error = e
+    raise error or OSError(f"No addresses found for {host}")
+
+async def open_tunnel(upstream, address, limit):
+    # 直连第一跳，再依次与每一跳握手，最后一跳连接 address
+    hops = upstream.hops if isinstance(upstream, ProxyChain) else (upstream,)
+    first = hops[0]
+    reader, writer = await open_direct((first.host, first.port), limit)
+    try:
+        targets = [(hop.host, hop.port) for hop in hops[1:]] + [address]
+        for hop, target in zip(hops, targets):
+            await tunnel_through_async(reader, writer, hop, target)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+async def open_upstream(address, upstream_proxy, upstream_name, timeout, limit):
+    if upstream_name and not proxy_pool.begin_attempt(upstream_name):
+        raise CircuitOpenError(f"Circuit open for upstream {upstream_name}")
+    upstream = upstream_for(upstream_proxy)
+    start = time.monotonic()
+    try:
+        streams = await warm_pool.connect_async(address, upstream_name, limit) if warm_pool and upstream_name else None
+        if streams is None:
+            try:
+                streams = await asyncio.wait_for(open_tunnel(upstream, address, limit), timeout)
+            except asyncio.TimeoutError:
+                raise socket.timeout(f"Timed out connecting to {address[0]}:{address[1]} through {upstream.label}") from None
+    except Exception:
+        metrics.add(('sockstools_upstream_failures_total', (('upstream', upstream_label(upstream_name)),)))
+        if upstream_name:
+            proxy_pool.record_failure(upstream_name)
+        raise
+    elapsed = time.monotonic() - start
+    metrics.observe(('sockstools_upstream_connect_seconds', (('upstream', upstream_label(upstream_name)),)), elapsed)
+    if upstream_name:
+        proxy_pool.record_connect(upstream_name, elapsed)
+        proxy_pool.acquire(upstream_name)
+    return streams
+
+async def race_open(address, candidates, timeout, limit):
+    # 与 race_connect 相同：按 RACE_STAGGER 错开启动，取最先完成握手的一个，某个尝试失败时立即启动下一个
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    candidates = iter(candidates)
+    attempts = {}
+    error = None
+    try:
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            candidate = next(candidates, None)
+            if candidate:
+                task = loop.create_task(open_upstream(address, *candidate, remaining, limit))
+                attempts[task] = candidate[1]
+            if not attempts:
+                break
+            done, _ = await asyncio.wait(attempts, timeout=min(RACE_STAGGER, remaining) if candidate else remaining,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                upstream_name = attempts.pop(task)
+                if task.exception() is None:
+                    reader, writer = task.result()
+                    return reader, writer, upstream_name
+                error = task.exception()
+    finally:
+        for task, upstream_name in attempts.items():
+            task.add_done_callback(functools.partial(discard_race_loser, upstream_name=upstream_name))
+            task.cancel()
+    raise error or socket.timeout(f"Timed out connecting to {address[0]}:{address[1]}")
+
+def discard_race_loser(task, upstream_name=None):
+    # 取消时可能已经连上，关闭连接并归还上游的计数
+    if not task.cancelled() and task.exception() is None:
+        task.result()[1].close()
+        release_upstream(upstream_name)
+
+async def open_with_failover(address, upstream_proxy, upstream_name, limit):
+    # 返回 (reader, writer, upstream_name)
+    deadline = time.monotonic() + FAILOVER_DEADLINE
+    tried = set()
+    error = None
+    for attempt in range(FAILOVER_ATTEMPTS):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        candidates = race_candidates(address, upstream_proxy, upstream_name, tried)
+        try:
+            if len(candidates) > 1:
+                return await race_open(address, candidates, min(CONNECT_TIMEOUT, remaining), limit)
+            reader, writer = await open_upstream(address, upstream_proxy, upstream_name, min(CONNECT_TIMEOUT, remaining), limit)
+            return reader, writer, upstream_name
+        except Exception as e:
+            error = e
+            if not isinstance(e, CircuitOpenError):
+                log(f"Upstream {upstream_name or upstream_proxy} failed for {address[0]}:{address[1]}: {e}", "WARNING")
+        tried.update(name for _, name in candidates)
+        upstream_proxy, upstream_name = next_upstream(address[0], tried, address[1])
+        if not upstream_proxy:
+            break
+    raise error
+
 class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
-    def __init__(self, *args, **kwargs):
+    daemon_threads = True  # 空闲的 keep-alive 连接不应阻止进程退出
+
+    def __init__(self, *args, backlog=128, **kwargs):
         self.upstream_proxy = None
+        self.request_queue_size = backlog
         super().__init__(*args, **kwargs)
 
-class ProxyHandler(BaseHTTPRequestHandler):
-    upstream_proxy = None
+    def server_bind(self):
+        if REUSE_PORT:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # Prometheus 文本格式的指标端点；/limits 查看限速设置，本机 POST /limits?client_rate=1m 可在运行时修改
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/limits':
+            self.send_body(json.dumps(rate_limits.settings()).encode(), 'application/json')
+            return
+        if path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        self.send_body(metrics.render().encode(), 'text/plain; version=0.0.4; charset=utf-8')
+
+    def do_POST(self):
+        parts = urlsplit(self.path)
+        if parts.path != '/limits':
+            self.send_error(404)
+            return
+        if self.client_address[0] not in ('127.0.0.1', '::1'):
+            self.send_error(403)
+            return
+        try:
+            query = parse_qs(parts.query)
+            if set(query) - set(LIMIT_FIELDS):
+                raise ValueError(f"unknown fields: {', '.join(sorted(set(query) - set(LIMIT_FIELDS)))}")
+            updates = {name: (int if name == 'client_connections' else byte_rate)(values[-1])
+                       for name, values in query.items()}
+        except (ValueError, IndexError) as e:
+            self.send_error(400, str(e))
+            return
+        rate_limits.configure(**updates)
+        log(f"Rate limits changed: {rate_limits.settings()}")
+        self.send_body(json.dumps(rate_limits.settings()).encode(), 'application/json')
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # 抓取请求很频繁，不写入日志
+
+def dns_metrics():
+    stats = dns_resolver.stats()
+    return [(('sockstools_dns_cache_hits_total', ()), stats['hits']),
+            (('sockstools_dns_cache_misses_total', ()), stats['misses']),
+            (('sockstools_dns_cache_coalesced_total', ()), stats['coalesced']),
+            (('sockstools_dns_cache_errors_total', ()), stats['errors']),
+            (('sockstools_dns_cache_entries', ()), stats['size'])]
+
+metrics.collectors.append(dns_metrics)
+
+def start_metrics_server(host, port):
+    metrics.enabled = True
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+CACHEABLE_STATUS = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}  # 没有明确新鲜度时可以启发式缓存的状态码
+CACHE_STORED_EXCLUDE = HOP_BY_HOP_HEADERS | {'age', 'content-length'}
+FORWARD_EXCLUDE = {'expect'}  # 100-continue 已由 BaseHTTPRequestHandler 答复
+CACHE_LABELS = (('listener', 'http'), ('upstream', 'cache'))
+
+def parse_cache_control(value):
+    # 'max-age=60, no-cache, public' -> {'max-age': '60', 'no-cache': True, 'public': True}
+    directives = {}
+    for part in (value or '').split(','):
+        name, sep, argument = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') if sep else True
+    return directives
+
+def http_date(value):
+    parsed = email.utils.parsedate_tz(value) if value else None
+    return email.utils.mktime_tz(parsed) if parsed else None
+
+def delta_seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+class CacheEntry:
+    # 一个缓存的响应。headers 是要发给客户端的头部（不含逐跳头和 Age），新鲜度和校验器由它计算；
+    # 内存层的 body 是 bytes，磁盘层的 body 为 None，由 path/offset 指向文件中的响应体
+    __slots__ = ('url', 'status', 'headers', 'vary', 'response_time', 'initial_age', 'body', 'size', 'path', 'offset',
+                 'lifetime', 'etag', 'last_modified', 'no_cache')
+
+    def __init__(self, url, status, headers, vary, response_time, initial_age, body=b'', size=None, path=None, offset=0):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.vary = vary  # [(请求头, 存储时请求中的值)]
+        self.response_time = response_time
+        self.initial_age = initial_age
+        self.body = body
+        self.size = len(body) if size is None else size
+        self.path = path
+        self.offset = offset
+        cache_control = parse_cache_control(self.header('Cache-Control'))
+        self.lifetime = self.freshness_lifetime(cache_control)
+        self.etag = self.header('ETag')
+        self.last_modified = self.header('Last-Modified')
+        self.no_cache = 'no-cache' in cache_control
+
+    @classmethod
+    def from_response(cls, url, request_headers, response, body, response_time):
+        stored = end_to_end_headers(response.raw.headers, CACHE_STORED_EXCLUDE)
+        if response.status_code != 204:
+            stored.append(('Content-Length', str(len(body))))
+        vary = [(name, request_headers.get(name)) for name in
+                (name.strip() for name in response.headers.get('Vary', '').split(',')) if name]
+        return cls(url, response.status_code, stored, vary, response_time,
+                   initial_age(response.headers, response_time), bytes(body))
+
+    def header(self, name):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    def freshness_lifetime(self, cache_control):
+        # 共享缓存优先 s-maxage，其次 max-age、Expires，最后按 Last-Modified 启发式估计（距今的 10%，最多一天）
+        for name in ('s-maxage', 'max-age'):
+            if name in cache_control:
+                seconds = delta_seconds(cache_control[name])
+                if seconds is not None:
+                    return seconds
+        date = http_date(self.header('Date')) or self.response_time
+        expires = self.header('Expires')
+        if expires is not None:
+            expires = http_date(expires)
+            return max(0, expires - date) if expires else 0  # 无法解析的 Expires 视为已过期
+        last_modified = http_date(self.header('Last-Modified'))
+        if last_modified and self.status in CACHEABLE_STATUS:
+            return min(86400, max(0, (date - last_modified) // 10))
+        return 0
+
+    def age(self, now):
+        return self.initial_age + max(0, now - self.response_time)
+
+    def fresh(self, now, max_age=None):
+        age = self.age(now)
+        return not self.no_cache and age < self.lifetime and (max_age is None or age <= max_age)
+
+    def matches(self, request_headers):
+        return all(request_headers.get(name) == value for name, value in self.vary)
+
+    def validators(self):
+        # 回源时的条件请求头；没有校验器的条目过期后只能重新获取
+        if self.etag:
+            return {'If-None-Match': self.etag}
+        if self.last_modified:
+            return {'If-Modified-Since': self.last_modified}
+        return {}
+
+    def revalidated(self, response_headers, response_time):
+        # 304：用响应里的头部更新存储的头部，响应体不变
+        updates = {name.lower(): (name, value) for name, value in end_to_end_headers(response_headers, CACHE_STORED_EXCLUDE)}
+        headers = [updates.pop(name.lower(), (name, value)) for name, value in self.headers] + list(updates.values())
+        return CacheEntry(self.url, self.status, headers, self.vary, response_time,
+                          initial_age(response_headers, response_time), self.body, self.size, self.path, self.offset)
+
+    def on_disk(self, path, offset):
+        return CacheEntry(self.url, self.status, self.headers, self.vary, self.response_time, self.initial_age,
+                          None, self.size, path, offset)
+
+    def meta(self):
+        return {'url': self.url, 'status': self.status, 'headers': self.headers, 'vary': self.vary,
+                'response_time': self.response_time, 'initial_age': self.initial_age, 'size': self.size}
+
+    @classmethod
+    def from_meta(cls, meta, path, offset):
+        return cls(meta['url'], meta['status'], [tuple(header) for header in meta['headers']],
+                   [tuple(header) for header in meta['vary']], meta['response_time'], meta['initial_age'],
+                   None, meta['size'], path, offset)
+
+def initial_age(headers, response_time):
+    # 响应到达时已有的年龄：Age 头与按 Date 计算的表观年龄取较大者
+    date = http_date(headers.get('Date'))
+    apparent = max(0, response_time - date) if date else 0
+    return max(apparent, delta_seconds(headers.get('Age')) or 0)
+
+class DiskCache:
+    # HTTP 缓存的磁盘层：每个响应一个文件（4 字节长度 + 元数据 JSON + 响应体），读取时 mmap，按字节预算 LRU 删除。
+    # 启动时扫描目录恢复索引；写入先写临时文件再改名，多个工作进程共用目录时最多读到旧版本
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index = collections.OrderedDict()  # url -> CacheEntry
+        self.bytes = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith('.tmp'):
+                    raise ValueError("Unfinished cache file")
+                with open(path, 'rb') as f:
+                    length = int.from_bytes(f.read(4), 'big')
+                    entry = CacheEntry.from_meta(json.loads(f.read(length)), path, 4 + length)
+                if os.path.getsize(path) != entry.offset + entry.size:
+                    raise ValueError("Truncated cache file")
+                entries.append(entry)
+            except (OSError, ValueError, KeyError, TypeError):
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+        for entry in sorted(entries, key=lambda entry: entry.response_time):
+            self.update(entry)
+        if entries:
+            log(f"Loaded {len(self.index)} cached responses ({self.bytes} bytes) from {self.directory}")
+
+    def path_for(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest())
+
+    def get(self, url):
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is not None:
+                self.index.move_to_end(url)
+            return entry
+
+    def put(self, entry):
+        if not entry.size or entry.size > self.max_bytes:
+            return
+        path = self.path_for(entry.url)
+        meta = json.dumps(entry.meta()).encode()
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(len(meta).to_bytes(4, 'big') + meta)
+                f.write(entry.body)
+            os.replace(temporary, path)
+        except OSError as e:
+            log(f"Cannot write cache file {path}: {e}", "WARNING")
+            with contextlib.suppress(OSError):
+                os.remove(temporary)
+            return
+        self.update(entry.on_disk(path, 4 + len(meta)))
+
+    def update(self, entry):
+        evicted = []
+        with self.lock:
+            old = self.index.pop(entry.url, None)
+            if old is not None:
+                self.bytes -= old.size
+            self.index[entry.url] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes:
+                _, oldest = self.index.popitem(last=False)
+                self.bytes -= oldest.size
+                evicted.append(oldest.path)
+        for path in evicted:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+    def discard(self, url):
+        with self.lock:
+            entry = self.index.pop(url, None)
+            if entry is None:
+                return
+            self.bytes -= entry.size
+        with contextlib.suppress(OSError):
+            os.remove(entry.path)
+
+class HttpCache:
+    # 普通 HTTP 转发的共享缓存（RFC 9111 的子集，只存储 GET 的完整响应）。内存层是按字节预算淘汰的 LRU，
+    # 配置了磁盘层时被淘汰的条目写入磁盘。过期的条目带条件请求回源，304 时只更新头部；
+    # 同一 URL 的并发未命中只有第一个请求回源，其余的等它存储完成后直接命中
+    coalesce_timeout = 30
+
+    def __init__(self, max_bytes, max_object=16 << 20, disk=None):
+        self.max_bytes = max_bytes
+        self.max_object = max_object
+        self.disk = disk
+        self.entries = collections.OrderedDict()  # url -> CacheEntry
+        self.bytes = 0
+        self.pending = {}  # url -> threading.Event，正在回源的未命中
+        self.results = collections.Counter()
+        self.lock = threading.Lock()
+
+    def lookup(self, url, request_headers):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+        if entry is None and self.disk:
+            entry = self.disk.get(url)
+        return entry if entry is not None and entry.matches(request_headers) else None
+
+    def acquire(self, url):
+        # 返回 True 时由调用方回源，结束后调用 release()；返回 False 表示已经等过另一个请求回源
+        with self.lock:
+            event = self.pending.get(url)
+            if event is None:
+                self.pending[url] = threading.Event()
+                return True
+        event.wait(self.coalesce_timeout)
+        return False
+
+    def release(self, url):
+        with self.lock:
+            event = self.pending.pop(url, None)
+        if event:
+            event.set()
+
+    def storable(self, method, request_headers, response):
+        # 在转发响应体之前判断，不能存储的响应不必缓冲。
+        # 304 只是对某个条件请求的答复（例如客户端自己带了 If-None-Match），不是完整的响应
+        if method != 'GET' or response.status_code in (206, 304) or response.status_code < 200:
+            return False
+        request_cache_control = parse_cache_control(request_headers.get('Cache-Control'))
+        cache_control = parse_cache_control(response.headers.get('Cache-Control'))
+        if 'no-store' in request_cache_control or 'no-store' in cache_control or 'private' in cache_control:
+            return False
+        if response.headers.get('Vary', '').strip() == '*' or 'Set-Cookie' in response.headers:
+            return False
+        if 'Authorization' in request_headers and not {'public', 's-maxage', 'must-revalidate'} & cache_control.keys():
+            return False
+        length = delta_seconds(response.headers.get('Content-Length'))
+        if length is not None and length > self.max_object:
+            return False
+        explicit = {'max-age', 's-maxage', 'public'} & cache_control.keys() or 'Expires' in response.headers
+        if not explicit and response.status_code not in CACHEABLE_STATUS:
+            return False
+        return bool(explicit or 'Last-Modified' in response.headers or 'ETag' in response.headers)
+
+    def store(self, entry):
+        spilled = []
+        with self.lock:
+            old = self.entries.pop(entry.url, None)
+            if old is not None:
+                self.bytes -= old.size
+            if entry.path is None and entry.size <= self.max_bytes:
+                self.entries[entry.url] = entry
+                self.bytes += entry.size
+            elif entry.path is None:
+                spilled.append(entry)
+            while self.bytes > self.max_bytes:
+                _, oldest = self.entries.popitem(last=False)
+                self.bytes -= oldest.size
+                spilled.append(oldest)
+        if self.disk:
+            if entry.path is not None:
+                self.disk.update(entry)  # 重新验证过的磁盘条目只更新索引
+            elif entry.url in self.entries:
+                self.disk.discard(entry.url)  # 磁盘上的旧版本已被替换
+            for oldest in spilled:
+                self.disk.put(oldest)
+
+    def invalidate(self, url):
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is not None:
+                self.bytes -= entry.size
+        if self.disk:
+            self.disk.discard(url)
+
+    @contextlib.contextmanager
+    def open_body(self, entry):
+        # 给出响应体的 memoryview；磁盘条目 mmap 整个文件，文件已被删除或截断时给出 None
+        if entry.path is None:
+            yield memoryview(entry.body)
+            return
+        mapped = None
+        try:
+            with open(entry.path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self.disk.discard(entry.url)
+        if mapped is None:
+            yield None
+            return
+        try:
+            with memoryview(mapped)[entry.offset:entry.offset + entry.size] as view:
+                yield view if len(view) == entry.size else None
+        finally:
+            mapped.close()
+
+    def count(self, result):
+        with self.lock:
+            self.results[result] += 1
+
+    def collect(self):
+        with self.lock:
+            samples = [(('sockstools_cache_requests_total', (('result', result),)), count)
+                       for result, count in self.results.items()]
+            samples += [(('sockstools_cache_entries', (('tier', 'memory'),)), len(self.entries)),
+                        (('sockstools_cache_bytes', (('tier', 'memory'),)), self.bytes)]
+        if self.disk:
+            samples += [(('sockstools_cache_entries', (('tier', 'disk'),)), len(self.disk.index)),
+                        (('sockstools_cache_bytes', (('tier', 'disk'),)), self.disk.bytes)]
+        return samples
+
+http_cache = None  # HttpCache 实例，--cache-size 或 --cache-dir 给出时创建
+
+def cache_metrics():
+    return http_cache.collect() if http_cache else []
+
+metrics.collectors.append(cache_metrics)
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = 60  # 空闲的 keep-alive 客户端连接在此时间后关闭
+    upstream_proxy = None
+    upstream_name = None  # 代理池中的原始代理字符串，用于记录统计
+    sessions = UpstreamSessions()
+    cache_url = None  # 当前请求可以存入缓存时为其 URL
+    cache_entry = None  # 正在回源验证的过期条目
+    cache_leader = None  # 本请求代表并发的未命中请求回源时为其 URL，见 release_coalescing()
+    disable_nagle_algorithm = True  # 响应头和响应体分几次写出，避免 Nagle 与延迟确认叠加出约 40ms 的停顿
+    users = {}  # 单端口模式下与 SOCKS5 共用的用户名 -> 密码，非空时要求 Proxy-Authorization
+
+    def log_message(self, format, *args):
+        # 每个请求一行的访问日志走分级、批量写出的日志，而不是同步写 stderr
+        log(f"{self.address_string()} {format % args}", "DEBUG")
+
+    def authorized(self):
+        if not self.users:
+            return True
+        scheme, _, credentials = self.headers.get('Proxy-Authorization', '').partition(' ')
+        if scheme.lower() == 'basic':
+            try:
+                username, _, password = base64.b64decode(credentials.strip(), validate=True).decode().partition(':')
+            except ValueError:
+                username = password = None
+            expected = self.users.get(username)
+            if expected is not None and hmac.compare_digest(expected.encode(), password.encode()):
+                return True
+        # 请求体没有读取，不能继续复用这个连接
+        self.close_connection = True
+        self.send_response(407)
+        self.send_header('Proxy-Authenticate', 'Basic realm="sockstools"')
+        self.send_header('Content-Length', '0')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        log(f"Proxy authentication failed from {self.client_address[0]}", "WARNING")
+        return False
+
+    def do_CONNECT(self):
+        start = time.monotonic()
+        client_ip = self.client_address[0]
+        if not self.authorized():
+            return
+        # 先校验目标再占用连接名额，格式错误的请求不会泄漏名额；[::1]:443 这样的 IPv6 地址去掉方括号
+        host, sep, port = self.path.rpartition(':')
+        if host[:1] == '[' and host[-1:] == ']':
+            host = host[1:-1]
+        if not sep or not host or not (port.isascii() and port.isdigit()) or int(port) > 65535:
+            self.send_error(400, "CONNECT target must be host:port")
+            return
+        address = [host, int(port) or 443]
+        if not rate_limits.admit(client_ip):
+            connection_rejected('http')
+            self.send_error(429, "Too many connections from this client")
+            return
+        try:
+            upstream_proxy, upstream_name = self.pick_upstream(address[0], address[1])
+            s, upstream_name = connect_with_failover(address, upstream_proxy, upstream_name, timeout=self.timeout)
+            s.settimeout(None)
+        except Exception as e:
+            rate_limits.leave(client_ip)
+            connect_failed('http')
+            self.send_error(403 if isinstance(e, RouteBlockedError) else 502)
+            log(f"Error connecting to upstream: {e}", "WARNING")
+            return
+        self.send_response(200, 'Connection Established')
+        self.end_headers()
+        self.close_connection = 1
+        labels = tunnel_labels('http', upstream_name)
+        tunnel_opened(labels, start)
+        buckets = rate_limits.buckets_for(client_ip, upstream_name)
+
+        def on_close():
+            tunnel_closed(labels, upstream_name)
+            rate_limits.release(client_ip, upstream_name)
+            rate_limits.leave(client_ip)
+
+        if RELAY_WORKERS:
+            # 把客户端套接字从 socketserver 中摘下来，交给共享的 relay reactor
+            client = socket.socket(fileno=self.connection.detach())
+            get_relay_reactor().add_tunnel(client, s, on_close, labels, buckets)
+        else:
+            self.connection.settimeout(None)
+            with s:
+                relay(self.connection, s, labels=labels, buckets=buckets)
+            on_close()
+
+    def pick_upstream(self, host, port=None):
+        if ROTATE_MODE == 'connection' and not route_rules:
+            # 同一个客户端连接上的请求沿用同一个上游（有路由规则时每个请求的目标可能走不同的路由）
+            if '_upstream' not in self.__dict__:
+                self._upstream = pick_upstream(host, self.upstream_proxy, self.upstream_name, port=port)
+            return self._upstream
+        return pick_upstream(host, self.upstream_proxy, self.upstream_name, port=port)
+
+    def request_target(self):
+        parts = urlsplit(self.path)
+        return parts.hostname or '', parts.port or DEFAULT_PORTS.get(parts.scheme, 80)
+
+    def do_GET(self):
+        client_ip = self.client_address[0]
+        if not self.authorized():
+            return
+        if not rate_limits.admit(client_ip):
+            connection_rejected('http')
+            self.send_error(429, "Too many connections from this client")
+            return
+        try:
+            if http_cache and self.command in ('GET', 'HEAD') and 'Range' not in self.headers:
+                self.cached_request()
+            else:
+                self.forward()
+                if http_cache and self.command not in ('GET', 'HEAD', 'OPTIONS', 'TRACE'):
+                    http_cache.invalidate(self.path)  # 不安全的方法使同一 URL 的缓存失效
+        finally:
+            rate_limits.leave(client_ip)
+
+    def forward(self):
+        try:
+            upstream_proxy, upstream_name = self.pick_upstream(*self.request_target())
+        except ConnectionError as e:
+            connect_failed('http')
+            self.send_error(403 if isinstance(e, RouteBlockedError) else 502)
+            log(f"Error handling request: {e}", "WARNING")
+            return
+        if upstream_proxy:
+            self.handle_upstream_proxy(upstream_proxy, upstream_name)
+        else:
+            self.handle_direct()
+
+    def cached_request(self):
+        # 新鲜的条目直接返回；过期的带条件请求回源，304 时从缓存返回；同一 URL 并发未命中时只有一个请求回源
+        url = self.path
+        request_cache_control = parse_cache_control(self.headers.get('Cache-Control'))
+        if 'no-store' in request_cache_control:
+            self.forward()
+            return
+        revalidate = 'no-cache' in request_cache_control or 'no-cache' in self.headers.get('Pragma', '')
+        entry = http_cache.lookup(url, self.headers)
+        if entry is None and self.command == 'GET':
+            if http_cache.acquire(url):
+                self.cache_leader = url
+            else:
+                http_cache.count('coalesced')
+                entry = http_cache.lookup(url, self.headers)
+        try:
+            if entry is not None and not revalidate and entry.fresh(time.time(), delta_seconds(request_cache_control.get('max-age'))):
+                with http_cache.open_body(entry) as view:
+                    if view is not None:
+                        http_cache.count('hit')
+                        self.send_cached(entry, view, 'HIT')
+                        return
+                entry = None
+            if entry is None:
+                http_cache.count('miss')
+            self.cache_url = url
+            self.cache_entry = entry if entry is not None and entry.validators() else None
+            self.forward()
+        finally:
+            self.cache_url = self.cache_entry = None
+            self.release_coalescing()
+
+    def release_coalescing(self):
+        # 响应不能缓存时尽早放行等待的请求，让它们各自回源，而不是等整个响应传完
+        if self.cache_leader is not None:
+            http_cache.release(self.cache_leader)
+            self.cache_leader = None
+
+    def not_modified(self, entry):
+        # 客户端自己的条件请求对照缓存条目判断
+        if entry.status != 200:
+            return False
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            return entry.etag is not None and ('*' in tags or entry.etag.removeprefix('W/') in tags)
+        if_modified_since = http_date(self.headers.get('If-Modified-Since'))
+        last_modified = http_date(entry.last_modified)
+        return if_modified_since is not None and last_modified is not None and last_modified <= if_modified_since
+
+    def send_cached(self, entry, view, result):
+        status = 304 if self.not_modified(entry) else entry.status
+        client_ip = self.client_address[0]
+        down = byte_keys(CACHE_LABELS)[1]
+        buckets = rate_limits.buckets_for(client_ip, None)
+        try:
+            self.log_request(status)
+            self.send_response_only(status)  # Server 和 Date 用缓存里源站的
+            for name, value in entry.headers:
+                self.send_header(name, value)
+            self.send_header('Age', str(int(entry.age(time.time()))))
+            self.send_header('X-Cache', result)
+            self.end_headers()
+            if status != 304 and self.command != 'HEAD':
+                for start in range(0, len(view), RELAY_CHUNK):
+                    with view[start:start + RELAY_CHUNK] as chunk:
+                        delay = throttle(buckets, len(chunk))
+                        if delay:
+                            time.sleep(delay)
+                        self.wfile.write(chunk)
+                        metrics.add(down, len(chunk))
+        except OSError as e:
+            self.close_connection = True
+            log(f"Error sending cached response: {e}", "WARNING")
+        finally:
+            rate_limits.release(client_ip, None)
+
+    def handle_upstream_proxy(self, upstream_proxy=None, upstream_name=None):
+        if upstream_proxy is None:
+            upstream_proxy, upstream_name = self.upstream_proxy, self.upstream_name
+        body = self.read_body()
+        deadline = time.monotonic() + FAILOVER_DEADLINE
+        tried = set()
+        for attempt in range(FAILOVER_ATTEMPTS):
+            try:
+                response = self.request_upstream(self.sessions.get(upstream_proxy), body, upstream_name)
+            except Exception as e:
+                if not isinstance(e, CircuitOpenError):
+                    log(f"Error handling upstream proxy request: {e}", "WARNING")
+                tried.add(upstream_name)
+                if not upstream_name or time.monotonic() >= deadline:
+                    break
+                if isinstance(body, RequestBody) and body.sent:
+                    break  # 流式请求体已经发出一部分，无法换上游重发
+                host, port = self.request_target()
+                upstream_proxy, upstream_name = next_upstream(host, tried, port)
+                if not upstream_proxy:
+                    break
+                continue
+            self.relay_response(response, "Error handling upstream proxy request", upstream_name, body)
+            return
+        connect_failed('http')
+        self.finish_body(body)
+        self.send_error(502)
+
+    def handle_direct(self):
+        body = self.read_body()
+        try:
+            response = self.request_upstream(self.sessions.get(None), body)
+        except Exception as e:
+            connect_failed('http')
+            self.finish_body(body)
+            self.send_error(502)
+            log(f"Error handling direct request: {e}", "WARNING")
+            return
+        self.relay_response(response, "Error handling direct request", body=body)
+
+    def read_body(self):
+        # 短的请求体直接读入；长的和 chunked 的返回 RequestBody 边读边转发
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return RequestBody(self.rfile)
+        length = int(self.headers.get('Content-Length') or 0)
+        if length >= STREAM_BODY_MIN:
+            return RequestBody(self.rfile, length)
+        return self.rfile.read(length) if length > 0 else None
+
+    def finish_body(self, body):
+        # 没有读完的请求体会让下一个请求错位，只能关闭连接
+        if isinstance(body, RequestBody) and not body.finished:
+            self.close_connection = True
+
+    def request_upstream(self, session, body, upstream_name=None):
+        headers = dict(end_to_end_headers(self.headers, FORWARD_EXCLUDE))
+        if isinstance(body, RequestBody) and body.chunked:
+            headers.pop('Content-Length', None)  # 同时出现时以 Transfer-Encoding 为准
+        if self.cache_entry is not None:
+            # 用缓存条目的校验器回源；客户端自己的条件请求之后对照缓存条目处理
+            headers = {k: v for k, v in headers.items() if k.lower() not in ('if-none-match', 'if-modified-since')}
+            headers.update(self.cache_entry.validators())
+        if upstream_name and not proxy_pool.begin_attempt(upstream_name):
+            raise CircuitOpenError(f"Circuit open for upstream {upstream_name}")
+        start = time.monotonic()
+        try:
+            response = session.request(self.command, self.path, headers=headers, data=body,
+                                       stream=True, allow_redirects=False, timeout=(CONNECT_TIMEOUT, None))
+        except Exception:
+            metrics.add(('sockstools_upstream_failures_total', (('upstream', upstream_label(upstream_name)),)))
+            if upstream_name:
+                proxy_pool.record_failure(upstream_name)
+            raise
+        elapsed = time.monotonic() - start
+        metrics.observe(('sockstools_upstream_connect_seconds', (('upstream', upstream_label(upstream_name)),)), elapsed)
+        if upstream_name:
+            proxy_pool.record_connect(upstream_name, elapsed)
+            proxy_pool.acquire(upstream_name)
+        return response
+
+    def relay_response(self, response, error_message, upstream_name=None, body=None):
+        labels = tunnel_labels('http', upstream_name)
+        up, down = byte_keys(labels)
+        tunnel_opened(labels)
+        if body:
+            metrics.add(up, body.sent if isinstance(body, RequestBody) else len(body))
+        self.finish_body(body)
+        buckets = rate_limits.buckets_for(self.client_address[0], upstream_name)
+        cached = None
+        try:
+            if self.cache_entry is not None and response.status_code == 304:
+                # 缓存的条目仍然有效：更新头部和新鲜度后从缓存返回
+                entry = self.cache_entry.revalidated(response.raw.headers, time.time())
+                http_cache.store(entry)
+                http_cache.count('revalidated')
+                with http_cache.open_body(entry) as view:
+                    if view is None:
+                        raise OSError(f"Cached body for {self.path} is gone")
+                    self.send_cached(entry, view, 'REVALIDATED')
+                return
+            if self.cache_url and http_cache.storable(self.command, self.headers, response):
+                cached = bytearray()
+            else:
+                self.release_coalescing()
+            upstream_headers = response.raw.headers
+            self.log_request(response.status_code)
+            self.send_response_only(response.status_code)  # Server 和 Date 用上游的，不再重复添加
+            for header, value in end_to_end_headers(upstream_headers, ('content-length',)):
+                self.send_header(header, value)
+            if self.cache_url:
+                self.send_header('X-Cache', 'MISS')
+            has_body = self.command != 'HEAD' and response.status_code not in (204, 304) \
+                and not 100 <= response.status_code < 200
+            length = None if 'Transfer-Encoding' in upstream_headers else upstream_headers.get('Content-Length')
+            chunked = False
+            if length is not None or not has_body:
+                if length is not None:
+                    self.send_header('Content-Length', length)
+            elif self.request_version == 'HTTP/1.1':
+                # 上游没有给出长度（chunked 或以关闭连接结束），对客户端重新分块，连接可以继续复用
+                self.send_header('Transfer-Encoding', 'chunked')
+                chunked = True
+            else:
+                # HTTP/1.0 客户端不认识 chunked，只能以关闭连接来标记响应结束
+                self.send_header('Connection', 'close')
+                self.close_connection = True
+            self.end_headers()
+            if has_body:
+                # 原样转发（不解压），有多少读多少，不等凑满缓冲区；读完后上游连接自动归还到连接池。
+                # 可以缓存的响应同时留一份副本
+                while True:
+                    chunk = response.raw.read1(RELAY_CHUNK, decode_content=False)
+                    if not chunk:
+                        break
+                    delay = throttle(buckets, len(chunk))
+                    if delay:
+                        time.sleep(delay)
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk) if chunked else chunk)
+                    metrics.add(down, len(chunk))
+                    if cached is not None:
+                        cached += chunk
+                        if len(cached) > http_cache.max_object:
+                            cached = None
+                            self.release_coalescing()
+                if chunked:
+                    self.wfile.write(b'0\r\n\r\n')
+            if cached is not None:
+                http_cache.store(CacheEntry.from_response(self.cache_url, self.headers, response, cached, time.time()))
+        except Exception as e:
+            # 响应头已经发出，只能断开客户端连接
+            self.close_connection = True
+            log(f"{error_message}: {e}", "WARNING")
+        finally:
+            response.close()
+            rate_limits.release(self.client_address[0], upstream_name)
+            tunnel_closed(labels, upstream_name)
+
+    do_POST = do_PUT = do_DELETE = do_HEAD = do_GET
+
+class SocksProxy(threading.Thread):
+    def __init__(self, host, port, upstream_proxy=None, backlog=128, upstream_name=None):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.upstream_proxy = upstream_proxy
+        self.upstream_name = upstream_name
+        self.backlog = backlog
+        self.running = False
+        self.server = None
+        self.http_server = None  # 单端口模式下处理 HTTP 连接的 ThreadingHTTPServer（本身不监听）
+        self.stop_event = threading.Event()
+
+    def run(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if REUSE_PORT:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server.bind((self.host, self.port))
+        self.server.listen(self.backlog)
+        self.server.settimeout(1)  # 设置超时，以便能够响应停止请求
+        self.running = True
+        while self.running and not self.stop_event.is_set():
+            try:
+                client, addr = self.server.accept()
+                if self.http_server is None:
+                    t = threading.Thread(target=self.handle_client, args=(client,))
+                else:
+                    t = threading.Thread(target=self.dispatch, args=(client, addr))
+                t.start()
+            except socket.timeout:
+                continue
+            except Exception as e:
+                if self.running:
+                    log(f"Error accepting connection: {e}", "ERROR")
+
+    def stop(self):
+        self.running = False
+        self.stop_event.set()
+        if self.server:
+            self.server.close()
+
+    def dispatch(self, client, addr):
+        # 单端口模式：偷看第一个字节（不取走），再交给 SOCKS5 或 HTTP 的处理逻辑
+        try:
+            client.settimeout(SNIFF_TIMEOUT)
+            first = client.recv(1, socket.MSG_PEEK)
+            client.settimeout(None)
+        except OSError:
+            first = b''
+        protocol = sniff_protocol(first)
+        if protocol == 'socks5':
+            self.handle_client(client)
+        elif protocol == 'http':
+            self.serve_http(client, addr)
+        else:
+            if first:
+                log(f"Unrecognized protocol from {addr[0]} (first byte {first!r})", "DEBUG")
+            client.close()
+
+    def serve_http(self, client, addr):
+        # 和 ThreadingHTTPServer 处理一个连接的方式相同；代理池、限速和指标与 SOCKS5 连接共用
+        try:
+            self.http_server.finish_request(client, addr)
+        except Exception:
+            self.http_server.handle_error(client, addr)
+        finally:
+            self.http_server.shutdown_request(client)
+
+    def handle_client(self, client):
+        start = time.monotonic()
+        try:
+            client_ip = client.getpeername()[0]
+        except OSError:
+            client.close()
+            return
+        if not rate_limits.admit(client_ip):
+            connection_rejected('socks5')
+            client.close()
+            return
+        try:
+            remote, upstream_name = self.handshake(client, client_ip, start)
+        except Exception as e:
+            log(f"SOCKS5 handshake failed: {e}", "WARNING")
+            connect_failed('socks5')
+            remote = None
+        if remote is None:  # 失败，或者 UDP ASSOCIATE 已经随控制连接结束
+            rate_limits.leave(client_ip)
+            client.close()
+            return
+        labels = tunnel_labels('socks5', upstream_name)
+        tunnel_opened(labels, start)
+
+        def on_close():
+            tunnel_closed(labels, upstream_name)
+            rate_limits.release(client_ip, upstream_name)
+            rate_limits.leave(client_ip)
+
+        # 开始转发数据
+        self.exchange_loop(client, remote, on_close, labels, rate_limits.buckets_for(client_ip, upstream_name))
+
+    def handshake(self, client, client_ip='', start=None):
+        # 返回 (remote, upstream_name)；UDP ASSOCIATE 在这里一直转发到控制连接关闭，返回 (None, None)
+        handshake = Socks5Handshake()
+        while not handshake.done:
+            data = client.recv(4096)
+            if not data:
+                raise ConnectionError("Client closed the connection during the handshake")
+            try:
+                reply = handshake.feed(data)
+            except Socks5Error as e:
+                client.sendall(e.response)
+                raise
+            if reply:
+                client.sendall(reply)
+
+        cmd, address, port = handshake.request
+        remote = upstream_name = None
+        try:
+            upstream_proxy, upstream_name = pick_upstream(address, self.upstream_proxy, self.upstream_name, port=port)
+            if cmd == 1:  # CONNECT
+                remote, upstream_name = connect_with_failover((address, port), upstream_proxy, upstream_name)
+                client.sendall(socks5_reply(remote.getsockname()))
+                if handshake.buffer:  # 客户端在收到回复之前就发出的数据
+                    remote.sendall(handshake.buffer)
+            elif cmd == 2:
+                remote = self.bind(client, (address, port), upstream_proxy, upstream_name)
+            else:
+                self.associate(client, client_ip, upstream_proxy, upstream_name, start)
+                return None, None
+        except Exception as e:
+            if remote is not None:
+                remote.close()
+                release_upstream(upstream_name)
+            with contextlib.suppress(OSError):
+                client.sendall(socks5_reply(('0.0.0.0', 0), socks5_error_code(e)))
+            raise Socks5Error(f"{SOCKS5_COMMANDS[cmd]} {address}:{port} failed: {e}", socks5_error_code(e)) from e
+        log(f"Connected to {address}:{port}" if cmd == 1 else f"BIND peer for {address}:{port} connected",
+            "DEBUG", upstream=upstream_label(upstream_name))
+        return remote, upstream_name
+
+    def bind(self, client, address, upstream_proxy=None, upstream_name=None):
+        # BIND：第一个回复告诉客户端监听地址，目标连入后第二个回复告诉它对端地址
+        if upstream_proxy:
+            remote, bound = socks5_upstream_control(upstream_for(upstream_proxy), address, 2)
+            try:
+                client.sendall(socks5_reply(bound))
+                remote.settimeout(BIND_TIMEOUT)
+                peer = socks5_read_reply(remote, address)
+                remote.settimeout(None)
+            except Exception:
+                remote.close()
+                raise
+            if upstream_name:
+                proxy_pool.acquire(upstream_name)
+        else:
+            with bind_listener(client.family) as listener:
+                client.sendall(socks5_reply((client.getsockname()[0], listener.getsockname()[1])))
+                remote, peer = listener.accept()
+            remote.settimeout(None)
+            if not bind_peer_allowed(address, peer):
+                remote.close()
+                raise Socks5Error(f"Unexpected BIND peer {peer[0]}", 2)
+        client.sendall(socks5_reply(peer))
+        return remote
+
+    def associate(self, client, client_ip, upstream_proxy=None, upstream_name=None, start=None):
+        control = relay = None
+        if upstream_proxy:
+            control, relay = socks5_upstream_control(upstream_for(upstream_proxy), ('0.0.0.0', 0), 3)
+        labels = tunnel_labels('socks5', upstream_name)
+        buckets = rate_limits.buckets_for(client_ip, upstream_name)
+        loop = get_udp_loop()
+        try:
+            transport = asyncio.run_coroutine_threadsafe(
+                open_udp_association(client.family, client_ip, relay, labels, buckets), loop).result()
+        except Exception:
+            rate_limits.release(client_ip, upstream_name)
+            if control:
+                control.close()
+            raise
+        if upstream_name:
+            proxy_pool.acquire(upstream_name)
+        tunnel_opened(labels, start)
+        log(f"UDP associate for {client_ip}", "DEBUG", upstream=upstream_label(upstream_name))
+        try:
+            client.sendall(socks5_reply((client.getsockname()[0], transport.get_extra_info('sockname')[1])))
+            while client.recv(4096):  # 关联一直持续到控制连接关闭
+                pass
+        except OSError:
+            pass
+        finally:
+            loop.call_soon_threadsafe(transport.close)
+            if control:
+                control.close()
+            rate_limits.release(client_ip, upstream_name)
+            tunnel_closed(labels, upstream_name)
+
+    def exchange_loop(self, client, remote, on_close=None, labels=None, buckets=None):
+        if RELAY_WORKERS:
+            get_relay_reactor().add_tunnel(client, remote, on_close, labels, buckets)
+        else:
+            with client, remote:
+                relay(client, remote, labels=labels, buckets=buckets)
+            if on_close:
+                on_close()
+
+class AsyncSocksProxy(SocksProxy):
+    # 单线程 asyncio 引擎：每个隧道只占用两个协程和少量缓冲区，而不是一个线程
+    chunk_size = 16384
+
+    def __init__(self, host, port, upstream_proxy=None, backlog=1024, upstream_name=None):
+        super().__init__(host, port, upstream_proxy, backlog, upstream_name)
+        self.loop = None
+        self.tunnels = set()
+        self._stopped = None
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        self._stopped = asyncio.Event()
+        if self.http_server is not None:
+            await self.serve_mixed()
+            return
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port,
+            backlog=self.backlog, reuse_address=True, reuse_port=REUSE_PORT or None, limit=self.chunk_size)
+        self.running = True
+        if self.stop_event.is_set():
+            self._stopped.set()
+        async with self.server:
+            await self._stopped.wait()
+            self.server.close()
+            for task in list(self.tunnels):
+                task.cancel()
+            if self.tunnels:
+                await asyncio.gather(*self.tunnels, return_exceptions=True)
+
+    async def serve_mixed(self):
+        # 单端口模式自己 accept：先偷看第一个字节，SOCKS5 连接在本事件循环里处理，HTTP 连接交给线程里的 ProxyHandler
+        loop = asyncio.get_running_loop()
+        self.server = socket.create_server((self.host, self.port), backlog=self.backlog, reuse_port=REUSE_PORT)
+        self.server.setblocking(False)
+        self.running = True
+        if self.stop_event.is_set():
+            self._stopped.set()
+        accepting = loop.create_task(self.accept_loop())
+        try:
+            await self._stopped.wait()
+        finally:
+            accepting.cancel()
+            self.server.close()
+            for task in list(self.tunnels):
+                task.cancel()
+            if self.tunnels:
+                await asyncio.gather(*self.tunnels, return_exceptions=True)
+
+    async def accept_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                client, addr = await loop.sock_accept(self.server)
+            except OSError as e:
+                log(f"Error accepting connection: {e}", "ERROR")
+                await asyncio.sleep(0.1)  # 例如文件描述符耗尽，稍后再试
+                continue
+            task = loop.create_task(self.sniff(client, addr))
+            self.tunnels.add(task)
+            task.add_done_callback(self.tunnels.discard)
+
+    async def sniff(self, client, addr):
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(client, lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, SNIFF_TIMEOUT)
+            first = client.recv(1, socket.MSG_PEEK)
+        except (asyncio.TimeoutError, OSError):
+            first = b''
+        except asyncio.CancelledError:
+            client.close()
+            raise
+        finally:
+            loop.remove_reader(client)
+        protocol = sniff_protocol(first)
+        if protocol == 'socks5':
+            reader, writer = await asyncio.open_connection(sock=client, limit=self.chunk_size)
+            await self.handle_client(reader, writer)
+        elif protocol == 'http':
+            client.setblocking(True)
+            threading.Thread(target=self.serve_http, args=(client, addr), daemon=True).start()
+        else:
+            if first:
+                log(f"Unrecognized protocol from {addr[0]} (first byte {first!r})", "DEBUG")
+            client.close()
+
+    def stop(self):
+        self.running = False
+        self.stop_event.set()
+        if self.loop and self._stopped and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._stopped.set)
+
+    async def handle_client(self, reader, writer):
+        client_ip = (writer.get_extra_info('peername') or ('',))[0]
+        if not rate_limits.admit(client_ip):
+            connection_rejected('socks5')
+            writer.close()
+            return
+        task = asyncio.current_task()
+        self.tunnels.add(task)
+        try:
+            await self._handle_client(reader, writer, client_ip)
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            log(f"SOCKS5 client error: {e}", "ERROR")
+        finally:
+            self.tunnels.discard(task)
+            rate_limits.leave(client_ip)
+            writer.close()
+
+    async def _handle_client(self, reader, writer, client_ip=''):
+        start = time.monotonic()
+        # SOCKS5 握手
+        handshake = Socks5Handshake()
+        while not handshake.done:
+            data = await reader.read(self.chunk_size)
+            if not data:
+                return
+            try:
+                writer.write(handshake.feed(data))
+            except Socks5Error as e:
+                writer.write(e.response)
+                connect_failed('socks5')
+                log(f"SOCKS5 handshake failed: {e}", "WARNING")
+                return
+
+        cmd, address, port = handshake.request
+        try:
+            upstream_proxy, upstream_name = pick_upstream(address, self.upstream_proxy, self.upstream_name, port=port)
+            if cmd == 1:  # CONNECT
+                remote_reader, remote_writer, upstream_name = await self.open_remote(address, port, upstream_proxy, upstream_name)
+                writer.write(socks5_reply(remote_writer.get_extra_info('sockname')))
+                if handshake.buffer:  # 客户端在收到回复之前就发出的数据
+                    remote_writer.write(bytes(handshake.buffer))
+            elif cmd == 2:
+                remote_reader, remote_writer = await self.bind(writer, (address, port), upstream_proxy, upstream_name)
+            else:
+                await self.associate(reader, writer, client_ip, upstream_proxy, upstream_name, start)
+                return
+        except Exception as e:
+            connect_failed('socks5')
+            writer.write(socks5_reply(('0.0.0.0', 0), socks5_error_code(e)))
+            log(f"SOCKS5 {SOCKS5_COMMANDS[cmd]} {address}:{port} failed: {e}", "WARNING")
+            return
+        log(f"Connected to {address}:{port}" if cmd == 1 else f"BIND peer for {address}:{port} connected",
+            "DEBUG", upstream=upstream_label(upstream_name))
+        labels = tunnel_labels('socks5', upstream_name)
+        up, down = byte_keys(labels)
+        tunnel_opened(labels, start)
+        buckets = rate_limits.buckets_for(client_ip, upstream_name)
+
+        # 开始转发数据
+        try:
+            await asyncio.gather(self.pipe(reader, remote_writer, up, buckets),
+                                 self.pipe(remote_reader, writer, down, buckets))
+        finally:
+            remote_writer.close()
+            rate_limits.release(client_ip, upstream_name)
+            tunnel_closed(labels, upstream_name)
+
+    async def open_remote(self, address, port, upstream_proxy=None, upstream_name=None):
+        if upstream_proxy:
+            # 上游握手（含竞速和故障转移）在事件循环里完成，不回应的上游不会占住线程、拖住其它隧道
+            return await open_with_failover((address, port), upstream_proxy, upstream_name, self.chunk_size)
+        reader, writer = await open_direct((address, port), self.chunk_size)
+        return reader, writer, None
+
+    async def bind(self, writer, address, upstream_proxy=None, upstream_name=None):
+        if upstream_proxy:
+            remote_reader, remote_writer, bound = await socks5_upstream_control_async(
+                upstream_for(upstream_proxy), address, 2, self.chunk_size)
+            try:
+                writer.write(socks5_reply(bound))
+                peer = await asyncio.wait_for(socks5_read_reply_async(remote_reader, address), BIND_TIMEOUT)
+            except BaseException:
+                remote_writer.close()
+                raise
+            if upstream_name:
+                proxy_pool.acquire(upstream_name)
+            writer.write(socks5_reply(peer))
+            return remote_reader, remote_writer
+        with bind_listener(writer.get_extra_info('socket').family) as listener:
+            listener.setblocking(False)
+            writer.write(socks5_reply((writer.get_extra_info('sockname')[0], listener.getsockname()[1])))
+            remote, peer = await asyncio.wait_for(self.loop.sock_accept(listener), BIND_TIMEOUT)
+        if not bind_peer_allowed(address, peer):
+            remote.close()
+            raise Socks5Error(f"Unexpected BIND peer {peer[0]}", 2)
+        writer.write(socks5_reply(peer))
+        return await asyncio.open_connection(sock=remote, limit=self.chunk_size)
+
+    async def associate(self, reader, writer, client_ip, upstream_proxy=None, upstream_name=None, start=None):
+        control = relay = None
+        if upstream_proxy:
+            _, control, relay = await socks5_upstream_control_async(
+                upstream_for(upstream_proxy), ('0.0.0.0', 0), 3, self.chunk_size)
+        labels = tunnel_labels('socks5', upstream_name)
+        buckets = rate_limits.buckets_for(client_ip, upstream_name)
+        try:
+            transport = await open_udp_association(writer.get_extra_info('socket').family, client_ip, relay, labels, buckets)
+        except BaseException:
+            rate_limits.release(client_ip, upstream_name)
+            if control:
+                control.close()
+            raise
+        if upstream_name:
+            proxy_pool.acquire(upstream_name)
+        tunnel_opened(labels, start)
+        log(f"UDP associate for {client_ip}", "DEBUG", upstream=upstream_label(upstream_name))
+        try:
+            writer.write(socks5_reply((writer.get_extra_info('sockname')[0], transport.get_extra_info('sockname')[1])))
+            with contextlib.suppress(ConnectionError):
+                while await reader.read(self.chunk_size):  # 关联一直持续到控制连接关闭
+                    pass
+        finally:
+            transport.close()
+            if control:
+                control.close()
+            rate_limits.release(client_ip, upstream_name)
+            tunnel_closed(labels, upstream_name)
+
+    async def pipe(self, reader, writer, key=None, buckets=None):
+        try:
+            while True:
+                data = await reader.read(self.chunk_size)
+                if not data:
+                    break
+                if key:
+                    metrics.add(key, len(data))
+                if buckets:
+                    delay = throttle(buckets, len(data))
+                    if delay:
+                        await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            if writer.can_write_eof():
+                try:
+                    writer.write_eof()
+                except OSError:
+                    pass
+
+def socks5_reply(bind_address, rep=0):
+    host, port = bind_address[0], bind_address[1]
+    if ':' in host:
+        return bytes((5, rep, 0, 4)) + socket.inet_pton(socket.AF_INET6, host) + port.to_bytes(2, 'big')
+    return bytes((5, rep, 0, 1)) + socket.inet_aton(host) + port.to_bytes(2, 'big')
+
+def sniff_protocol(first):
+    # SOCKS5 握手以版本号 5 开头，HTTP 请求以大写的方法名开头
+    if first == b'\x05':
+        return 'socks5'
+    if first.isalpha() and first.isupper():
+        return 'http'
+    return None
+
+class Socks5Error(Exception):
+    # 握手失败；response 是关闭连接前还要发给客户端的字节（方法选择、认证结果或错误回复）
+    def __init__(self, message, reply=1, response=b''):
+        super().__init__(message)
+        self.reply = reply
+        self.response = response
+
+def parse_socks_address(data, offset=0):
+    # 解析 ATYP + 地址 + 端口，返回 (host, port, 结束位置)；数据还不完整时返回 None
+    if len(data) < offset + 2:
+        return None
+    address_type = data[offset]
+    if address_type == 1:  # IPv4
+        end = offset + 5
+    elif address_type == 4:  # IPv6
+        end = offset + 17
+    elif address_type == 3:  # 域名
+        end = offset + 2 + data[offset + 1]
+    else:
+        raise ValueError(f"Unsupported address type {address_type}")
+    if len(data) < end + 2:
+        return None
+    if address_type == 1:
+        host = socket.inet_ntoa(data[offset + 1:end])
+    elif address_type == 4:
+        host = socket.inet_ntop(socket.AF_INET6, data[offset + 1:end])
+    else:
+        host = bytes(data[offset + 2:end]).decode(errors='replace')
+    return host, int.from_bytes(data[end:end + 2], 'big'), end + 2
+
+class Socks5Handshake:
+    # SOCKS5 握手状态机，本身不做 IO：feed() 收到的数据，返回应立即发给客户端的字节。
+    # 客户端把问候、认证和请求一次发完时（pipelining）一次读取就能完成握手；
+    # 完成后 request 为 (cmd, host, port)，buffer 中是请求之后已经收到的数据，需要转发给目标
+    def __init__(self, users=None):
+        self.users = SOCKS_USERS if users is None else users
+        self.buffer = bytearray()
+        self.state = 'greeting'
+        self.username = None
+        self.request = None
+
+    @property
+    def done(self):
+        return self.state == 'done'
+
+    def feed(self, data):
+        self.buffer += data
+        buffer = self.buffer
+        out = b''
+        while self.state != 'done':
+            if self.state == 'greeting':
+                if len(buffer) < 2:
+                    break
+                if buffer[0] != 5:
+                    raise Socks5Error(f"Unsupported SOCKS version {buffer[0]}", None, out)
+                if len(buffer) < 2 + buffer[1]:
+                    break
+                methods = buffer[2:2 + buffer[1]]
+                del buffer[:2 + buffer[1]]
+                method = 2 if self.users else 0  # 用户名/密码认证或无需认证
+                if method not in methods:
+                    raise Socks5Error("No acceptable authentication method", None, out + b"\x05\xff")
+                out += bytes((5, method))
+                self.state = 'auth' if method else 'request'
+            elif self.state == 'auth':
+                # RFC 1929：VER ULEN UNAME PLEN PASSWD
+                if len(buffer) < 2 or len(buffer) < 3 + buffer[1]:
+                    break
+                user_end = 2 + buffer[1]
+                if len(buffer) < user_end + 1 + buffer[user_end]:
+                    break
+                username = bytes(buffer[2:user_end]).decode(errors='replace')
+                password = bytes(buffer[user_end + 1:user_end + 1 + buffer[user_end]])
+                del buffer[:user_end + 1 + buffer[user_end]]
+                expected = self.users.get(username)
+                if expected is None or not hmac.compare_digest(expected.encode(), password):
+                    raise Socks5Error(f"Authentication failed for user {username!r}", None, out + b"\x01\x01")
+                out += b"\x01\x00"
+                self.username = username
+                self.state = 'request'
+            else:
+                if len(buffer) < 4:
+                    break
+                version, cmd = buffer[0], buffer[1]
+                try:
+                    address = parse_socks_address(buffer, 3)
+                except ValueError as e:
+                    raise Socks5Error(str(e), 8, out + socks5_reply(('0.0.0.0', 0), 8))
+                if address is None:
+                    break
+                host, port, end = address
+                del buffer[:end]
+                if version != 5 or cmd not in (1, 2, 3):
+                    raise Socks5Error(f"Unsupported command {cmd}", 7, out + socks5_reply(('0.0.0.0', 0), 7))
+                self.request = (cmd, host, port)
+                self.state = 'done'
+        return out
+
+SOCKS5_COMMANDS = {1: 'CONNECT', 2: 'BIND', 3: 'UDP ASSOCIATE'}
+
+def socks5_error_code(error):
+    # 请求失败时回复给客户端的 REP 码
+    if isinstance(error, Socks5Error):
+        return error.reply or 1
+    if isinstance(error, RouteBlockedError):
+        return 2
+    if isinstance(error, ConnectionRefusedError):
+        return 5
+    if isinstance(error, (TimeoutError, socket.gaierror)):
+        return 4
+    if isinstance(error, OSError) and error.errno == errno.ENETUNREACH:
+        return 3
+    if isinstance(error, OSError) and error.errno == errno.EHOSTUNREACH:
+        return 4
+    return 1
+
+def socks5_upstream_control(upstream, address, cmd):
+    # BIND / UDP ASSOCIATE 经过上游时，与 SOCKS5 上游建立控制连接并转发同样的命令，返回 (sock, 上游回复的地址)。
+    # 多跳链的最后一跳须为 SOCKS5；UDP 数据报无法穿过前面几跳的 TCP 隧道，所以链上不支持 UDP ASSOCIATE
+    hops = control_hops(upstream, cmd)
+    last = hops[-1]
+    if len(hops) > 1:
+        sock = ProxyChain('', hops[:-1]).connect((last.host, last.port), CONNECT_TIMEOUT)
+    else:
+        sock = socket.create_connection((last.host, last.port), CONNECT_TIMEOUT)
+    try:
+        socks5_greet(sock, last.username, last.password)
+        host, port = socks5_request(sock, address, cmd)
+    except Exception:
+        sock.close()
+        raise
+    if host in ('0.0.0.0', '::'):
+        host = sock.getpeername()[0]
+    return sock, (host, port)
+
+def control_hops(upstream, cmd):
+    hops = getattr(upstream, 'hops', (upstream,))
+    if hops[-1].proxy_type != socks.SOCKS5 or (cmd == 3 and len(hops) > 1):
+        raise Socks5Error(f"{SOCKS5_COMMANDS[cmd]} is not supported through {upstream.label}", 7)
+    return hops
+
+async def socks5_upstream_control_async(upstream, address, cmd, limit):
+    # socks5_upstream_control 的 asyncio 版本，返回 (reader, writer, 上游回复的地址)
+    hops = control_hops(upstream, cmd)
+    last = hops[-1]
+
+    async def handshake():
+        if len(hops) > 1:
+            reader, writer = await open_tunnel(ProxyChain('', hops[:-1]), (last.host, last.port), limit)
+        else:
+            reader, writer = await open_direct((last.host, last.port), limit)
+        try:
+            return reader, writer, await socks5_handshake_async(reader, writer, last, address, cmd)
+        except BaseException:
+            writer.close()
+            raise
+
+    reader, writer, (host, port) = await asyncio.wait_for(handshake(), CONNECT_TIMEOUT)
+    if host in ('0.0.0.0', '::'):
+        host = writer.get_extra_info('peername')[0]
+    return reader, writer, (host, port)
+
+def bind_listener(client_family):
+    # BIND 的监听套接字和 UDP 中继都绑定通配地址，回复给客户端的是它连入时使用的本机地址
+    listener = socket.create_server(('::' if client_family == socket.AF_INET6 else '0.0.0.0', 0), family=client_family)
+    listener.settimeout(BIND_TIMEOUT)
+    return listener
+
+def bind_peer_allowed(address, peer):
+    # BIND 请求中的 DST.ADDR 是预期连入的对端，为 IP 时只接受来自它的连接
+    host = address[0]
+    try:
+        socket.inet_pton(socket.AF_INET6 if ':' in host else socket.AF_INET, host)
+    except OSError:
+        return True
+    return host in ('0.0.0.0', '::') or host == peer[0]
+
+def udp_header(address):
+    return b"\x00\x00\x00" + socks_address(address[0]) + address[1].to_bytes(2, 'big')
+
+class UdpAssociation(asyncio.DatagramProtocol):
+    # UDP ASSOCIATE 的数据报中继，同一个套接字面向客户端和目标。直连时去掉 SOCKS5 UDP 头发给目标，
+    # 目标的回包加上头发回客户端；经过 SOCKS5 上游时头部格式相同，数据报原样在客户端和上游中继之间转发。
+    # 只接受控制连接所在 IP 发来的数据报和客户端发送过的目标的回包；超出限速的数据报直接丢弃
+    max_peers = 4096
+
+    def __init__(self, client_ip, relay=None, labels=None, buckets=None):
+        self.client_ip = client_ip
+        self.client = None  # 第一个来自 client_ip 的数据报确定客户端的端口
+        self.relay = relay
+        self.peers = set()
+        self.up, self.down = byte_keys(labels) if labels else (None, None)
+        self.buckets = buckets
+        self.transport = None
+        self.family = socket.AF_INET
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.family = transport.get_extra_info('socket').family
+
+    def datagram_received(self, data, addr):
+        addr = addr[:2]
+        if addr == self.client or (self.client is None and addr[0] == self.client_ip):
+            self.client = addr
+            if self.relay:
+                self.send(data, self.relay, self.up)
+                return
+            try:
+                target = parse_socks_address(data, 3)
+            except ValueError:
+                return
+            if target is None or data[2]:  # 不支持分片
+                return
+            host, port, end = target
+            try:
+                addresses, future = dns_resolver.lookup(host)
+            except socket.gaierror:
+                return
+            if future is None:
+                self.send_to(addresses, port, data[end:])
+            else:
+                loop = asyncio.get_running_loop()
+                future.add_done_callback(lambda f: loop.call_soon_threadsafe(self.resolved, f, port, data[end:]))
+        elif self.client is None:
+            return
+        elif self.relay:
+            if addr == self.relay:
+                self.send(data, self.client, self.down)
+        elif addr in self.peers:
+            self.send(udp_header(addr) + data, self.client, self.down)
+
+    def resolved(self, future, port, payload):
+        if self.transport and not self.transport.is_closing() and not future.exception():
+            self.send_to(future.result(), port, payload)
+
+    def send_to(self, addresses, port, payload):
+        for family, ip in addresses:
+            if family == self.family:
+                if len(self.peers) >= self.max_peers:
+                    self.peers.clear()
+                self.peers.add((ip, port))
+                self.send(payload, (ip, port), self.up)
+                return
+
+    def send(self, data, addr, key):
+        if self.buckets:
+            if throttle(self.buckets, 0):
+                return
+            throttle(self.buckets, len(data))
+        if key:
+            metrics.add(key, len(data))
+        self.transport.sendto(data, addr)
+
+    def error_received(self, exc):
+        pass  # ICMP 不可达等错误不影响其他目标
+
+async def open_udp_association(family, client_ip, relay=None, labels=None, buckets=None):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: UdpAssociation(client_ip, relay, labels, buckets),
+        local_addr=('::' if family == socket.AF_INET6 else '0.0.0.0', 0), family=family)
+    return transport
+
+udp_loop = None
+udp_loop_lock = threading.Lock()
+
+def get_udp_loop():
+    # 线程引擎的 UDP ASSOCIATE 都交给一个后台事件循环转发，不为每个关联开线程
+    global udp_loop
+    if udp_loop is None:
+        with udp_loop_lock:
+            if udp_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='udp-relay', daemon=True).start()
+                udp_loop = loop
+    return udp_loop
+
+class CircuitBreaker:
+    # closed -> 连续失败达到阈值 -> open -> 冷却期过后放行一次探测 (half-open) -> 成功则 closed，失败则加倍冷却
+    __slots__ = ('state', 'consecutive_failures', 'retry_at', 'cooldown')
+    threshold = 2
+    reset_timeout = 30.0
+    max_reset_timeout = 600.0
+
+    def __init__(self):
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.retry_at = 0.0
+        self.cooldown = self.reset_timeout
+
+    def available(self, now):
+        # 不占用探测名额的检查，供选择策略过滤
+        return self.state == 'closed' or now >= self.retry_at
+
+    def begin(self, now):
+        # 真正发起连接前调用；half-open 时只放行一个探测连接
+        if self.state == 'closed':
+            return True
+        if now < self.retry_at:
+            return False
+        self.state = 'half-open'
+        self.retry_at = now + self.cooldown  # 探测期间其他连接继续绕开
+        return True
+
+    def success(self):
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.cooldown = self.reset_timeout
+
+    def failure(self, now):
+        self.consecutive_failures += 1
+        if self.state == 'half-open':
+            self.cooldown = min(self.cooldown * 2, self.max_reset_timeout)
+        elif self.consecutive_failures < self.threshold:
+            return
+        self.state = 'open'
+        self.retry_at = now + self.cooldown
+
+class CircuitOpenError(ConnectionError):
+    pass
+
+class ProxyStats:
+    # 每个代理的健康数据：延迟（指数滑动平均）、成功率、最后检测时间和熔断器
+    __slots__ = ('latency', 'successes', 'failures', 'last_checked', 'active', 'breaker')
+    alpha = 0.3
+    unknown_latency = 1.0  # 尚无数据的代理按 1 秒估计，既不优先也不冷落
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.successes = 0
+        self.failures = 0
+        self.last_checked = 0.0
+        self.active = 0
+        self.breaker = CircuitBreaker()
+
+    def score(self):
+        # 期望耗时：延迟除以平滑后的成功率，越小越好
+        latency = self.unknown_latency if self.latency is None else self.latency
+        return latency * (self.successes + self.failures + 2) / (self.successes + 1)
+
+    def record_success(self, latency):
+        self.latency = latency if self.latency is None else self.latency + self.alpha * (latency - self.latency)
+        self.successes += 1
+        self.last_checked = time.time()
+        self.breaker.success()
+
+    def record_failure(self):
+        self.failures += 1
+        self.last_checked = time.time()
+        self.breaker.failure(time.monotonic())
+
+    @property
+    def success_rate(self):
+        total = self.successes + self.failures
+        return self.successes / total if total else 0.0
+
+    def to_dict(self):
+        return {'latency': self.latency, 'success_rate': self.success_rate, 'active': self.active,
+                'successes': self.successes, 'failures': self.failures, 'last_checked': self.last_checked,
+                'breaker': self.breaker.state}
+
+UNKNOWN_SCORE = ProxyStats().score()
+
+class SelectionStrategy:
+    name = None
+
+    def __init__(self):
+        self.table = None
+
+    def choose(self, proxies: List[str], pool: 'ProxyPool') -> str:
+        raise NotImplementedError
+
+    def prepare(self, proxies: List[str], pool: 'ProxyPool'):
+        # 需要预计算表的策略覆盖它
+        return None
+
+    def rank(self, proxies, pool):
+        # 由 PoolRanker 在后台调用
+        count = len(proxies)
+        self.table = (proxies, count, time.monotonic(), self.prepare(proxies, pool))
+
+    def prepared(self, proxies, pool):
+        # 池当前列表的预计算表由后台重算，过期时先沿用旧表，还没有表时返回 None；
+        # select() 临时过滤出的候选列表直接现算
+        if proxies is not pool.proxies:
+            return self.prepare(proxies, pool)
+        table = self.table
+        if table is None or table[0] is not proxies or table[1] != len(proxies) or \
+                time.monotonic() - table[2] > PoolRanker.interval:
+            pool.request_rank()
+        return table[3] if table else None
+
+class RandomStrategy(SelectionStrategy):
+    name = 'random'
+
+    def choose(self, proxies, pool):
+        return random.choice(proxies)
+
+class RoundRobinStrategy(SelectionStrategy):
+    name = 'round-robin'
+
+    def __init__(self):
+        super().__init__()
+        self.counter = itertools.count()
+
+    def choose(self, proxies, pool):
+        return proxies[next(self.counter) % len(proxies)]
+
+class WeightedLatencyStrategy(SelectionStrategy):
+    # 按 1/score 加权随机，快的代理拿到更多流量，慢的仍保留少量探测流量；
+    # 累积权重定期预计算，每次选择只做一次二分查找
+    name = 'latency'
+
+    def prepare(self, proxies, pool):
+        stats = pool.stats
+        proxies = list(proxies)
+        weights = (1.0 / stats[proxy].score() if proxy in stats else 1.0 / UNKNOWN_SCORE for proxy in proxies)
+        return proxies, list(itertools.accumulate(weights))
+
+    def choose(self, proxies, pool):
+        table = self.prepared(proxies, pool)
+        if table is None:
+            return random.choice(proxies)
+        proxies, cum_weights = table
+        return random.choices(proxies, cum_weights=cum_weights)[0]
+
+class PowerOfTwoStrategy(SelectionStrategy):
+    # 随机取两个，选负载与延迟综合更好的那个，O(1)
+    name = 'p2c'
+
+    def choose(self, proxies, pool):
+        if len(proxies) < 2:
+            return proxies[0]
+        a, b = random.sample(proxies, 2)
+        stats_a, stats_b = pool.stats_for(a), pool.stats_for(b)
+        return a if stats_a.score() * (stats_a.active + 1) <= stats_b.score() * (stats_b.active + 1) else b
+
+class LeastConnectionsStrategy(SelectionStrategy):
+    # 定期挑出负载最低的一批候选，选择时只在候选里按实时连接数比较
+    name = 'least-conn'
+    candidates = 32
+
+    @staticmethod
+    def load(proxy, pool):
+        stats = pool.stats.get(proxy)
+        return (stats.active, stats.score()) if stats else (0, UNKNOWN_SCORE)
+
+    def prepare(self, proxies, pool):
+        return heapq.nsmallest(self.candidates, proxies, key=lambda proxy: self.load(proxy, pool))
+
+    def choose(self, proxies, pool):
+        # 旧表里可能有已移出池的代理
+        index = pool.index
+        candidates = [proxy for proxy in self.prepared(proxies, pool) or () if proxy in index]
+        if not candidates:
+            return random.choice(proxies)
+        return min(candidates, key=lambda proxy: self.load(proxy, pool))
+
+SELECTION_STRATEGIES = {cls.name: cls for cls in (
+    RandomStrategy, RoundRobinStrategy, WeightedLatencyStrategy, PowerOfTwoStrategy, LeastConnectionsStrategy)}
+
+@contextlib.contextmanager
+def gc_paused():
+    # 批量创建大量记录时暂停分代 GC，否则每分配几百个对象就会触发一次扫描
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+DEFAULT_PORTS = {'http': 80, 'https': 443, 'socks4': 1080, 'socks5': 1080, 'socks': 1080}
+
+UPSTREAM_TYPES = {'http': socks.HTTP, 'https': socks.HTTP, 'socks4': socks.SOCKS4, 'socks5': socks.SOCKS5, 'socks': socks.SOCKS5}
+
+class UpstreamProxy:
+    # 解析好的上游代理描述，创建后不可修改；代理池的索引里每个代理字符串只对应一个实例，
+    # 各处需要的参数格式（PySocks、requests）在第一次使用时生成并缓存在实例上
+    __slots__ = ('proxy', 'scheme', 'host', 'port', 'username', 'password', '_connect_kwargs', '_requests_proxies')
+
+    def __init__(self, proxy, scheme, host, port, username=None, password=None):
+        for name, value in (('proxy', proxy), ('scheme', scheme), ('host', host), ('port', port),
+                            ('username', username), ('password', password),
+                            ('_connect_kwargs', None), ('_requests_proxies', None)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("UpstreamProxy is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("UpstreamProxy is immutable")
+
+    def __reduce__(self):
+        # 传给工作进程时按字符串重新解析
+        return parse_upstream, (self.proxy,)
+
+    def __eq__(self, other):
+        return isinstance(other, UpstreamProxy) and other.proxy == self.proxy
+
+    def __hash__(self):
+        return hash(self.proxy)
+
+    def __str__(self):
+        return self.proxy
+
+    def __repr__(self):
+        return f"UpstreamProxy({self.label!r})"
+
+    @classmethod
+    def parse(cls, proxy: str) -> 'UpstreamProxy':
+        # 只用字符串切分，批量导入时比 urlsplit 快得多
+        scheme, sep, rest = proxy.partition('://')
+        if sep:
+            scheme = scheme.lower()
+        else:
+            scheme, rest = 'http', proxy
+        userinfo, _, hostport = rest.rstrip('/').rpartition('@')
+        host, sep, port = hostport.rpartition(':')
+        if not sep or not port.isdigit():
+            host, port = hostport, DEFAULT_PORTS.get(scheme, 1080)
+        if host[:1] == '[':
+            host = host[1:-1]
+        username = password = None
+        if userinfo:
+            username, _, password = userinfo.partition(':')
+            if '%' in userinfo:
+                username, password = unquote(username), unquote(password)
+        return cls(proxy, scheme, host, int(port), username or None, password or None)
+
+    @property
+    def proxy_type(self):
+        # PySocks 的代理类型，不支持的协议为 None
+        return UPSTREAM_TYPES.get(self.scheme)
+
+    @property
+    def netloc(self):
+        return f"[{self.host}]:{self.port}" if ':' in self.host else f"{self.host}:{self.port}"
+
+    @property
+    def label(self):
+        # 不含用户名和密码，用于日志和指标
+        return f"{self.scheme}://{self.netloc}"
 
-    def do_CONNECT(self):
-        address = self.path.split(':', 1)
-        address[1] = int(address[1]) or 443
-        try:
-            if self.upstream_proxy:
-                s = socks.create_connection(address, **self.upstream_proxy)
-            else:
-                s = socket.create_connection(address, timeout=self.timeout)
-        except Exception as e:
-            self.send_error(502)
-            log(f"Error connecting to upstream: {e}")
-            return
-        self.send_response(200, 'Connection Established')
-        self.end_headers()
+    def url(self, scheme=None):
+        userinfo = ''
+        if self.username:
+            userinfo = quote(self.username, safe='')
+            if self.password:
+                userinfo += ':' + quote(self.password, safe='')
+            userinfo += '@'
+        return f"{scheme or self.scheme}://{userinfo}{self.netloc}"
 
-        conns = [self.connection, s]
-        self.close_connection = 0
-        while not self.close_connection:
-            rlist, wlist, xlist = select.select(conns, [], conns, self.timeout)
-            if xlist or not rlist:
-                break
-            for r in rlist:
-                other = conns[1] if r is conns[0] else conns[0]
-                data = r.recv(8192)
-                if not data:
-                    self.close_connection = 1
-                    break
-                other.sendall(data)
+    @property
+    def connect_kwargs(self):
+        # socks.create_connection 的参数
+        if self._connect_kwargs is None:
+            if self.proxy_type is None:
+                raise ValueError(f"Unsupported upstream proxy: {self.label}")
+            object.__setattr__(self, '_connect_kwargs', MappingProxyType({
+                'proxy_type': self.proxy_type, 'proxy_addr': self.host, 'proxy_port': self.port,
+                'proxy_username': self.username, 'proxy_password': self.password}))
+        return self._connect_kwargs
 
-    def do_GET(self):
-        if self.upstream_proxy:
-            self.handle_upstream_proxy()
-        else:
-            self.handle_direct()
+    @property
+    def requests_proxies(self):
+        # requests 的 proxies 参数；SOCKS 上游用 socks5h/socks4a，由上游解析域名
+        if self._requests_proxies is None:
+            if self.proxy_type is None:
+                raise ValueError(f"Unsupported upstream proxy: {self.label}")
+            scheme = {socks.SOCKS4: 'socks4a', socks.SOCKS5: 'socks5h'}.get(self.proxy_type, self.scheme)
+            url = self.url(scheme)
+            object.__setattr__(self, '_requests_proxies', MappingProxyType({'http': url, 'https': url}))
+        return self._requests_proxies
 
-    def handle_upstream_proxy(self):
-        url = self.path
-        headers = {k: v for k, v in self.headers.items()}
-        try:
-            response = requests.get(url, headers=headers, proxies=self.upstream_proxy, stream=True)
-            self.send_response(response.status_code)
-            for header, value in response.headers.items():
-                self.send_header(header, value)
-            self.end_headers()
-            for chunk in response.iter_content(8192):
-                self.wfile.write(chunk)
-        except Exception as e:
-            self.send_error(502)
-            log(f"Error handling upstream proxy request: {e}")
+    def connect(self, address, timeout=None):
+        return socks.create_connection(address, timeout=timeout, **self.connect_kwargs)
 
-    def handle_direct(self):
-        url = self.path
-        headers = {k: v for k, v in self.headers.items()}
-        try:
-            response = requests.get(url, headers=headers, stream=True)
-            self.send_response(response.status_code)
-            for header, value in response.headers.items():
-                self.send_header(header, value)
-            self.end_headers()
-            for chunk in response.iter_content(8192):
-                self.wfile.write(chunk)
-        except Exception as e:
-            self.send_error(502)
-            log(f"Error handling direct request: {e}")
+class ProxyChain:
+    # 多跳上游，写作用 '>' 连接的代理字符串（socks5://a:1080>http://b:8080）。先直连第一跳，
+    # 再在已建立的隧道上依次与后面每一跳握手，最后一跳连接目标；整个字符串作为统计和指标的键
+    __slots__ = ('proxy', 'hops')
+    separator = '>'
 
-    do_POST = do_PUT = do_DELETE = do_HEAD = do_GET
+    def __init__(self, proxy, hops):
+        object.__setattr__(self, 'proxy', proxy)
+        object.__setattr__(self, 'hops', tuple(hops))
 
-class SocksProxy(threading.Thread):
-    def __init__(self, host, port, upstream_proxy=None):
-        super().__init__()
-        self.host = host
-        self.port = port
-        self.upstream_proxy = upstream_proxy
-        self.running = False
-        self.server = None
-        self.stop_event = threading.Event()
+    def __setattr__(self, name, value):
+        raise AttributeError("ProxyChain is immutable")
 
-    def run(self):
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server.bind((self.host, self.port))
-        self.server.listen(5)
-        self.server.settimeout(1)  # 设置超时，以便能够响应停止请求
-        self.running = True
-        while self.running and not self.stop_event.is_set():
-            try:
-                client, addr = self.server.accept()
-                t = threading.Thread(target=self.handle_client, args=(client,))
-                t.start()
-            except socket.timeout:
-                continue
-            except Exception as e:
-                if self.running:
-                    log(f"Error accepting connection: {e}")
+    def __reduce__(self):
+        return parse_upstream, (self.proxy,)
 
-    def stop(self):
-        self.running = False
-        self.stop_event.set()
-        if self.server:
-            self.server.close()
+    def __eq__(self, other):
+        return isinstance(other, ProxyChain) and other.proxy == self.proxy
 
-    def handle_client(self, client):
-        with client:
-            # SOCKS5 握手
-            client.recv(2)  # 版本和认证方法数
-            client.sendall(b"\x05\x00")  # 无需认证
-
-            # 请求
-            version, cmd, _, address_type = client.recv(4)
-            if address_type == 1:  # IPv4
-                address = socket.inet_ntoa(client.recv(4))
-            elif address_type == 3:  # 域名
-                domain_length = ord(client.recv(1))
-                address = client.recv(domain_length).decode()
-            else:
-                client.close()
-                return
+    def __hash__(self):
+        return hash(self.proxy)
 
-            port = int.from_bytes(client.recv(2), 'big')
+    def __str__(self):
+        return self.proxy
 
-            try:
-                if cmd == 1:  # CONNECT
-                    if self.upstream_proxy:
-                        remote = socks.create_connection((address, port), **self.upstream_proxy)
-                    else:
-                        remote = socket.create_connection((address, port))
-                    bind_address = remote.getsockname()
-                    log(f"Connected to {address}:{port}")
-                else:
-                    client.close()
-                    return
-            except Exception as e:
-                log(e)
-                client.close()
-                return
+    def __repr__(self):
+        return f"ProxyChain({self.label!r})"
+
+    @classmethod
+    def parse(cls, proxy: str) -> 'ProxyChain':
+        return cls(proxy, [UpstreamProxy.parse(hop.strip()) for hop in proxy.split(cls.separator)])
+
+    @property
+    def proxy_type(self):
+        # 每一跳都支持时为 'chain'，否则为 None
+        return 'chain' if all(hop.proxy_type for hop in self.hops) else None
+
+    @property
+    def label(self):
+        return self.separator.join(hop.label for hop in self.hops)
+
+    @property
+    def connect_kwargs(self):
+        raise ValueError(f"Proxy chains cannot be passed to PySocks: {self.label}")
+
+    @property
+    def requests_proxies(self):
+        raise ValueError(f"Proxy chains cannot be passed to requests: {self.label}")
+
+    def connect(self, address, timeout=None):
+        if not isinstance(timeout, (int, float)):
+            timeout = CONNECT_TIMEOUT
+        first = self.hops[0]
+        sock = connect_direct((first.host, first.port), timeout=timeout)
+        try:
+            targets = [(hop.host, hop.port) for hop in self.hops[1:]] + [address]
+            for hop, target in zip(self.hops, targets):
+                tunnel_through(sock, hop, target)
+        except Exception:
+            sock.close()
+            raise
+        return sock
 
-            client.sendall(b"\x05\x00\x00\x01" + socket.inet_aton(bind_address[0]) + bind_address[1].to_bytes(2, 'big'))
+class PoolRanker(threading.Thread):
+    # 代理池的排名线程：读到过期排名的连接线程唤醒它，由它扫描整个池重算，
+    # 两次重算之间至少间隔 interval 秒，连接线程自己从不扫描整个池
+    interval = 1.0
 
-            # 开始转发数据
-            self.exchange_loop(client, remote)
+    def __init__(self, pool: 'ProxyPool'):
+        super().__init__(name="pool-ranker", daemon=True)
+        self.pool = pool
+        self.wake = threading.Event()
 
-    def exchange_loop(self, client, remote):
+    def run(self):
         while True:
-            r, w, e = select.select([client, remote], [], [])
-            if client in r:
-                data = client.recv(4096)
-                if remote.send(data) <= 0:
-                    break
-            if remote in r:
-                data = remote.recv(4096)
-                if client.send(data) <= 0:
-                    break
+            self.wake.wait()
+            self.wake.clear()
+            try:
+                self.pool.rank()
+            except Exception as e:
+                log(f"Proxy pool ranking failed: {e}", "ERROR")
+            time.sleep(self.interval)
 
 class ProxyPool:
-    def __init__(self, file_path: str = 'proxies.json'):
+    # 代理以列表保存（随机选择 O(1)），另有 proxy -> UpstreamProxy 的哈希索引用于去重和查询；
+    # 持久化为 JSON 快照加追加写的变更日志（file_path + '.log'），日志过长时压缩回快照
+    compact_min = 10000  # 日志条数超过 max(compact_min, 代理数) 时压缩
+
+    def __init__(self, file_path: str = 'proxies.json', strategy: str = 'random'):
         self.file_path = file_path
         self.proxies: List[str] = []
+        self.index: Dict[str, UpstreamProxy] = {}
+        self.log_entries = 0
+        self.stats: Dict[str, ProxyStats] = {}
+        self.stats_lock = threading.Lock()
+        self.strategy: SelectionStrategy = SELECTION_STRATEGIES[strategy]()
+        self.ring = None
+        self.best_cache = None
+        self.ranker = None
         self.last_refresh = 0
         self.refresh_interval = 300  # 5 minutes
 
-    async def add_proxies(self, new_proxies: List[str]):
-        for proxy in new_proxies:
-            if proxy not in self.proxies:
-                self.proxies.append(proxy)
-        await self.save_to_file()
-        log(f"Added {len(new_proxies)} new proxies. Total proxies: {len(self.proxies)}")
+    def set_strategy(self, name: str):
+        self.strategy = SELECTION_STRATEGIES[name]()
+
+    def available(self, proxy: str, now=None) -> bool:
+        stats = self.stats.get(proxy)
+        return stats is None or stats.breaker.available(time.monotonic() if now is None else now)
+
+    def select(self, exclude=()) -> Optional[str]:
+        proxies = self.proxies
+        if not proxies:
+            return None
+        now = time.monotonic()
+        # 大多数情况下前几次就能选中可用的代理，避免每次都过滤整个列表
+        for _ in range(8):
+            proxy = self.strategy.choose(proxies, self)
+            if proxy not in exclude and proxy in self.index and self.available(proxy, now):
+                return proxy
+        candidates = [proxy for proxy in proxies if proxy not in exclude and self.available(proxy, now)]
+        return self.strategy.choose(candidates, self) if candidates else None
+
+    def select_for(self, key: str, exclude=()) -> Optional[str]:
+        # 一致性哈希：同一目标主机固定落在同一个上游，池变化时只有少量主机被重新分配
+        proxies = self.proxies
+        if not proxies:
+            return None
+        ring = self.ring
+        if ring is None or ring[0] is not proxies or ring[1] != len(proxies):
+            vnodes = max(1, min(16, 100000 // len(proxies)))
+            points = sorted((zlib.crc32(f"{proxy}#{i}".encode()), proxy) for proxy in proxies for i in range(vnodes))
+            ring = self.ring = (proxies, len(proxies), [h for h, _ in points], [p for _, p in points])
+        index = bisect.bisect(ring[2], zlib.crc32(key.encode()))
+        now = time.monotonic()
+        # 沿环向后找第一个可用的上游，熔断的代理只影响它自己负责的那部分主机
+        for step in range(min(len(ring[3]), 64)):
+            proxy = ring[3][(index + step) % len(ring[3])]
+            if proxy not in exclude and self.available(proxy, now):
+                return proxy
+        return self.select(exclude)
+
+    def best(self, n: int, exclude=()) -> List[str]:
+        # 评分最好的若干个可用代理；排名由 PoolRanker 在后台重算，这里只读缓存，
+        # 过期时先用旧的排名，第一次排名完成前返回空列表
+        now = time.monotonic()
+        cache = self.best_cache
+        if cache is None or cache[0] is not self.proxies or now - cache[1] > PoolRanker.interval:
+            self.request_rank()
+            if cache is None:
+                return []
+        index = self.index
+        return [proxy for proxy in cache[2]
+                if proxy not in exclude and proxy in index and self.available(proxy, now)][:n]
+
+    def rank(self):
+        # 在 PoolRanker 线程里执行：重算 best() 的排名和选择策略的预计算表
+        proxies = self.proxies
+        now = time.monotonic()
+        stats = self.stats
+        ranked = heapq.nsmallest(32, (proxy for proxy in proxies if self.available(proxy, now)),
+                                 key=lambda proxy: stats[proxy].score() if proxy in stats else UNKNOWN_SCORE)
+        self.best_cache = (proxies, now, ranked)
+        self.strategy.rank(proxies, self)
+
+    def request_rank(self):
+        # 第一次需要排名时才启动后台线程，临时创建的池和工作进程里的池互不影响
+        if self.ranker is None:
+            with self.stats_lock:
+                if self.ranker is None:
+                    self.ranker = PoolRanker(self)
+                    self.ranker.start()
+        self.ranker.wake.set()
+
+    def begin_attempt(self, proxy: str) -> bool:
+        with self.stats_lock:
+            return self.stats_for(proxy).breaker.begin(time.monotonic())
+
+    # 以下由隧道处理线程调用，记录真实连接的结果
+    def record_connect(self, proxy: str, latency: float):
+        with self.stats_lock:
+            self.stats_for(proxy).record_success(latency)
+
+    def record_failure(self, proxy: str):
+        with self.stats_lock:
+            self.stats_for(proxy).record_failure()
+
+    def acquire(self, proxy: str):
+        with self.stats_lock:
+            self.stats_for(proxy).active += 1
+
+    def release(self, proxy: str):
+        with self.stats_lock:
+            stats = self.stats.get(proxy)
+            if stats and stats.active > 0:
+                stats.active -= 1
+
+    def stats_for(self, proxy: str) -> ProxyStats:
+        stats = self.stats.get(proxy)
+        if stats is None:
+            stats = self.stats.setdefault(proxy, ProxyStats())
+        return stats
+
+    def snapshot(self):
+        # 交给工作进程的只读快照：代理列表和目前积累的统计
+        with self.stats_lock:
+            stats = {proxy: (s.latency, s.successes, s.failures) for proxy, s in self.stats.items()}
+        return self.file_path, list(self.proxies), stats
+
+    def restore(self, snapshot):
+        self.file_path, proxies, stats = snapshot
+        for proxy, (latency, successes, failures) in stats.items():
+            s = self.stats_for(proxy)
+            s.latency, s.successes, s.failures = latency, successes, failures
+        self.replace(proxies)
+
+    def record(self, proxy: str) -> Optional[UpstreamProxy]:
+        return self.index.get(proxy)
+
+    def __contains__(self, proxy: str) -> bool:
+        return proxy in self.index
+
+    def __len__(self):
+        return len(self.proxies)
+
+    def replace(self, proxies: List[str]):
+        # 整体替换代理列表并重建索引（重复项只保留第一个）
+        index = {}
+        with gc_paused():
+            for proxy in proxies:
+                if proxy not in index:
+                    index[proxy] = UpstreamProxy.parse(proxy)
+        self.index = index
+        self.proxies = list(index)
+        self.changed()
+
+    def changed(self):
+        # 列表变化后马上在后台重排，第一个连接到来时排名已经就绪
+        if self.proxies:
+            self.request_rank()
+
+    def counters(self):
+        with self.stats_lock:
+            return {proxy: (s.successes, s.failures, s.latency) for proxy, s in self.stats.items()}
+
+    def merge_counters(self, deltas):
+        # 汇总工作进程上报的增量，下一次重载时新进程从汇总后的统计开始
+        with self.stats_lock:
+            for proxy, (successes, failures, latency) in deltas.items():
+                s = self.stats_for(proxy)
+                s.successes += successes
+                s.failures += failures
+                if latency is not None:
+                    s.latency = latency
+
+    async def remove_proxies(self, dead: List[str]):
+        dead = {proxy for proxy in dead if proxy in self.index}
+        if not dead:
+            return
+        # 选择代理的线程可能正在遍历旧列表，这里换成新列表而不是原地删除
+        self.proxies = [proxy for proxy in self.proxies if proxy not in dead]
+        for proxy in dead:
+            self.index.pop(proxy, None)
+            self.stats.pop(proxy, None)
+        self.changed()
+        await self.append_log('-', dead)
+        log(f"Removed {len(dead)} proxies. Total proxies: {len(self.proxies)}")
+
+    async def add_proxies(self, new_proxies: List[str], quiet=False) -> List[str]:
+        added = []
+        index = self.index
+        with gc_paused():
+            for proxy in new_proxies:
+                if proxy not in index:
+                    index[proxy] = UpstreamProxy.parse(proxy)
+                    added.append(proxy)
+        self.proxies.extend(added)
+        if added:
+            self.changed()
+        await self.append_log('+', added)
+        if not quiet:
+            log(f"Added {len(added)} new proxies. Total proxies: {len(self.proxies)}")
+        return added
+
+    @property
+    def log_path(self):
+        return self.file_path + '.log'
+
+    async def append_log(self, op, proxies):
+        # 每次变更只追加 "+代理" / "-代理" 行，不再重写整个文件
+        if not proxies:
+            return
+        async with aiofiles.open(self.log_path, 'a') as f:
+            await f.write(''.join(f"{op}{proxy}\n" for proxy in proxies))
+        self.log_entries += len(proxies)
+        if self.log_entries > max(self.compact_min, len(self.proxies)):
+            await self.save_to_file()
 
     async def get_proxy(self) -> str:
         if not self.proxies:
             await self.load_from_file()
-        if self.proxies:
-            return random.choice(self.proxies)
-        return None
+        return self.select()
 
     async def refresh_proxies(self):
         # 这里我们只是重新加载文件中的代理，不进行有效性测试
@@ -207,72 +3847,364 @@ class ProxyPool:
         log(f"刷新代理完成。当前代理数量: {len(self.proxies)}")
 
     async def save_to_file(self):
-        async with aiofiles.open(self.file_path, 'w') as f:
-            await f.write(json.dumps(self.proxies, indent=2))
-        log(f"Saved {len(self.proxies)} proxies to {self.file_path}")
+        # 压缩：把当前列表写成新快照（先写临时文件再替换），然后清空变更日志
+        proxies = self.proxies
+        tmp_path = self.file_path + '.tmp'
+        async with aiofiles.open(tmp_path, 'w') as f:
+            await f.write(json.dumps(proxies))
+        os.replace(tmp_path, self.file_path)
+        async with aiofiles.open(self.log_path, 'w'):
+            pass
+        self.log_entries = 0
+        log(f"Saved {len(proxies)} proxies to {self.file_path}")
 
     async def load_from_file(self):
+        # 快照按块解析（JSON 快照、GUI 保存的旧格式和纯文本列表都可以），不把整个文件读进内存
+        proxies = []
         try:
-            async with aiofiles.open(self.file_path, 'r') as f:
-                content = await f.read()
-                if content.strip():
-                    self.proxies = json.loads(content)
-                else:
-                    self.proxies = []
-            log(f"Loaded {len(self.proxies)} proxies from {self.file_path}")
+            async for batch in iter_proxy_source(self.file_path):
+                proxies.extend(batch)
         except FileNotFoundError:
-            self.proxies = []
             log(f"Proxy file {self.file_path} not found. Starting with empty proxy list.")
-        except json.JSONDecodeError:
-            self.proxies = []
-            log(f"Error decoding JSON from {self.file_path}. Starting with empty proxy list.")
+        except ValueError as e:
+            log(f"Error parsing {self.file_path}: {e}. Starting with empty proxy list.", "ERROR")
+            proxies = []
+        self.replace(proxies)
+        # 重放快照之后的变更日志；快照替换后、日志清空前崩溃时重放也是幂等的
+        entries = 0
+        try:
+            async with aiofiles.open(self.log_path, 'r') as f:
+                lines = (await f.read()).splitlines()
+        except FileNotFoundError:
+            lines = []
+        index = self.index
+        with gc_paused():
+            for line in lines:
+                op, proxy = line[:1], line[1:]
+                if op == '+' and proxy not in index:
+                    index[proxy] = UpstreamProxy.parse(proxy)
+                elif op == '-':
+                    index.pop(proxy, None)
+                entries += 1
+        self.proxies = list(index)
+        self.changed()
+        self.log_entries = entries
+        log(f"Loaded {len(self.proxies)} proxies from {self.file_path}")
 
 proxy_pool = ProxyPool()
 
+class HealthChecker:
+    # 并发检测代理池：信号量限制同时在途的探测数，所有 HTTP 探测共用一个 connector
+    def __init__(self, pool: ProxyPool, concurrency=200, timeout=5, test_url='http://www.example.com/'):
+        self.pool = pool
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.test_url = test_url
+        target = urlsplit(test_url)
+        self.test_host = target.hostname
+        self.test_port = target.port or 80
+        self.test_path = target.path or '/'
+
+    async def check_all(self, proxies=None, on_result=None) -> Dict[str, bool]:
+        proxies = list(self.pool.proxies if proxies is None else proxies)
+        results: Dict[str, bool] = {}
+
+        def record(proxy, ok):
+            results[proxy] = ok
+            if on_result:
+                on_result(proxy, ok)
+
+        async def batches():
+            yield proxies
+
+        await self.check_stream(batches(), record)
+        return results
+
+    async def check_stream(self, batches, on_result=None):
+        # 检测异步产生的一批批代理（例如还在下载中的列表），结果只通过 on_result 回调给出
+        semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ssl=False)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            async def probe(proxy):
+                try:
+                    ok = await self.check(session, proxy)
+                    if on_result:
+                        on_result(proxy, ok)
+                finally:
+                    semaphore.release()
+
+            tasks = set()
+            async for proxies in batches:
+                for proxy in proxies:
+                    await semaphore.acquire()  # 只创建与并发数相当的任务，内存不随代理数量增长
+                    task = asyncio.ensure_future(probe(proxy))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def clean(self, on_result=None) -> List[str]:
+        results = await self.check_all(on_result=on_result)
+        dead = [proxy for proxy, ok in results.items() if not ok]
+        await self.pool.remove_proxies(dead)
+        return dead
+
+    async def check(self, session, proxy: str) -> bool:
+        stats = self.pool.stats_for(proxy)
+        upstream = upstream_for(proxy)
+        start = time.monotonic()
+        try:
+            if upstream.proxy_type == socks.HTTP:
+                async with session.get(self.test_url, proxy=upstream.url()) as response:
+                    ok = response.status == 200
+            elif upstream.proxy_type is not None:
+                ok = await asyncio.wait_for(self.check_socks(upstream), self.timeout)
+            else:
+                ok = False
+        except Exception:
+            ok = False
+        if ok:
+            stats.record_success(time.monotonic() - start)
+        else:
+            stats.record_failure()
+        return ok
+
+    async def check_socks(self, upstream):
+        # aiohttp 不支持 SOCKS 代理，这里直接完成 SOCKS4a/5 握手后发出一个 HTTP 请求
+        reader, writer = await asyncio.open_connection(upstream.host, upstream.port)
+        try:
+            host = self.test_host.encode()
+            port = self.test_port.to_bytes(2, 'big')
+            if upstream.proxy_type == socks.SOCKS4:
+                writer.write(b"\x04\x01" + port + b"\x00\x00\x00\x01\x00" + host + b"\x00")
+                reply = await reader.readexactly(8)
+                if reply[1] != 0x5a:
+                    return False
+            else:
+                if upstream.username:
+                    writer.write(b"\x05\x01\x02")
+                else:
+                    writer.write(b"\x05\x01\x00")
+                version, method = await reader.readexactly(2)
+                if method == 0x02 and upstream.username:
+                    user = upstream.username.encode()
+                    password = (upstream.password or '').encode()
+                    writer.write(bytes((1, len(user))) + user + bytes((len(password),)) + password)
+                    if (await reader.readexactly(2))[1] != 0:
+                        return False
+                elif method != 0x00:
+                    return False
+                writer.write(b"\x05\x01\x00\x03" + bytes((len(host),)) + host + port)
+                version, rep, _, address_type = await reader.readexactly(4)
+                if rep != 0:
+                    return False
+                if address_type == 1:
+                    await reader.readexactly(4 + 2)
+                elif address_type == 4:
+                    await reader.readexactly(16 + 2)
+                else:
+                    await reader.readexactly((await reader.readexactly(1))[0] + 2)
+            writer.write(f"GET {self.test_path} HTTP/1.0\r\nHost: {self.test_host}\r\n\r\n".encode())
+            status_line = await reader.readline()
+            return status_line.split(b" ")[1:2] == [b"200"]
+        finally:
+            writer.close()
+
+FETCH_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+# 大列表下载可能很久，只限制建立连接和两次读之间的间隔
+FETCH_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+
+class ProxyListParser:
+    # 增量解析代理列表：逗号/换行/空白分隔的文本，或 JSON（数组、{"proxies": [...]}，取其中所有不是键的字符串）。
+    # 每次 feed 一段文本，返回其中已经完整的条目，只保留末尾未完成的一小段
+    separators = re.compile(r'[\s,;]+')
+    json_string = re.compile(r'"((?:[^"\\]|\\.)*)"\s*(:?)', re.S)
+    max_entry = 4096  # 单个条目的长度上限，防止没有分隔符的输入让缓冲区无限增长
+
+    def __init__(self):
+        self.buffer = ''
+        self.mode = None  # 'text' 或 'json'，由第一个非空白字符决定
+
+    def feed(self, text, final=False) -> List[str]:
+        buffer = self.buffer + text
+        if self.mode is None:
+            buffer = buffer.lstrip('\ufeff \t\r\n')
+            if not buffer:
+                return []
+            self.mode = 'json' if buffer[0] in '[{' else 'text'
+        if self.mode == 'json':
+            return self.feed_json(buffer, final)
+        entries = self.separators.split(buffer)
+        self.buffer = '' if final else entries.pop()
+        if len(self.buffer) > self.max_entry:
+            self.buffer = ''
+        return [entry for entry in entries if self.valid(entry)]
+
+    def close(self) -> List[str]:
+        return self.feed('', final=True)
+
+    def feed_json(self, buffer, final):
+        # 只在字符串外部查找下一个引号，未闭合的字符串（或还看不到后面是否跟着冒号的）留到下一块
+        entries = []
+        pos = 0
+        while True:
+            start = buffer.find('"', pos)
+            if start < 0:
+                self.buffer = ''
+                break
+            match = self.json_string.match(buffer, start)
+            if match is None or (match.end() == len(buffer) and not final):
+                self.buffer = buffer[start:]
+                if len(self.buffer) > self.max_entry:
+                    raise ValueError("JSON string too long for a proxy entry")
+                break
+            pos = match.end()
+            if match.group(2):
+                continue  # 对象的键
+            value = match.group(1)
+            if '\\' in value:
+                value = json.loads(f'"{value}"')
+            if self.valid(value):
+                entries.append(value)
+        return entries
+
+    @staticmethod
+    def valid(entry):
+        # 按 UpstreamProxy.parse 的规则切分：主机非空且不含空白，端口是 1-65535；
+        # 没有协议的必须写明 host:port，这样 JSON 里像 "2024-01-01 10:00:00" 的值不会被当成代理
+        if '>' in entry:
+            return all(ProxyListParser.valid(hop) for hop in entry.split('>'))
+        scheme, sep, rest = entry.partition('://')
+        if sep and scheme.lower() not in UPSTREAM_TYPES:
+            return False
+        if not sep and not entry.rstrip('/').rpartition('@')[2].rpartition(':')[2].isdigit():
+            return False
+        try:
+            upstream = UpstreamProxy.parse(entry)
+        except ValueError:
+            return False
+        return bool(upstream.host) and not any(c.isspace() for c in upstream.host) and 0 < upstream.port < 65536
+
+async def iter_proxy_source(source, session=None, chunk_size=65536):
+    # 按块读取一个来源（http(s) URL 或本地文件），逐批产出解析出的代理
+    parser = ProxyListParser()
+    tail = ''
+    if source.startswith(('http://', 'https://')):
+        async with session.get(source, headers=FETCH_HEADERS) as response:
+            if response.status != 200:
+                raise ConnectionError(f"HTTP status {response.status}")
+            decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+            async for chunk in response.content.iter_chunked(chunk_size):
+                batch = parser.feed(decoder.decode(chunk))
+                if batch:
+                    yield batch
+            tail = decoder.decode(b'', True)
+    else:
+        async with aiofiles.open(source, 'r', errors='replace') as f:
+            while True:
+                chunk = await f.read(chunk_size)
+                if not chunk:
+                    break
+                batch = parser.feed(chunk)
+                if batch:
+                    yield batch
+    batch = parser.feed(tail, final=True)
+    if batch:
+        yield batch
+
+def proxy_sources(value):
+    # --upstream-url 可以重复给出；GUI 传入的是单个字符串
+    if not value:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+async def ingest_proxies(sources, pool: ProxyPool, checker=None, concurrency=4, queue_size=16) -> int:
+    # 流式导入：多个来源并发下载，边解析边去重按批加入代理池；给了 checker 时新代理经有界队列
+    # 同时送去健康检查（队列满时下载暂停），检测失败的在结束后移出代理池。
+    # 返回新增的代理数，所有来源都失败时抛出 ConnectionError
+    semaphore = asyncio.Semaphore(concurrency)
+    queue = asyncio.Queue(queue_size) if checker else None
+    dead = []
+    added = 0
+    failed = []
+
+    async def fetch(session, source):
+        nonlocal added
+        count = 0
+        async with semaphore:
+            log(f"开始从 {source} 导入代理")
+            try:
+                async for batch in iter_proxy_source(source, session):
+                    new = await pool.add_proxies(batch, quiet=True)
+                    count += len(new)
+                    if queue is not None and new:
+                        await queue.put(new)
+            except Exception as e:
+                failed.append(source)
+                log(f"从 {source} 导入代理时出错: {e}", "WARNING")
+        added += count
+        log(f"从 {source} 导入 {count} 个新代理，当前代理数量: {len(pool)}")
+
+    async def batches():
+        while (batch := await queue.get()) is not None:
+            yield batch
+
+    def on_result(proxy, ok):
+        if not ok:
+            dead.append(proxy)
+
+    async with aiohttp.ClientSession(timeout=FETCH_TIMEOUT) as session:
+        checking = asyncio.ensure_future(checker.check_stream(batches(), on_result)) if checker else None
+        try:
+            await asyncio.gather(*(fetch(session, source) for source in proxy_sources(sources)))
+        finally:
+            if checking:
+                await queue.put(None)
+                await checking
+    if dead:
+        await pool.remove_proxies(dead)
+    if failed and len(failed) == len(proxy_sources(sources)):
+        raise ConnectionError(f"all {len(failed)} proxy sources failed")
+    return added
+
 async def get_proxies_from_url(url):
+    # 返回去重后的列表；大列表应直接用 ingest_proxies 流式加入代理池
     log(f"开始从 URL 获取代理: {url}")
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
-    log(f"使用的 User-Agent: {headers['User-Agent']}")
-
-    async with aiohttp.ClientSession() as session:
+    async with aiohttp.ClientSession(timeout=FETCH_TIMEOUT) as session:
         for attempt in range(3):  # 尝试3次
+            proxies = {}
             try:
-                log(f"发送 GET 请求... (尝试 {attempt + 1}/3)")
+                log(f"发送 GET 请求... (尝试 {attempt + 1}/3)", "DEBUG")
                 start_time = time.time()
-                async with session.get(url, headers=headers, timeout=10) as response:
-                    end_time = time.time()
-                    log(f"请求耗时: {end_time - start_time:.2f} 秒")
-                    log(f"响应状态码: {response.status}")
-                    log(f"响应头: {response.headers}")
-                    
-                    if response.status == 200:
-                        content = await response.text()
-                        log(f"原始响应内容: {content}")
-                        proxy_list = content.strip().split(',')
-                        valid_proxies = [proxy.strip() for proxy in proxy_list if proxy.strip()]
-                        if valid_proxies:
-                            log(f"获取到 {len(valid_proxies)} 个有效代理地址")
-                            return valid_proxies
-                        else:
-                            log("响应中没有有效的代理地址")
-                    else:
-                        log(f"请求失败，状态码: {response.status}")
+                async for batch in iter_proxy_source(url, session):
+                    proxies.update(dict.fromkeys(batch))
+                log(f"请求耗时: {time.time() - start_time:.2f} 秒", "DEBUG")
+                if proxies:
+                    log(f"获取到 {len(proxies)} 个有效代理地址")
+                    return list(proxies)
+                log("响应中没有有效的代理地址", "WARNING")
             except asyncio.TimeoutError:
-                log(f"请求超时 (尝试 {attempt + 1}/3)")
+                log(f"请求超时 (尝试 {attempt + 1}/3)", "WARNING")
             except Exception as e:
-                log(f"发生错误: {str(e)} (尝试 {attempt + 1}/3)")
-            
+                log(f"发生错误: {str(e)} (尝试 {attempt + 1}/3)", "WARNING")
+
             if attempt < 2:  # 如果不是最后一次尝试，等待后重试
                 await asyncio.sleep(2)
-    
-    log("未能获取到有效的代理地址")
+
+    log("未能获取到有效的代理地址", "ERROR")
     return []
 
 def read_proxies_from_file(file_path):
-    with open(file_path, 'r') as f:
-        return [line.strip() for line in f if line.strip()]
+    parser = ProxyListParser()
+    proxies = {}
+    with open(file_path, 'r', errors='replace') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            proxies.update(dict.fromkeys(parser.feed(chunk)))
+    proxies.update(dict.fromkeys(parser.close()))
+    return list(proxies)
 
 def get_random_proxy_from_url(url):
     try:
@@ -280,34 +4212,27 @@ def get_random_proxy_from_url(url):
         if response.status_code == 200:
             return response.text.strip()
     except Exception as e:
-        log(f"Error fetching proxy from URL: {e}")
+        log(f"Error fetching proxy from URL: {e}", "ERROR")
     return None
 
 def parse_proxy_string(proxy_string):
-    if '://' not in proxy_string:
-        proxy_string = 'http://' + proxy_string
-    
-    parts = proxy_string.split('://')
-    proxy_type = parts[0].lower()
-    
-    if proxy_type in ['http', 'https']:
-        return {'http': proxy_string, 'https': proxy_string}
-    elif proxy_type == 'socks4':
-        return {'proxy_type': socks.SOCKS4, 'addr': parts[1].split(':')[0], 'port': int(parts[1].split(':')[1])}
-    elif proxy_type in ['socks5', 'socks']:
-        return {'proxy_type': socks.SOCKS5, 'addr': parts[1].split(':')[0], 'port': int(parts[1].split(':')[1])}
-    else:
+    # 返回 UpstreamProxy，协议不支持时返回 None
+    upstream = upstream_for(proxy_string.strip())
+    if upstream is None or upstream.proxy_type is None:
         return None
+    return upstream
 
 def get_upstream_proxy(args):
     if hasattr(args, 'upstream') and args.upstream:
         return args.upstream
     elif hasattr(args, 'upstream_file') and args.upstream_file:
+        proxy_pool.file_path = args.upstream_file
         asyncio.run(proxy_pool.load_from_file())
     elif hasattr(args, 'upstream_url') and args.upstream_url:
-        proxies = asyncio.run(get_proxies_from_url(args.upstream_url))
-        if proxies:
-            return random.choice(proxies)
+        try:
+            asyncio.run(ingest_proxies(args.upstream_url, proxy_pool, new_proxy_checker(args)))
+        except ConnectionError as e:
+            log(str(e), "ERROR")
     
     proxy = asyncio.run(proxy_pool.get_proxy())
     if proxy:
@@ -316,42 +4241,636 @@ def get_upstream_proxy(args):
         log("No valid upstream proxy found. Running in direct mode.")
         return None
 
-def log(message):
-    print(message)
-    # 如果在 GUI 模式下运行，可以将日志发送到 GUI
-    if hasattr(log, 'callback'):
-        log.callback(message)
+def health_checker(args):
+    # GUI 传入的 Namespace 没有 --check-* 参数，使用默认值
+    return HealthChecker(proxy_pool, concurrency=getattr(args, 'check_concurrency', 200),
+                         timeout=getattr(args, 'check_timeout', 5),
+                         test_url=getattr(args, 'check_url', 'http://www.example.com/'))
+
+def new_proxy_checker(args):
+    # --check-new：从 URL 导入的代理边下载边检测
+    return health_checker(args) if getattr(args, 'check_new', False) else None
+
+class PoolRefresher(threading.Thread):
+    # 代理池的后台调度线程，自带一个长期运行的事件循环，按 interval 定时执行：
+    #   refresh    重新拉取来源（没有来源时重新加载代理文件）
+    #   revalidate 检测最久没检测过的 revalidate_batch 个代理，失败的一次性移出（换成新列表，不原地修改）
+    # 每次间隔带随机抖动，连续失败时按指数退避。处理连接的线程只读取 pool.proxies 的当前引用，
+    # 不会被刷新阻塞；其它线程（GUI）用 submit() 把协程交给同一个循环执行
+    jitter = 0.1
+    max_backoff = 3600
+
+    def __init__(self, pool: ProxyPool, interval, upstream_url=None, checker=None, check_new=False, revalidate_batch=0):
+        super().__init__(name="pool-refresher", daemon=True)
+        self.pool = pool
+        self.interval = interval
+        self.sources = proxy_sources(upstream_url)
+        self.checker = checker
+        self.check_new = check_new
+        self.revalidate_batch = revalidate_batch
+        self.failures = collections.Counter()
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        if self.interval > 0:
+            self.loop.create_task(self.schedule('refresh', self.refresh))
+            if self.checker and self.revalidate_batch > 0:
+                self.loop.create_task(self.schedule('revalidate', self.revalidate))
+        try:
+            self.loop.run_forever()
+        finally:
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    def submit(self, coro):
+        # 返回 concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def delay(self, name):
+        delay = min(self.interval * 2 ** self.failures[name], max(self.max_backoff, self.interval))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def schedule(self, name, job):
+        while True:
+            await asyncio.sleep(self.delay(name))
+            try:
+                await job()
+                self.failures[name] = 0
+            except Exception as e:
+                self.failures[name] += 1
+                log(f"Proxy pool {name} failed ({self.failures[name]} in a row), backing off: {e}", "ERROR")
+
+    async def refresh(self):
+        if self.sources:
+            await ingest_proxies(self.sources, self.pool, self.checker if self.check_new else None)
+        else:
+            await self.pool.refresh_proxies()
+        self.pool.last_refresh = time.time()
+
+    async def revalidate(self):
+        stats = self.pool.stats
+
+        def last_checked(proxy):
+            s = stats.get(proxy)
+            return s.last_checked if s else 0.0
+
+        batch = heapq.nsmallest(self.revalidate_batch, self.pool.proxies, key=last_checked)
+        if not batch:
+            return
+        results = await self.checker.check_all(batch)
+        dead = [proxy for proxy, ok in results.items() if not ok]
+        if len(batch) > 1 and len(dead) == len(batch):
+            # 全部失败更可能是本机网络或检测地址的问题，保留代理并退避
+            raise ConnectionError(f"all {len(batch)} probes failed, keeping the entries")
+        await self.pool.remove_proxies(dead)
+        log(f"Revalidated {len(batch)} stalest proxies, removed {len(dead)}", "DEBUG")
+
+    def stop(self):
+        if self.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'CRITICAL': 50}
+LOG_LEVEL_NAMES = {v: k for k, v in LOG_LEVELS.items()}
+
+class LogWriter(threading.Thread):
+    # 后台日志线程：log() 只判断级别并把记录放进 SimpleQueue，格式化、限流和写出都在这里批量完成
+    batch_size = 512
+    flush_interval = 0.1
+    digits = re.compile(r'\d+')
+
+    def __init__(self):
+        super().__init__(name="log-writer", daemon=True)
+        self.queue = queue.SimpleQueue()
+        self.level = LOG_LEVELS['INFO']
+        self.json_format = False
+        self.rate_limit = 20  # 每个窗口内同类消息最多输出的条数，0 表示不限流
+        self.rate_window = 10
+        self.recent = {}  # 同类消息 -> [窗口开始时间, 条数, 被丢弃条数, 级别, 示例]
+        self.last_sweep = time.monotonic()
+        self.started = False
+        self.lock = threading.Lock()
+
+    def put(self, record):
+        if not self.started:
+            with self.lock:
+                if not self.started:
+                    self.started = True
+                    self.start()
+                    atexit.register(self.close)
+        self.queue.put(record)
+
+    def close(self):
+        # 进程退出前把队列中剩余的日志写完
+        self.queue.put(None)
+        self.join(timeout=2)
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.write([record for record in batch if record is not None])
+            except Exception:
+                pass  # 日志写出失败不能影响代理本身
+            if None in batch:
+                return
+
+    def write(self, records):
+        now = time.monotonic()
+        out = []
+        for timestamp, level, message, fields in records:
+            if self.allow(level, message, now, out):
+                out.append((timestamp, level, message, fields))
+        if now - self.last_sweep >= self.rate_window:
+            self.last_sweep = now
+            for key, entry in list(self.recent.items()):
+                if now - entry[0] >= self.rate_window:
+                    del self.recent[key]
+                    self.summarize(entry, out)
+        if not out:
+            return
+        sys.stdout.write(''.join(self.format(*record) for record in out))
+        sys.stdout.flush()
+        callback = getattr(log, 'callback', None)
+        if callback:
+            for _, level, message, _ in out:
+                callback(message, LOG_LEVEL_NAMES.get(level, 'INFO'))
+
+    def allow(self, level, message, now, out):
+        # 同类消息（忽略其中的数字）在一个窗口内只输出 rate_limit 条
+        if not self.rate_limit:
+            return True
+        key = (level, self.digits.sub('#', message))
+        entry = self.recent.get(key)
+        if entry is None or now - entry[0] >= self.rate_window:
+            if entry:
+                self.summarize(entry, out)
+            self.recent[key] = [now, 1, 0, level, message]
+            return True
+        entry[1] += 1
+        if entry[1] > self.rate_limit:
+            entry[2] += 1
+            return False
+        return True
+
+    @staticmethod
+    def summarize(entry, out):
+        if entry[2]:
+            out.append((time.time(), entry[3], f"Suppressed {entry[2]} similar messages: {entry[4]}", {}))
+
+    def format(self, timestamp, level, message, fields):
+        name = LOG_LEVEL_NAMES.get(level, 'INFO')
+        if self.json_format:
+            return json.dumps({'ts': round(timestamp, 3), 'level': name, 'msg': message, **fields},
+                              ensure_ascii=False, default=str) + "\n"
+        extra = ''.join(f" {k}={v}" for k, v in fields.items())
+        return f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))} [{name}] {message}{extra}\n"
+
+log_writer = LogWriter()
 
-def create_server(args):
-    upstream_proxy = get_upstream_proxy(args)
+def log(message, level='INFO', **fields):
+    # 低于当前级别的日志直接丢弃；其余交给后台线程写出
+    # 如果在 GUI 模式下运行，后台线程会通过 log.callback 把日志发送到 GUI
+    levelno = LOG_LEVELS.get(level, LOG_LEVELS['INFO'])
+    if levelno >= log_writer.level:
+        log_writer.put((time.time(), levelno, str(message), fields))
+
+def set_log_level(level):
+    log_writer.level = LOG_LEVELS[level.upper()]
+
+def configure_logging(args):
+    set_log_level(getattr(args, 'log_level', None) or 'INFO')
+    log_writer.json_format = getattr(args, 'log_json', False)
+    log_writer.rate_limit = getattr(args, 'log_rate_limit', log_writer.rate_limit)
+
+def create_server(args, snapshot=None):
+    global RELAY_MODE, RELAY_WORKERS, ROTATE_MODE, CONNECT_TIMEOUT, FAILOVER_ATTEMPTS, FAILOVER_DEADLINE
+    global RACE_COUNT, RACE_STAGGER, SOCKS_USERS, warm_pool, route_rules, http_cache
+    RELAY_MODE = getattr(args, 'relay', None) or RELAY_MODE
+    RELAY_WORKERS = getattr(args, 'relay_workers', RELAY_WORKERS)
+    ROTATE_MODE = getattr(args, 'rotate', None) or 'off'
+    CONNECT_TIMEOUT = getattr(args, 'connect_timeout', CONNECT_TIMEOUT)
+    FAILOVER_ATTEMPTS = max(1, getattr(args, 'failover_attempts', FAILOVER_ATTEMPTS))
+    FAILOVER_DEADLINE = getattr(args, 'failover_deadline', FAILOVER_DEADLINE)
+    RACE_COUNT = getattr(args, 'race', RACE_COUNT)
+    RACE_STAGGER = getattr(args, 'race_stagger', RACE_STAGGER)
+    SOCKS_USERS = dict(entry.partition(':')[::2] for entry in getattr(args, 'socks_auth', None) or ())
+    dns_resolver.max_size = getattr(args, 'dns_cache', dns_resolver.max_size)
+    dns_resolver.ttl = getattr(args, 'dns_ttl', dns_resolver.ttl)
+    if getattr(args, 'warm_pool', 0) > 0 and warm_pool is None:
+        warm_pool = WarmPool(min_size=args.warm_pool, max_size=max(args.warm_pool, getattr(args, 'warm_max', 32)),
+                             idle_timeout=getattr(args, 'warm_idle', 10))
+        warm_pool.start()
+    CircuitBreaker.threshold = getattr(args, 'breaker_threshold', CircuitBreaker.threshold)
+    CircuitBreaker.reset_timeout = getattr(args, 'breaker_reset', CircuitBreaker.reset_timeout)
+    proxy_pool.set_strategy(getattr(args, 'strategy', None) or 'random')
+    configure_limits(args)
+    if snapshot:
+        # 工作进程：沿用父进程已经加载好的代理池和上游，不再重复读取文件或请求 URL
+        upstream_proxy, pool_snapshot = snapshot
+        proxy_pool.restore(pool_snapshot)
+    else:
+        upstream_proxy = get_upstream_proxy(args)
+    if getattr(args, 'routes', None):
+        route_rules = load_routes(args.routes)
+        log(f"Loaded {len(route_rules)} routing rules and {len(route_rules.pools)} pools from {args.routes}")
+
+    if args.type in ('http', 'mixed'):
+        # 单端口模式的 HTTP/CONNECT 与 SOCKS5 使用同一份认证，否则开启认证后同一端口仍是开放代理
+        ProxyHandler.users = SOCKS_USERS if args.type == 'mixed' else {}
+        ProxyHandler.upstream_proxy = upstream_proxy
+        ProxyHandler.upstream_name = upstream_proxy
+        ProxyHandler.sessions = UpstreamSessions(
+            pool_size=getattr(args, 'pool_size', 32),
+            idle_timeout=getattr(args, 'pool_idle', 120),
+            retries=getattr(args, 'retries', 2))
+        cache_size, cache_dir = getattr(args, 'cache_size', 0), getattr(args, 'cache_dir', None)
+        if (cache_size > 0 or cache_dir) and http_cache is None:
+            disk = DiskCache(cache_dir, getattr(args, 'cache_disk_size', 1 << 30)) if cache_dir else None
+            http_cache = HttpCache(cache_size, getattr(args, 'cache_max_object', 16 << 20), disk)
 
     if args.type == 'http':
-        server = ThreadingHTTPServer(('0.0.0.0', args.port), ProxyHandler)
+        server = ThreadingHTTPServer(('0.0.0.0', args.port), ProxyHandler, backlog=getattr(args, 'backlog', None) or 128)
         server.upstream_proxy = upstream_proxy
-        ProxyHandler.upstream_proxy = upstream_proxy
         log(f"Starting HTTP proxy on 0.0.0.0:{args.port}")
-    else:  # socks5
-        server = SocksProxy('0.0.0.0', args.port, upstream_proxy)
-        log(f"Starting SOCKS5 proxy on 0.0.0.0:{args.port}")
+    else:  # socks5 或 mixed
+        backlog = getattr(args, 'backlog', None)
+        if getattr(args, 'engine', 'thread') == 'asyncio':
+            server = AsyncSocksProxy('0.0.0.0', args.port, upstream_proxy, backlog=backlog or 1024, upstream_name=upstream_proxy)
+        else:
+            server = SocksProxy('0.0.0.0', args.port, upstream_proxy, backlog=backlog or 128, upstream_name=upstream_proxy)
+        if args.type == 'mixed':
+            # 同一个端口按第一个字节分流；HTTP 连接借用这个不监听的服务器对象来运行 ProxyHandler
+            server.http_server = ThreadingHTTPServer(('0.0.0.0', args.port), ProxyHandler, bind_and_activate=False)
+            server.http_server.socket.close()
+            log(f"Starting SOCKS5 and HTTP proxy on 0.0.0.0:{args.port}")
+        else:
+            log(f"Starting SOCKS5 proxy on 0.0.0.0:{args.port}")
         # 注意：我们不再在这里调用 server.start()
 
-    if upstream_proxy:
+    if ROTATE_MODE != 'off':
+        log(f"Rotating upstream proxies per {ROTATE_MODE} across {len(proxy_pool.proxies)} proxies")
+    elif upstream_proxy:
         log(f"Using upstream proxy: {upstream_proxy}")
     else:
         log("No valid upstream proxy found. Running in direct mode.")
 
+    server.metrics_server = None
+    if getattr(args, 'metrics_port', None):
+        server.metrics_server = start_metrics_server(getattr(args, 'metrics_host', '0.0.0.0'), args.metrics_port)
+
+    refresh = getattr(args, 'upstream_refresh', None) or getattr(args, 'refresh', 0)
+    server.refresher = None
+    if refresh > 0:
+        proxy_pool.refresh_interval = refresh
+        server.refresher = PoolRefresher(proxy_pool, refresh, getattr(args, 'upstream_url', None), health_checker(args),
+                                         getattr(args, 'check_new', False), getattr(args, 'revalidate_batch', 100))
+        server.refresher.start()
+
     return server
 
+def check_pool(args):
+    checker = health_checker(args)
+
+    async def run():
+        await proxy_pool.load_from_file()
+        total = len(proxy_pool.proxies)
+        start = time.monotonic()
+        dead = await checker.clean()
+        log(f"Checked {total} proxies in {time.monotonic() - start:.1f}s, removed {len(dead)}")
+        if args.upstream_url:
+            # 新来源的代理边下载边检测，只有通过的留在代理池里
+            start = time.monotonic()
+            try:
+                added = await ingest_proxies(args.upstream_url, proxy_pool, checker)
+                log(f"Imported {added} proxies in {time.monotonic() - start:.1f}s, {len(proxy_pool)} in pool")
+            except ConnectionError as e:
+                log(str(e), "ERROR")
+        for proxy in proxy_pool.proxies:
+            print(json.dumps({'proxy': proxy, **proxy_pool.stats_for(proxy).to_dict()}))
+
+    asyncio.run(run())
+
+def stop_server(server):
+    if isinstance(server, ThreadingHTTPServer):
+        server.shutdown()
+        server.server_close()
+    else:
+        server.stop()
+
+def run_worker(args, snapshot, conn, drain_timeout):
+    # 工作进程入口：SIGTERM 时停止接受新连接，等待已有隧道结束（最多 drain_timeout 秒）后退出
+    global REUSE_PORT
+    REUSE_PORT = True
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C 由父进程统一处理
+    configure_logging(args)
+    metrics.enabled = True
+    server = create_server(args, snapshot)
+    draining = threading.Event()
+
+    def drain(signum, frame):
+        if not draining.is_set():
+            draining.set()
+            threading.Thread(target=stop_server, args=(server,), daemon=True).start()
+
+    signal.signal(signal.SIGTERM, drain)
+    sent = {}
+    send_lock = threading.Lock()
+
+    def report():
+        counters = proxy_pool.counters()
+        deltas = {}
+        for proxy, (successes, failures, latency) in counters.items():
+            last = sent.get(proxy, (0, 0, None))
+            if (successes, failures, latency) != last:
+                deltas[proxy] = (successes - last[0], failures - last[1], latency)
+        sent.update(counters)
+        with send_lock:
+            conn.send(('report', os.getpid(), metrics.totals(), deltas))
+
+    def reporter():
+        parent = multiprocessing.parent_process()
+        while not draining.wait(WorkerSupervisor.report_interval):
+            if parent and not parent.is_alive():
+                drain(None, None)  # 父进程意外退出，工作进程也随之停止
+                return
+            try:
+                report()
+            except (OSError, EOFError):
+                return
+
+    conn.send(('ready', os.getpid(), None, None))
+    baseline = proxy_pool.counters()  # 快照中的统计已经在父进程里，只上报之后的增量
+    sent.update(baseline)
+    threading.Thread(target=reporter, name="worker-report", daemon=True).start()
+    try:
+        if isinstance(server, ThreadingHTTPServer):
+            server.serve_forever()
+        else:
+            server.run()
+    finally:
+        deadline = time.monotonic() + drain_timeout
+        while metrics.active_tunnels() > 0 and time.monotonic() < deadline:
+            time.sleep(0.2)
+        try:
+            report()
+        except (OSError, EOFError):
+            pass
+        conn.close()
+
+class WorkerSupervisor:
+    # --workers N：N 个工作进程以 SO_REUSEPORT 绑定同一端口，父进程只负责启动、汇总统计、重载和退出
+    # SIGHUP 平滑重载：先启动新一批进程，就绪后再让旧进程停止接受连接并等待隧道结束
+    report_interval = 1
+    summary_interval = 60
+
+    def __init__(self, args, count, drain_timeout=30):
+        self.args = args
+        self.count = count
+        self.drain_timeout = drain_timeout
+        # 父进程已经有日志、指标等线程，用 spawn 启动干净的子进程，避免在多线程进程中 fork
+        self.context = multiprocessing.get_context('spawn')
+        self.upstream_proxy = None
+        self.workers = {}  # pid -> (process, conn)
+        self.draining = {}  # pid -> (process, conn, kill_at)
+        self.ready = set()
+        self.reports = {}  # pid -> 最近一次上报的指标
+        self.retired = {}  # 已退出进程的累计指标（不含 gauge）
+        self.lock = threading.Lock()
+        self.reload_requested = False
+        self.stopping = False
+
+    def collect(self):
+        with self.lock:
+            totals = {}
+            Metrics.merge(totals, self.retired)
+            for report in self.reports.values():
+                Metrics.merge(totals, report)
+        return totals.items()
+
+    def spawn(self):
+        parent_conn, child_conn = self.context.Pipe(duplex=False)
+        process = self.context.Process(
+            target=run_worker, name="proxy-worker",
+            args=(self.worker_args(), (self.upstream_proxy, proxy_pool.snapshot()), child_conn, self.drain_timeout))
+        process.start()
+        child_conn.close()
+        self.workers[process.pid] = (process, parent_conn)
+        return process.pid
+
+    def worker_args(self):
+        args = argparse.Namespace(**vars(self.args))
+        args.workers = 1
+        args.metrics_port = None  # 指标由父进程汇总后统一提供
+        args.upstream_refresh = 0  # 代理池只在父进程刷新，重载时随快照下发
+        return args
+
+    def limits_changed(self, settings):
+        # 限速在工作进程中执行：写回参数后平滑重载，新进程按新的限制启动，旧进程上的隧道保持原限制直到结束
+        for name, value in settings.items():
+            setattr(self.args, name, value)
+        self.reload_requested = True
+
+    def run(self):
+        self.upstream_proxy = get_upstream_proxy(self.args)
+        configure_limits(self.args)
+        rate_limits.on_change = self.limits_changed
+        metrics.collectors.append(self.collect)
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, 'reload_requested', True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, 'stopping', True))
+        for _ in range(self.count):
+            self.spawn()
+        log(f"Started {self.count} workers on port {self.args.port}")
+        next_summary = time.monotonic() + self.summary_interval
+        try:
+            while not self.stopping:
+                self.poll(self.report_interval)
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload()
+                if time.monotonic() >= next_summary:
+                    next_summary += self.summary_interval
+                    self.summary()
+        finally:
+            self.stopping = True
+            self.shutdown()
+
+    def poll(self, timeout):
+        conns = [entry[1] for entry in list(self.workers.values()) + list(self.draining.values()) if not entry[1].closed]
+        for conn in multiprocessing.connection.wait(conns, timeout):
+            try:
+                kind, pid, totals, deltas = conn.recv()
+            except (EOFError, OSError):
+                conn.close()
+                continue
+            if kind == 'ready':
+                self.ready.add(pid)
+                continue
+            with self.lock:
+                self.reports[pid] = totals
+            if deltas:
+                proxy_pool.merge_counters(deltas)
+        self.reap()
+
+    def reap(self):
+        now = time.monotonic()
+        for pid, (process, conn) in list(self.workers.items()):
+            if not process.is_alive():
+                del self.workers[pid]
+                self.retire(pid, conn)
+                if not self.stopping:
+                    log(f"Worker {pid} exited with code {process.exitcode}, starting a replacement", "WARNING")
+                    self.spawn()
+        for pid, (process, conn, kill_at) in list(self.draining.items()):
+            if not process.is_alive():
+                del self.draining[pid]
+                self.retire(pid, conn)
+            elif now >= kill_at:
+                process.kill()
+
+    def retire(self, pid, conn):
+        # 读完进程退出前的最后一次上报，再把它的计数并入累计值
+        while not conn.closed and conn.poll():
+            try:
+                kind, _, totals, deltas = conn.recv()
+            except (EOFError, OSError):
+                break
+            if kind == 'report':
+                with self.lock:
+                    self.reports[pid] = totals
+                if deltas:
+                    proxy_pool.merge_counters(deltas)
+        conn.close()
+        self.ready.discard(pid)
+        with self.lock:
+            report = self.reports.pop(pid, {})
+            counters = {key: value for key, value in report.items()
+                        if METRIC_HELP.get(key[0], ('counter',))[0] != 'gauge'}
+            Metrics.merge(self.retired, counters)
+
+    def reload(self):
+        if getattr(self.args, 'upstream_file', None):
+            asyncio.run(proxy_pool.load_from_file())
+        old = dict(self.workers)
+        self.workers = {}
+        new = [self.spawn() for _ in range(self.count)]
+        log(f"Reloading: started {len(new)} new workers, draining {len(old)}")
+        deadline = time.monotonic() + 30
+        while not all(pid in self.ready for pid in new) and time.monotonic() < deadline and not self.stopping:
+            # 旧进程在新进程就绪前继续接受连接
+            self.workers.update(old)
+            self.poll(0.2)
+            for pid in old:
+                self.workers.pop(pid, None)
+        self.drain(old)
+
+    def drain(self, workers):
+        kill_at = time.monotonic() + self.drain_timeout + 5
+        for pid, (process, conn) in workers.items():
+            if process.is_alive():
+                os.kill(pid, signal.SIGTERM)
+            self.draining[pid] = (process, conn, kill_at)
+
+    def shutdown(self):
+        log(f"Stopping {len(self.workers)} workers, waiting up to {self.drain_timeout}s for tunnels to finish")
+        self.drain(self.workers)
+        self.workers = {}
+        while self.draining:
+            self.poll(0.2)
+        self.summary()
+
+    def summary(self):
+        totals = dict(self.collect())
+        def total(name):
+            return sum(value for (metric, _), value in totals.items() if metric == name)
+        log(f"Workers: {len(self.workers)} running, {len(self.draining)} draining; "
+            f"active tunnels {total('sockstools_active_tunnels')}, connects {total('sockstools_connects_total')}, "
+            f"bytes {total('sockstools_bytes_total')}")
+
 def main(args=None):
     if args is None:
         parser = argparse.ArgumentParser(description="Simple HTTP and SOCKS5 Proxy with Upstream Support")
-        parser.add_argument('--type', choices=['http', 'socks5'], default='http', help='Proxy type (default: http)')
+        parser.add_argument('--type', choices=['http', 'socks5', 'mixed'], default='http', help='Proxy type; mixed serves SOCKS5 and HTTP on one port (default: http)')
         parser.add_argument('--port', type=int, default=8080, help='Bind port (default: 8080)')
-        parser.add_argument('--upstream', help='Upstream proxy address (e.g., http://1.2.3.4:8080 or socks5://1.2.3.4:1080)')
+        parser.add_argument('--upstream', help='Upstream proxy address (e.g., http://1.2.3.4:8080 or socks5://1.2.3.4:1080); join several with ">" to chain them')
+        parser.add_argument('--routes', help='Routing rules file: per-domain/CIDR/port actions (direct, block, pool, pool:NAME, via UPSTREAM or a>b chain)')
         parser.add_argument('--upstream-file', help='File containing upstream proxy addresses')
-        parser.add_argument('--upstream-url', help='URL to fetch random proxy addresses')
-        parser.add_argument('--upstream-refresh', type=int, default=0, help='Refresh upstream proxy every N seconds (0 to disable)')
+        parser.add_argument('--upstream-url', action='append', help='URL (or file) with proxy addresses as comma/newline-separated text or JSON; repeat to fetch several concurrently')
+        parser.add_argument('--upstream-refresh', type=int, default=0, help='Refetch sources and revalidate the proxy pool every N seconds in the background (0 to disable)')
+        parser.add_argument('--engine', choices=['thread', 'asyncio'], default='thread', help='SOCKS5 and mixed server engine (default: thread)')
+        parser.add_argument('--socks-auth', action='append', metavar='USER:PASS', help='Require SOCKS5 username/password authentication (and Basic Proxy-Authorization on a mixed port); repeat for several users')
+        parser.add_argument('--relay', choices=['auto', 'splice', 'copy'], default='auto', help='Tunnel relay mode: kernel splice or buffered copy (default: auto)')
+        parser.add_argument('--relay-workers', type=int, default=RELAY_WORKERS, help='Threads in the shared epoll relay reactor, 0 for one thread per tunnel (default: %(default)s)')
+        parser.add_argument('--pool-size', type=int, default=32, help='Keep-alive connections per upstream host for HTTP forwarding (default: 32)')
+        parser.add_argument('--pool-idle', type=int, default=120, help='Close upstream sessions idle for N seconds (default: 120)')
+        parser.add_argument('--retries', type=int, default=2, help='Connect retries for HTTP forwarding (default: 2)')
+        parser.add_argument('--cache-size', type=byte_rate, default=0, help='Memory budget of the HTTP response cache, with k/m/g suffixes (default: 0, off)')
+        parser.add_argument('--cache-dir', help='Directory for the on-disk HTTP cache tier; entries evicted from memory move there')
+        parser.add_argument('--cache-disk-size', type=byte_rate, default=1 << 30, help='Byte budget of the on-disk cache tier (default: 1g)')
+        parser.add_argument('--cache-max-object', type=byte_rate, default=16 << 20, help='Largest response body the cache stores (default: 16m)')
+        parser.add_argument('--rotate', choices=['off', 'connection', 'host'], default='off', help='Draw an upstream from the pool for every connection, or per target host (default: off)')
+        parser.add_argument('--connect-timeout', type=float, default=CONNECT_TIMEOUT, help='Timeout for each upstream connect attempt in seconds (default: %(default)s)')
+        parser.add_argument('--failover-attempts', type=int, default=FAILOVER_ATTEMPTS, help='Upstreams to try before giving up on a connection (default: %(default)s)')
+        parser.add_argument('--failover-deadline', type=float, default=FAILOVER_DEADLINE, help='Overall time budget for upstream failover in seconds (default: %(default)s)')
+        parser.add_argument('--race', type=int, default=RACE_COUNT, help='Race each connect through this many of the healthiest upstreams and keep the first (default: %(default)s, off)')
+        parser.add_argument('--race-stagger', type=float, default=RACE_STAGGER, help='Delay between starting raced connect attempts in seconds (default: %(default)s)')
+        parser.add_argument('--warm-pool', type=int, default=0, help='Keep at least N pre-authenticated sessions to each busy SOCKS upstream (default: 0, off)')
+        parser.add_argument('--warm-max', type=int, default=32, help='Upper bound for pre-warmed sessions per upstream (default: 32)')
+        parser.add_argument('--warm-idle', type=float, default=10, help='Recycle pre-warmed sessions idle for N seconds (default: 10)')
+        parser.add_argument('--dns-cache', type=int, default=1024, help='Resolved hostnames kept in the DNS cache for direct connects, 0 to disable (default: 1024)')
+        parser.add_argument('--dns-ttl', type=float, default=60, help='Seconds a resolved hostname stays cached (default: 60)')
+        parser.add_argument('--breaker-threshold', type=int, default=CircuitBreaker.threshold, help='Consecutive failures that open an upstream circuit breaker (default: %(default)s)')
+        parser.add_argument('--breaker-reset', type=float, default=CircuitBreaker.reset_timeout, help='Seconds before an open breaker lets a probe through (default: %(default)s)')
+        parser.add_argument('--strategy', choices=sorted(SELECTION_STRATEGIES), default='random', help='Upstream selection strategy for the proxy pool (default: random)')
+        parser.add_argument('--check-pool', action='store_true', help='Health-check the proxy pool, drop dead entries and exit')
+        parser.add_argument('--check-concurrency', type=int, default=200, help='Concurrent health-check probes (default: 200)')
+        parser.add_argument('--check-timeout', type=float, default=5, help='Health-check probe timeout in seconds (default: 5)')
+        parser.add_argument('--check-url', default='http://www.example.com/', help='URL fetched through each proxy by the health check')
+        parser.add_argument('--revalidate-batch', type=int, default=100, help='Stalest pool entries re-checked every --upstream-refresh interval, 0 to disable (default: 100)')
+        parser.add_argument('--check-new', action='store_true', help='Health-check proxies imported from --upstream-url while they stream in and drop dead ones')
+        parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port (default: off)')
+        parser.add_argument('--metrics-host', default='0.0.0.0', help='Bind address for the metrics endpoint (default: 0.0.0.0)')
+        parser.add_argument('--log-level', choices=list(LOG_LEVELS), default='INFO', help='Minimum level written to the log (default: INFO)')
+        parser.add_argument('--log-json', action='store_true', help='Write logs as JSON lines')
+        parser.add_argument('--log-rate-limit', type=int, default=20, help='Similar messages allowed per 10 s before the rest are suppressed, 0 for no limit (default: 20)')
+        parser.add_argument('--workers', type=int, default=1, help='Run N listener processes sharing the port with SO_REUSEPORT (default: 1)')
+        parser.add_argument('--drain-timeout', type=float, default=30, help='Seconds a stopping worker waits for open tunnels to finish (default: 30)')
+        parser.add_argument('--global-rate', type=byte_rate, default=0, help='Total relay bandwidth in bytes/s, with k/m/g suffixes, 0 for no limit (default: 0)')
+        parser.add_argument('--client-rate', type=byte_rate, default=0, help='Relay bandwidth per client IP in bytes/s (default: 0, no limit)')
+        parser.add_argument('--upstream-rate', type=byte_rate, default=0, help='Relay bandwidth per upstream proxy in bytes/s (default: 0, no limit)')
+        parser.add_argument('--client-connections', type=int, default=0, help='Concurrent tunnels and requests per client IP (default: 0, no limit)')
+        parser.add_argument('--backlog', type=int, help='Listen backlog (default: 128 for thread, 1024 for asyncio)')
         args = parser.parse_args()
+    configure_logging(args)
+
+    if getattr(args, 'check_pool', False):
+        check_pool(args)
+        return
+
+    if getattr(args, 'workers', 1) > 1:
+        if hasattr(socket, 'SO_REUSEPORT'):
+            supervisor = WorkerSupervisor(args, args.workers, args.drain_timeout)
+            if getattr(args, 'metrics_port', None):
+                start_metrics_server(getattr(args, 'metrics_host', '0.0.0.0'), args.metrics_port)
+            if getattr(args, 'upstream_refresh', 0) > 0:
+                proxy_pool.refresh_interval = args.upstream_refresh
+                PoolRefresher(proxy_pool, args.upstream_refresh, args.upstream_url, health_checker(args),
+                              args.check_new, args.revalidate_batch).start()
+            supervisor.run()
+            return
+        log("SO_REUSEPORT is not available on this platform, running a single process", "WARNING")
 
     server = create_server(args)
 
@@ -361,6 +4880,10 @@ def main(args=None):
         else:
             server.run()
     except KeyboardInterrupt:
+        if server.refresher:
+            server.refresher.stop()
+        if server.metrics_server:
+            server.metrics_server.shutdown()
         log("Proxy server stopped.")
 
 if __name__ == "__main__":
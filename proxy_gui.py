@@ -6,13 +6,10 @@ import argparse
 import time
 import queue
 import asyncio
-import random
 import os
-import json
-import aiohttp
 import atexit
 
-from proxy import ThreadingHTTPServer, SocksProxy, ProxyPool, get_proxies_from_url, parse_proxy_string
+from proxy import ThreadingHTTPServer, SocksProxy, HealthChecker, get_proxies_from_url, parse_proxy_string
 
 class ProxyGUI:
     def __init__(self, master):
@@ -35,7 +32,12 @@ class ProxyGUI:
         self.stop_event = threading.Event()
         self.log_queue = queue.Queue()
         self.after_id = None
-        self.proxy_pool = ProxyPool()
+        self.proxy_pool = proxy.proxy_pool  # 与代理服务器共享同一个代理池及其统计
+        # 代理池操作都交给这个长期运行的事件循环，不再每次用 asyncio.run 新建循环
+        self.scheduler = proxy.PoolRefresher(self.proxy_pool, 0)
+        self.scheduler.start()
+        proxy.set_log_level(self.log_level.get())
+        proxy.log.callback = self.queue_log_message  # 代理服务器的日志也显示在日志区域
         self.load_proxies_from_file()
 
         self.master.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -47,7 +49,7 @@ class ProxyGUI:
         self.type_frame.pack(fill=tk.X, pady=2)
         ttk.Label(self.type_frame, text="代理类型:").pack(side=tk.LEFT)
         self.type_var = tk.StringVar(value="http")
-        ttk.Combobox(self.type_frame, textvariable=self.type_var, values=["http", "socks5"]).pack(side=tk.LEFT, expand=True, fill=tk.X)
+        ttk.Combobox(self.type_frame, textvariable=self.type_var, values=["http", "socks5", "mixed"]).pack(side=tk.LEFT, expand=True, fill=tk.X)
 
         # 端口输入
         self.port_frame = ttk.Frame(parent)
@@ -149,7 +151,7 @@ class ProxyGUI:
 
         parsed_proxy = parse_proxy_string(new_proxy)
         if parsed_proxy:
-            self.update_proxy(parsed_proxy)
+            self.update_proxy(parsed_proxy, new_proxy)
             self.queue_log_message(f"手动更改代理为: {new_proxy}", "INFO")
         else:
             self.queue_log_message("无效的代理地址格式", "ERROR")
@@ -165,15 +167,15 @@ class ProxyGUI:
     def _refresh_proxy_thread(self):
         try:
             args = argparse.Namespace(upstream_url=self.upstream_url_var.get())
-            new_proxies = asyncio.run(get_proxies_from_url(args.upstream_url))
+            new_proxies = self.run_async(get_proxies_from_url(args.upstream_url))
             if new_proxies:
-                asyncio.run(self.proxy_pool.add_proxies(new_proxies))
+                self.run_async(self.proxy_pool.add_proxies(new_proxies))
                 self.queue_log_message(f"成功获取并添加 {len(new_proxies)} 个新代理到代理池", "INFO")
                 self.save_proxies_to_file()
-                valid_proxy = asyncio.run(self.proxy_pool.get_proxy())
+                valid_proxy = self.run_async(self.proxy_pool.get_proxy())
                 if valid_proxy:
                     new_proxy = parse_proxy_string(valid_proxy)
-                    self.update_proxy(new_proxy)
+                    self.update_proxy(new_proxy, valid_proxy)
                     self.queue_log_message("成功获取新的有效代理", "INFO")
                     self.master.after(0, self.update_proxy_count)
                 else:
@@ -183,22 +185,21 @@ class ProxyGUI:
         except Exception as e:
             self.queue_log_message(f"获取新代理时发生错误: {str(e)}", "ERROR")
 
-    def update_proxy(self, new_proxy):
+    def update_proxy(self, new_proxy, proxy_str=None):
         if self.proxy_server:
             if isinstance(self.proxy_server, ThreadingHTTPServer):
                 self.proxy_server.upstream_proxy = new_proxy
                 proxy.ProxyHandler.upstream_proxy = new_proxy
+                proxy.ProxyHandler.upstream_name = proxy_str
             elif isinstance(self.proxy_server, SocksProxy):
                 self.proxy_server.upstream_proxy = new_proxy
+                self.proxy_server.upstream_name = proxy_str
+                if self.proxy_server.http_server is not None:
+                    proxy.ProxyHandler.upstream_proxy = new_proxy
+                    proxy.ProxyHandler.upstream_name = proxy_str
         
-        if isinstance(new_proxy, dict):
-            if 'http' in new_proxy:
-                self.current_proxy_var.set(new_proxy['http'])
-            elif 'proxy_type' in new_proxy:
-                proxy_type = 'socks4' if new_proxy['proxy_type'] == proxy.socks.SOCKS4 else 'socks5'
-                self.current_proxy_var.set(f"{proxy_type}://{new_proxy['addr']}:{new_proxy['port']}")
-        elif isinstance(new_proxy, str):
-            self.current_proxy_var.set(new_proxy)
+        if isinstance(new_proxy, proxy.UpstreamProxy):
+            self.current_proxy_var.set(new_proxy.label)
         else:
             self.current_proxy_var.set(str(new_proxy))
         
@@ -218,13 +219,13 @@ class ProxyGUI:
 
     def _refresh_proxy_pool_thread(self):
         try:
-            asyncio.run(self.proxy_pool.refresh_proxies())
+            self.run_async(self.proxy_pool.refresh_proxies())
             self.master.after(0, self.update_proxy_count)
             
-            new_proxy_str = asyncio.run(self.proxy_pool.get_proxy())
+            new_proxy_str = self.run_async(self.proxy_pool.get_proxy())
             if new_proxy_str:
                 new_proxy = parse_proxy_string(new_proxy_str)
-                self.update_proxy(new_proxy)
+                self.update_proxy(new_proxy, new_proxy_str)
                 self.queue_log_message(f"代理池刷新完成，选择新代理: {new_proxy_str}", "INFO")
             else:
                 self.queue_log_message("代理池刷新完成，但没有可用的代理", "WARNING")
@@ -238,6 +239,7 @@ class ProxyGUI:
             self.upstream_url_combo['values'] = new_values
 
     def on_log_level_change(self, event):
+        proxy.set_log_level(self.log_level.get())
         self.queue_log_message(f"日志级别已更改为: {self.log_level.get()}", "INFO")
 
     @property
@@ -245,10 +247,8 @@ class ProxyGUI:
         return ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
 
     def save_proxies_to_file(self):
-        proxy_file = 'proxies.json'
         try:
-            with open(proxy_file, 'w') as f:
-                json.dump({"proxies": self.proxy_pool.proxies}, f, indent=2)
+            self.run_async(self.proxy_pool.save_to_file())
             self.queue_log_message(f"成功保存 {len(self.proxy_pool.proxies)} 个代理到文件", "INFO")
         except Exception as e:
             self.queue_log_message(f"保存代理到文件时发生错误: {str(e)}", "ERROR")
@@ -264,7 +264,7 @@ class ProxyGUI:
     def _clean_proxy_pool_thread(self):
         try:
             initial_count = len(self.proxy_pool.proxies)
-            asyncio.run(self._clean_proxies())
+            self.run_async(self._clean_proxies())
             final_count = len(self.proxy_pool.proxies)
             removed_count = initial_count - final_count
 
@@ -273,24 +273,24 @@ class ProxyGUI:
             
             if final_count == 0:
                 self.queue_log_message("代理池为空，尝试获取新代理...", "INFO")
-                new_proxies = asyncio.run(get_proxies_from_url(self.upstream_url_var.get()))
+                new_proxies = self.run_async(get_proxies_from_url(self.upstream_url_var.get()))
                 if new_proxies:
-                    asyncio.run(self.proxy_pool.add_proxies(new_proxies))
+                    self.run_async(self.proxy_pool.add_proxies(new_proxies))
                     self.queue_log_message(f"成功获取并添加 {len(new_proxies)} 个新代理到代理池", "INFO")
                     self.save_proxies_to_file()
-                    new_proxy_str = asyncio.run(self.proxy_pool.get_proxy())
+                    new_proxy_str = self.run_async(self.proxy_pool.get_proxy())
                     if new_proxy_str:
                         new_proxy = parse_proxy_string(new_proxy_str)
-                        self.update_proxy(new_proxy)
+                        self.update_proxy(new_proxy, new_proxy_str)
                         self.queue_log_message(f"成功获取新的有效代理: {new_proxy_str}", "INFO")
                 else:
                     self.queue_log_message("无法从网站获取新的代理", "WARNING")
             else:
                 self.save_proxies_to_file()
-                new_proxy_str = asyncio.run(self.proxy_pool.get_proxy())
+                new_proxy_str = self.run_async(self.proxy_pool.get_proxy())
                 if new_proxy_str:
                     new_proxy = parse_proxy_string(new_proxy_str)
-                    self.update_proxy(new_proxy)
+                    self.update_proxy(new_proxy, new_proxy_str)
                     self.queue_log_message(f"使用现有代理: {new_proxy_str}", "INFO")
 
             self.master.after(0, self.update_proxy_count)
@@ -298,22 +298,12 @@ class ProxyGUI:
             self.queue_log_message(f"清理代理池时发生错误: {str(e)}", "ERROR")
 
     async def _clean_proxies(self):
-        valid_proxies = []
-        for proxy_str in self.proxy_pool.proxies:
-            if await self._is_proxy_valid(proxy_str):
-                valid_proxies.append(proxy_str)
-            else:
+        def on_result(proxy_str, ok):
+            if not ok:
                 self.queue_log_message(f"移除无效代理: {proxy_str}", "INFO")
-        self.proxy_pool.proxies = valid_proxies
 
-    async def _is_proxy_valid(self, proxy_str):
-        try:
-            parsed_proxy = parse_proxy_string(proxy_str)
-            async with aiohttp.ClientSession() as session:
-                async with session.get('http://www.example.com', proxy=parsed_proxy, timeout=5) as response:
-                    return response.status == 200
-        except Exception:
-            return False
+        checker = HealthChecker(self.proxy_pool)
+        await checker.clean(on_result=on_result)
 
     def start_proxy(self):
         if self.is_running:
@@ -360,14 +350,14 @@ class ProxyGUI:
 
     def get_initial_proxy(self, upstream_url):
         if self.proxy_pool.proxies:
-            return random.choice(self.proxy_pool.proxies)
+            return self.proxy_pool.select()
         
         try:
-            new_proxies = asyncio.run(get_proxies_from_url(upstream_url))
+            new_proxies = self.run_async(get_proxies_from_url(upstream_url))
             if new_proxies:
-                asyncio.run(self.proxy_pool.add_proxies(new_proxies))
+                self.run_async(self.proxy_pool.add_proxies(new_proxies))
                 self.save_proxies_to_file()
-                return asyncio.run(self.proxy_pool.get_proxy())
+                return self.run_async(self.proxy_pool.get_proxy())
         except Exception as e:
             self.queue_log_message(f"获取初始代理时发生错误: {str(e)}", "ERROR")
         return None
@@ -383,6 +373,8 @@ class ProxyGUI:
         def shutdown_server():
             try:
                 if self.proxy_server:
+                    if getattr(self.proxy_server, 'refresher', None):
+                        self.proxy_server.refresher.stop()
                     if isinstance(self.proxy_server, ThreadingHTTPServer):
                         self.proxy_server.shutdown()
                         self.proxy_server.server_close()
@@ -438,6 +430,8 @@ class ProxyGUI:
             self.master.after(0, self.stop_proxy)
 
     def queue_log_message(self, message, level):
+        if proxy.LOG_LEVELS.get(level, 0) < proxy.log_writer.level:
+            return
         self.log_queue.put((message, level))
         if self.after_id is None:
             self.after_id = self.master.after(100, self.process_log_queue)
@@ -470,34 +464,19 @@ class ProxyGUI:
         if self.proxy_thread and self.proxy_thread.is_alive():
             self.proxy_thread.join(timeout=2)
         
-        # 关闭所有可能的网络连接
-        try:
-            loop = asyncio.get_event_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
-        tasks = asyncio.all_tasks(loop)
-        for task in tasks:
-            task.cancel()
-        
-        if tasks:
-            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
-        
-        loop.close()
+        # 停止后台事件循环，取消其中未完成的任务
+        self.scheduler.stop()
         
         # 确保日志队列被处理
         self.process_log_queue()
 
+    def run_async(self, coro):
+        # 在后台事件循环中执行协程并等待结果
+        return self.scheduler.submit(coro).result()
+
     def load_proxies_from_file(self):
-        proxy_file = 'proxies.json'
         try:
-            with open(proxy_file, 'r') as f:
-                data = json.load(f)
-            if isinstance(data, dict) and 'proxies' in data:
-                self.proxy_pool.proxies = data['proxies']
-            else:
-                self.proxy_pool.proxies = data  # 兼容旧格式
+            self.run_async(self.proxy_pool.load_from_file())
             self.queue_log_message(f"从文件加载了 {len(self.proxy_pool.proxies)} 个代理", "INFO")
             self.update_proxy_count()
         except Exception as e: